@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: @Leedehai
+#
+# File: inspectee.py
+# ---------------------------
+# Mocks a test program, for runs without a timer ('--timer builtin'): prints
+# the content of the files given, and exits with the code given by '--exit'.
+
+import sys
+
+args = sys.argv[1:]
+exit_code = 0
+if len(args) >= 2 and args[0] == "--exit":
+    exit_code = int(args[1])
+    args = args[2:]
+for filename in args:
+    with open(filename, 'r') as f:
+        sys.stdout.write(f.read())
+sys.exit(exit_code)
@@ -13,6 +13,9 @@ try:
     delimiter = os.environ["CTIMER_DELIMITER"]
 except KeyError:
     delimiter = ""
+stats_filename = os.environ.get("CTIMER_STATS", None)
+if os.environ.get("MOCK_OLD_TIMER", None) == "1":
+    stats_filename = None  # Mocks a timer that doesn't support CTIMER_STATS.
 
 INSPECTEE_STDOUT_RAW = """Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut
 labore et dolore magna aliqua. Dolor sed viverra ipsum nunc aliquet bibendum enim. In massa tempor nec feugiat. Nunc
@@ -56,11 +59,15 @@ if args[0] == "timeout.exe":
     if len(args) >= 2 and args[1] == "--tweak-stdout":
         print(INSPECTEE_STDOUT_RAW_TWEAKED)
     stats = STATS_JSON % ("timeout", 1500, 1500.02)
-    print(delimiter + stats + delimiter)
 else:
     if len(args) >= 2 and args[-1] == "--print":
         print(INSPECTEE_STDOUT_RAW)
     if len(args) >= 2 and args[-1] == "--tweak-stdout":
         print(INSPECTEE_STDOUT_RAW_TWEAKED)
     stats = STATS_JSON % ("return", 0, 1.01)
+
+if stats_filename:
+    with open(stats_filename, 'w') as f:
+        f.write(stats)
+else:
     print(delimiter + stats + delimiter)
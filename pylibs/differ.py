@@ -5,11 +5,26 @@
 # File: diff_html_str.py
 # ---------------------------
 # Returns a valid HTML string to render a diff view.
+#
+# The lines are interned as integers and diff'ed with Myers' O(ND) algorithm,
+# in linear space (the "middle snake" variant), which is fast when the files
+# are large but differ in few lines, i.e. the usual case. Unless the whole
+# files are shown (by default), unchanged lines more than the given number of
+# lines away from a change are collapsed. If the table would be too large, the
+# unchanged lines are collapsed further, down to none. If the files are so
+# different that the diff would take too long, or the changed lines alone
+# would make the table too large, a summary is rendered instead: the first
+# divergence, and the counts of lines not found in the other file.
 
 import os
 import difflib
+import html
+import time
+from collections import Counter
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+
+from pylibs.runner_compress import open_maybe_compressed
 
 _MISSING_EXPECTED_FILE_HTML_FORMAT = """
 <div style='width:80ch; padding:1ch'>
@@ -22,6 +37,45 @@ _MISSING_EXPECTED_FILE_HTML_FORMAT = """
     </span>
 </div>"""
 
+_SUMMARY_HTML_FORMAT = """
+<div class="info_div">
+    <span class="info_key">diff too large, summary only</span><br>
+    <span class="info_value">
+        &nbsp;&nbsp;{reason}<br>
+        &nbsp;&nbsp;expected: {expected_count} lines, {expected_only_count} not found in actual<br>
+        &nbsp;&nbsp;actual: {actual_count} lines, {actual_only_count} not found in expected<br>
+        &nbsp;&nbsp;first divergence: line {first_line}
+    </span>
+</div>"""
+
+_COLLAPSED_HTML_FORMAT = """
+<div class="info_div">
+    <span class="info_key">diff too large, unchanged lines collapsed</span><br>
+    <span class="info_value">
+        &nbsp;&nbsp;the diff has more than {max_rows} rows, so {context_lines} unchanged lines are shown around each change
+    </span>
+</div>"""
+
+_TABLE_HEAD = """
+    <table class="diff" id="difflib_chg_to0__top">
+        <thead><tr><th class="diff_next"><br /></th><th colspan="2" class="diff_header">expected</th><th class="diff_next"><br /></th><th colspan="2" class="diff_header">actual</th></tr></thead>"""
+
+DEFAULT_CONTEXT_LINES = None  # None: show all lines.
+# Unchanged lines shown before the first divergence in a summary.
+_SUMMARY_CONTEXT_LINES = 5
+# Unchanged lines shown around changes if the table would be too large with
+# the requested context; if it still would be, none are shown.
+_COLLAPSED_CONTEXT_LINES = 5
+# The budget of the diff: the number of steps of Myers' algorithm, and time.
+_MAX_DIFF_STEPS = 2 * 1000 * 1000
+_MAX_DIFF_SEC = 5.0
+_MAX_TABLE_ROWS = 10000
+# Intraline changes are shown only for similar lines, as in difflib.HtmlDiff.
+_MAX_INTRALINE_CHARS = 2000
+_INTRALINE_CUTOFF = 0.75
+
+Opcode = Tuple[str, int, int, int, int]  # As difflib's get_opcodes().
+
 with open(Path(__file__).parent.joinpath("diff_head.html"), 'r') as diff_head_f:
     _DIFF_HEAD = diff_head_f.read()
 
@@ -64,19 +118,313 @@ def _get_size_str(filename: str) -> str:
     return "%d B" % os.path.getsize(filename)
 
 
-def _replace_outdated_html_bits(html_str: str) -> str:
-    return html_str \
-        .replace("cellspacing=\"0\" cellpadding=\"0\" rules=\"groups\"", "") \
-        .replace("<colgroup></colgroup>", "") \
-        .replace("nowrap=\"nowrap\"", "class=\"data\"")
+class _BudgetExceeded(Exception):
+    pass
+
+
+class _Budget:
+    def __init__(self):
+        self.steps_ = 0
+        self.deadline_ = time.monotonic() + _MAX_DIFF_SEC
+
+    def spend(self, steps: int) -> None:
+        self.steps_ += steps
+        if (self.steps_ > _MAX_DIFF_STEPS
+                or time.monotonic() > self.deadline_):
+            raise _BudgetExceeded()
+
+
+def _intern_lines(a_lines: List[str],
+                  b_lines: List[str]) -> Tuple[List[int], List[int]]:
+    ids: Dict[str, int] = {}
+    return ([ids.setdefault(e, len(ids)) for e in a_lines],
+            [ids.setdefault(e, len(ids)) for e in b_lines])
+
+
+def _bisect(a: List[int], a0: int, a1: int, b: List[int], b0: int, b1: int,
+            budget: _Budget) -> Tuple[int, int]:
+    # Finds where the forward and the backward searches for the shortest edit
+    # script meet, which splits the problem in two; the sequences' first and
+    # last elements differ. After diff-match-patch's diff_bisect().
+    n, m = a1 - a0, b1 - b0
+    max_d = (n + m + 1) // 2
+    v_offset, v_length = max_d + 1, 2 * max_d + 3
+    v1, v2 = [-1] * v_length, [-1] * v_length
+    v1[v_offset + 1], v2[v_offset + 1] = 0, 0
+    delta = n - m
+    front = delta % 2 != 0  # Whether the forward search detects the overlap.
+    k1start, k1end, k2start, k2end = 0, 0, 0, 0
+    for d in range(max_d + 1):
+        budget.spend(2 * d + 1)
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d
+                            and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[a0 + x1] == b[b0 + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:  # Ran off the right of the graph.
+                k1end += 2
+            elif y1 > m:  # Ran off the bottom of the graph.
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return a0 + x1, b0 + y1
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d
+                            and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while (x2 < n and y2 < m
+                   and a[a1 - 1 - x2] == b[b1 - 1 - y2]):
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:  # Ran off the left of the graph.
+                k2end += 2
+            elif y2 > m:  # Ran off the top of the graph.
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    if x1 >= n - x2:
+                        return a0 + x1, b0 + x1 - (k1_offset - v_offset)
+    raise AssertionError("the searches should have met")
+
+
+def _get_opcodes(a: List[int], b: List[int], budget: _Budget) -> List[Opcode]:
+    # Matching blocks (i, j, size): the common prefix and suffix of each
+    # subproblem, which is then split by _bisect().
+    blocks: List[Tuple[int, int, int]] = []
+    subproblems = [(0, len(a), 0, len(b))]
+    while subproblems:
+        a0, a1, b0, b1 = subproblems.pop()
+        size = 0
+        while (a0 + size < a1 and b0 + size < b1
+               and a[a0 + size] == b[b0 + size]):
+            size += 1
+        if size > 0:
+            blocks.append((a0, b0, size))
+            a0, b0 = a0 + size, b0 + size
+        size = 0
+        while (a0 < a1 - size and b0 < b1 - size
+               and a[a1 - 1 - size] == b[b1 - 1 - size]):
+            size += 1
+        if size > 0:
+            blocks.append((a1 - size, b1 - size, size))
+            a1, b1 = a1 - size, b1 - size
+        if a0 == a1 or b0 == b1:
+            continue
+        x, y = _bisect(a, a0, a1, b, b0, b1, budget)
+        subproblems.append((x, a1, y, b1))
+        subproblems.append((a0, x, b0, y))
+    blocks.sort()
+    opcodes: List[Opcode] = []
+    i, j = 0, 0
+    for block_i, block_j, size in blocks + [(len(a), len(b), 0)]:
+        if i < block_i and j < block_j:
+            opcodes.append(("replace", i, block_i, j, block_j))
+        elif i < block_i:
+            opcodes.append(("delete", i, block_i, j, j))
+        elif j < block_j:
+            opcodes.append(("insert", i, i, j, block_j))
+        if size > 0:
+            if opcodes and opcodes[-1][0] == "equal":  # Adjacent blocks.
+                _, i1, _, j1, _ = opcodes.pop()
+                opcodes.append(
+                    ("equal", i1, block_i + size, j1, block_j + size))
+            else:
+                opcodes.append(
+                    ("equal", block_i, block_i + size, block_j, block_j + size))
+        i, j = block_i + size, block_j + size
+    return opcodes
+
+
+def _group_opcodes(opcodes: List[Opcode],
+                   context_lines: Optional[int]) -> List[List[Opcode]]:
+    # Same as difflib's get_grouped_opcodes(): hunks of changes, with up to
+    # context_lines unchanged lines around.
+    if context_lines == None:
+        return [opcodes]
+    n = context_lines
+    codes = list(opcodes)
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return groups
+
+
+def _escape(s: str) -> str:
+    return html.escape(s, quote=False).replace(" ", "&nbsp;")
+
+
+def _span(css_class: str, s: str) -> str:
+    # An empty line is shown as a space, so the row doesn't collapse.
+    return "<span class=\"%s\">%s</span>" % (css_class, _escape(s or " "))
+
+
+def _render_changed_pair(a_line: str, b_line: str) -> Tuple[str, str]:
+    matcher = difflib.SequenceMatcher(None, a_line, b_line, autojunk=False)
+    if (len(a_line) > _MAX_INTRALINE_CHARS or len(b_line) >
+            _MAX_INTRALINE_CHARS or matcher.real_quick_ratio() <
+            _INTRALINE_CUTOFF or matcher.ratio() < _INTRALINE_CUTOFF):
+        return _span("diff_sub", a_line), _span("diff_add", b_line)
+    a_pieces, b_pieces = [], []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            a_pieces.append(_escape(a_line[i1:i2]))
+            b_pieces.append(_escape(b_line[j1:j2]))
+            continue
+        if i2 > i1:
+            a_pieces.append(
+                _span("diff_chg" if tag == "replace" else "diff_sub",
+                      a_line[i1:i2]))
+        if j2 > j1:
+            b_pieces.append(
+                _span("diff_chg" if tag == "replace" else "diff_add",
+                      b_line[j1:j2]))
+    return "".join(a_pieces), "".join(b_pieces)
+
+
+def _render_row(nav: str, nav_id: str, a_lineno: Optional[int], a_html: str,
+                b_lineno: Optional[int], b_html: str) -> str:
+    def header(side: str, lineno: Optional[int]) -> str:
+        if lineno == None:
+            return "<td class=\"diff_header\"></td>"
+        return "<td class=\"diff_header\" id=\"%s0_%d\">%d</td>" % (
+            side, lineno, lineno)
+
+    return ("<tr><td class=\"diff_next\"%s>%s</td>%s<td class=\"data\">%s"
+            "</td><td class=\"diff_next\">%s</td>%s<td class=\"data\">%s"
+            "</td></tr>" %
+            (nav_id, nav, header("from", a_lineno), a_html, nav,
+             header("to", b_lineno), b_html))
+
+
+def _render_table(a_lines: List[str], b_lines: List[str],
+                  groups: List[List[Opcode]]) -> Optional[str]:
+    # Returns None if there would be too many rows.
+    row_count = sum(
+        max(i2 - i1, j2 - j1) for group in groups
+        for _, i1, i2, j1, j2 in group)
+    if row_count > _MAX_TABLE_ROWS:
+        return None
+    a_lines = [e.rstrip("\n").expandtabs(4) for e in a_lines]
+    b_lines = [e.rstrip("\n").expandtabs(4) for e in b_lines]
+    tbodies = []
+    for g, group in enumerate(groups):
+        # The first row of each hunk links to the next hunk, or to the top.
+        if g + 1 < len(groups):
+            nav = "<a href=\"#difflib_chg_to0__%d\">n</a>" % (g + 1)
+        else:
+            nav = "<a href=\"#difflib_chg_to0__top\">t</a>"
+        nav_id = " id=\"difflib_chg_to0__%d\"" % g
+        rows = []
+        for tag, i1, i2, j1, j2 in group:
+            for k in range(max(i2 - i1, j2 - j1)):
+                i, j = i1 + k, j1 + k
+                a_lineno = i + 1 if i < i2 else None
+                b_lineno = j + 1 if j < j2 else None
+                if tag == "equal":
+                    a_html, b_html = _escape(a_lines[i]), _escape(b_lines[j])
+                elif a_lineno != None and b_lineno != None:
+                    a_html, b_html = _render_changed_pair(
+                        a_lines[i], b_lines[j])
+                else:
+                    a_html = _span("diff_sub", a_lines[i]) if a_lineno else ""
+                    b_html = _span("diff_add", b_lines[j]) if b_lineno else ""
+                rows.append(
+                    _render_row(nav, nav_id, a_lineno, a_html, b_lineno,
+                                b_html))
+                nav, nav_id = "", ""
+        tbodies.append("\n        <tbody>\n            %s\n        </tbody>" %
+                       "\n            ".join(rows))
+    return _TABLE_HEAD + "".join(tbodies) + "\n    </table>"
+
+
+def _render_summary(a_lines: List[str], b_lines: List[str], a: List[int],
+                    b: List[int], reason: str) -> str:
+    first = 0  # Index of the first divergence.
+    while first < len(a) and first < len(b) and a[first] == b[first]:
+        first += 1
+    a_count, b_count = Counter(a), Counter(b)
+    # The lines around the first divergence, paired up without alignment.
+    begin = max(0, first - _SUMMARY_CONTEXT_LINES)
+    end_a = min(len(a), first + 4 * _SUMMARY_CONTEXT_LINES)
+    end_b = min(len(b), first + 4 * _SUMMARY_CONTEXT_LINES)
+    group = [("equal", begin, first, begin, first)]
+    if first < end_a or first < end_b:
+        group.append(("replace", first, end_a, first, end_b))
+    return _SUMMARY_HTML_FORMAT.format(
+        reason=html.escape(reason),
+        expected_count=len(a),
+        expected_only_count=sum((a_count - b_count).values()),
+        actual_count=len(b),
+        actual_only_count=sum((b_count - a_count).values()),
+        first_line=first + 1) + _render_table(a_lines, b_lines, [group])
+
+
+def _make_diff_table(a_lines: List[str], b_lines: List[str],
+                     context_lines: Optional[int]) -> str:
+    a, b = _intern_lines(a_lines, b_lines)
+    try:
+        opcodes = _get_opcodes(a, b, _Budget())
+    except _BudgetExceeded:
+        return _render_summary(
+            a_lines, b_lines, a, b,
+            "the diff takes more than %d steps or %.1f sec" %
+            (_MAX_DIFF_STEPS, _MAX_DIFF_SEC))
+    table = _render_table(a_lines, b_lines,
+                          _group_opcodes(opcodes, context_lines))
+    if table != None:
+        return table
+    for fallback_lines in [_COLLAPSED_CONTEXT_LINES, 0]:
+        if context_lines != None and fallback_lines >= context_lines:
+            continue
+        table = _render_table(a_lines, b_lines,
+                              _group_opcodes(opcodes, fallback_lines))
+        if table != None:
+            return _COLLAPSED_HTML_FORMAT.format(
+                max_rows=_MAX_TABLE_ROWS,
+                context_lines=fallback_lines) + table
+    return _render_summary(a_lines, b_lines, a, b,
+                           "the changed lines make more than %d rows" %
+                           _MAX_TABLE_ROWS)
 
 
 # return: (golden_file_found, html_string)
+# context_lines: the number of unchanged lines shown around changes, or None to
+# show all lines.
 def get_diff_html_str(
     html_title: str,
     desc: str,
     expected_filename: str,
     actual_filename: str,
+    context_lines: Optional[int] = DEFAULT_CONTEXT_LINES,
 ) -> Tuple[bool, Optional[str]]:
     assert actual_filename != None and expected_filename != None
     assert os.path.isfile(actual_filename)
@@ -86,17 +434,12 @@ def get_diff_html_str(
             expected_lines = list(f)
     else:
         expected_lines = []
-    with open(actual_filename, 'r') as f:
+    with open_maybe_compressed(actual_filename, 'rt') as f:
         actual_lines = list(f)
     if actual_lines == expected_lines:
         return True, None  # has golden file, same content
-    diff_table_str = _replace_outdated_html_bits(
-        difflib.HtmlDiff(tabsize=4).make_table(expected_lines,
-                                               actual_lines,
-                                               fromdesc='expected',
-                                               todesc='actual',
-                                               context=False,
-                                               numlines=5))
+    diff_table_str = _make_diff_table(expected_lines, actual_lines,
+                                      context_lines)
     slot_contents: Dict[str, str] = {
         "title": html_title,
         "diff_head": _DIFF_HEAD,
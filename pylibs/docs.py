@@ -34,11 +34,37 @@ EXPLANATION_STRING = """\x1b[33mSupplementary docs\x1b[0m
           program's exit status; non-0 exit is reserved for internal error.
         * the timer should pass whatever environment variables it has to
           the inspected program.
+    '--timer-stats': how the stats report is received from the timer:
+        file      : (default) CTIMER_STATS is set to a per-task file in the
+                    log directory, so the stats report doesn't have to be
+                    found in stdout; if the timer doesn't write the file
+                    (an older timer), the report is read from stdout, by
+                    a CTIMER_DELIMITER unique to the task
+        delimiter : CTIMER_STATS is not set; the report is found in stdout
+                    by CTIMER_DELIMITER, which fails if the inspectee prints
+                    the delimiter string
+    '--timer builtin': no timer program; the runner spawns the test itself
+        (posix_spawn, in a new session), which saves one fork and exec per
+        task, and reads the stats from wait4(). Linux only, Python 3.8+.
+        Accuracy, compared with ctimer:
+        * processor time (user + sys) comes from the same kernel rusage, so
+          it's as accurate
+        * the timeout is enforced with RLIMIT_CPU, set with prlimit() right
+          after the spawn, which has a granularity of 1 second: a test that
+          exceeds its timeout is killed up to 1 sec (processor time) later
+          than ctimer would, and is reported as "timeout" if it used more
+          processor time than the timeout, even if it finished
+        * "maxrss_kb" is no less than the runner's own RSS (dozens of MB),
+          as Linux accounts the memory the child had before exec; it's
+          accurate for tests that use more than that
+        * CTIMER_* environment variables are not set for the test
 
 \x1b[33m'--meta':\x1b[0m
     This option passes the path of a file containing the metadata of tests.
     The metadata file could be either hand-written or script-generated; it
-    stores in JSON format an array of metadata objects. Each has keys:
+    stores in JSON format an array of metadata objects, or in JSON lines
+    format one metadata object per line (told by the first character being
+    '[' or not). Each has keys:
         "id"      : string
             unique description, also the test id
         \x1b[33m=== parameters contolling command invocation ===\x1b[0m
@@ -64,8 +90,16 @@ EXPLANATION_STRING = """\x1b[33mSupplementary docs\x1b[0m
         "timeout_ms" : integer or null
             the max processor time (ms) allowed; null: effectively infinite
         "exit"    : exit status object (see below), storing the expected exit
+        "max_rss_kb" : integer (optional)
+            the expected peak RSS (KiB), used by '--mem-budget'
     * all paths are relative to the current working directory
-    * mutually exclusive: --meta, --paths
+    * mutually exclusive: --meta, --paths, --paths-from
+    * tests are dispatched while later metadata objects are being read, so
+      the first test starts at once, unless an option needs all tests
+      beforehand ('--write-golden', '--history', '--shard', '--cache',
+      '--golden-manifest', '--adaptive-repeat', '--mem-budget'); JSON lines
+      are also parsed one line at a time. A bad metadata object is reported
+      when it's read, which may be after some tests have run.
 
 \x1b[33m'--paths':\x1b[0m
     In cases where only the paths of the test executables matter, prefer this
@@ -75,7 +109,10 @@ EXPLANATION_STRING = """\x1b[33mSupplementary docs\x1b[0m
         desc = (serial number), path = (the path provided with this option),
         args = [], envs = null, prefix = [], golden = null, timeout_ms = null,
         exit = { "type": "return", "repr": 0 } (exit status, see below)
-    * mutually exclusive: --meta, --paths
+    '--paths-from FILE' reads the paths from a file instead, one per line, or
+    from stdin if FILE is '-'; like '--meta', tests are dispatched while the
+    paths are being read.
+    * mutually exclusive: --meta, --paths, --paths-from
 
 \x1b[33m'--read-flakes':\x1b[0m
     Not unusually, some tests are flaky. Use this option to specify a
@@ -96,6 +133,208 @@ EXPLANATION_STRING = """\x1b[33mSupplementary docs\x1b[0m
     expected, and if the file exists, the content will be different.
     You have to manually check the tests are correct before writing.
 
+\x1b[33m'--engine':\x1b[0m
+    How tasks are run concurrently:
+        thread : (default) a pool of worker threads, each blocked on one
+                 timer process at a time
+        async  : one asyncio event loop spawns the timer processes and
+                 handles their exits and stdout EOFs, with at most as many
+                 processes alive as the worker count; suited for a large
+                 number of short-lived tests
+    Both engines produce the same master log.
+
+\x1b[33m'--stream-log':\x1b[0m
+    Append each result object to log.jsonl under the log directory as soon as
+    the task finishes (one JSON object per line, in the order of finishing),
+    instead of holding all results in memory until the end. The file is
+    fsync'ed periodically, so an interrupted run keeps the results of the
+    finished tasks. The side file log.jsonl.idx stores for each line a
+    fixed-size record of 3 little-endian uint64 (task index, byte offset,
+    byte length), so tools can seek to any task.
+    The master log is built from these files at the end of the run; to build
+    it after an interrupted run:
+        python3 -m pylibs.runner_log_stream LOG_DIR/log.jsonl LOG_DIR/log.json
+
+\x1b[33m'--history':\x1b[0m
+    Dispatch the tasks expected to take the longest wall time first, so that
+    a long test doesn't start last and hold up the end of the run. The
+    expected times are read from the given file, which is either
+    * a history file: it is created if not existing, and updated after the
+      run with this run's wall time, processor time and maximum resident set
+      size of each test, or
+    * a master log of a previous run: it is only read.
+    Tests not found in the history are expected to take the median time of
+    those found. The summary reports the predicted and actual makespan (the
+    wall time from the first task's start to the last task's end).
+
+\x1b[33m'--cache':\x1b[0m
+    Skip tests whose inputs are unchanged since they last passed, and use
+    their cached results instead. The cache key of a test is computed from
+    the bytes of the test executable, of the prefix binaries (the first one
+    is looked up in PATH if needed) and of the timer, plus the test's "args",
+    "envs", "timeout_ms", "exit" and the golden file content, and the
+    options '--timer-stats', '--also-stderr', '--separate-stderr' and
+    '--max-output-bytes'. The files' digests are kept in the cache directory
+    and computed again only if the files' size or mtime change. Passing
+    results and their stdout are stored in the cache directory, with atomic
+    writes so that multiple runners can share one cache directory.
+    A cached result has "cached": true in the master log, and the stdout is
+    copied to the log directory; its "times_ms" "proc" is from the run that
+    was cached, and "abs_start" and "abs_end" are the time it's reused.
+    * not compatible with '--repeat' or '--write-golden'
+
+\x1b[33m'--shard':\x1b[0m
+    Run only the I-th of N shards of the tests (1 <= I <= N), so one suite can
+    be split across machines. The partition is deterministic:
+    * if '--history' is given and has records of the tests, the tests are
+      assigned longest first, each to the shard with the least expected
+      wall time so far (tests without records are expected to take the
+      median time); all shards should be given the same history content,
+    * otherwise, the tests are assigned by the hash of their IDs.
+    Repeats of a test are in the same shard. Besides the master log, the log
+    directory has shard.json, which records the shard, the method, the
+    expected wall time (ms) of each shard, and the IDs of the tests in it.
+
+\x1b[33m'--mem-budget':\x1b[0m
+    Start a task only if the sum of the expected peak RSS of the running tasks,
+    plus its own, fits in the budget, e.g. '48G' (units: K, M, G, T, binary).
+    When a task doesn't fit, the next one in the queue that fits is started
+    instead, but once 64 tasks are started ahead of it, no other task is until
+    it fits; a task larger than the budget runs when nothing else is running.
+    The expected peak RSS is the metadata's "max_rss_kb" if given, or else the
+    "maxrss_kb" in '--history'; tests with neither are expected to take the
+    median of the known tests. The expected (simulated) and observed
+    concurrency are reported.
+    * tasks taken by '--worker' processes count against the same budget
+
+\x1b[33m'--pin-cpus':\x1b[0m
+    Pin each worker slot to a dedicated CPU, so that the processor time of the
+    tests is less noisy: the timers spawned by a slot, and the tests they run,
+    are confined to the slot's CPU (Linux only). The runner itself is not, so
+    its work (capturing the stdout, diffing, ...) doesn't share the CPUs with
+    the tests. The CPUs are those in the given list, e.g. '--pin-cpus 0-3,8',
+    or else one logical CPU per physical core, so no two slots are SMT
+    siblings. Only CPUs this process is allowed to run on are used, no more
+    than the CPU quota of its cgroup (e.g. the container's); the worker count
+    is reduced to the number of CPUs if needed. The CPU is recorded in the
+    "cpu" field of each result in the master log.
+    * also works with '--worker', on the worker's machine
+
+\x1b[33m'--coordinator', '--worker':\x1b[0m
+    Spread one run across several runner processes. The process given
+    '--coordinator ADDR' runs the tests as usual, and also serves the tasks
+    to any number of processes started with
+        score_run.py --worker ADDR [--timer TIMER] [--sequential]
+    which take one task at a time per worker slot and send back the results.
+    Workers may join late and take the remaining tasks. If a worker is lost,
+    its unfinished tasks are put back to the queue.
+    * ADDR is a Unix domain socket path, or HOST:PORT for TCP
+    * the coordinator writes the master log; workers write the tests' stdout
+      and diff files into the coordinator's log directory, and run the tests
+      in the coordinator's working directory
+    * a worker uses the coordinator's timer unless '--timer' is given
+    * workers should present the run's token in $SCORE_COORDINATOR_TOKEN;
+      the coordinator writes it to coordinator.token (readable only by the
+      user) in its log directory, and uses $SCORE_COORDINATOR_TOKEN instead
+      of a random one if it's set, e.g.
+        SCORE_COORDINATOR_TOKEN=$(cat LOG/coordinator.token) \\
+            score_run.py --worker ADDR
+
+\x1b[33m'--adaptive-repeat':\x1b[0m
+    With '--repeat N', retire a test after its first K repeats if they all
+    pass with the same exit status and the same stdout; only the other tests
+    are repeated N times. In the master log, "repeat.all" of a retired test's
+    results is K, i.e. the number of repeats run.
+
+\x1b[33m'--max-failures':\x1b[0m
+    Stop the run once N unexpected errors are seen (flaky errors don't count):
+    no more tasks are started, and the running tests, with their timers, are
+    killed. In the master log, the tasks that are not run to completion have
+    "ok": false, "error_is_flaky": null, and the exception "task skipped: ..".
+    * tasks already taken by '--worker' processes are not killed, but their
+      results are discarded
+
+\x1b[33m'--postprocess-workers':\x1b[0m
+    Compute the diffs between the tests' stdout and the golden files in a
+    pool of N processes, so that large diffs don't slow down the workers
+    running the tests (Python threads share one interpreter lock). The diffs
+    are computed by the workers themselves if N is 0, the default. After the
+    run, the number of diffs, and how long all N processes were busy, are
+    reported; if that is most of the run, a larger N may help.
+    * also works with '--worker', on the worker's machine
+
+\x1b[33m'--diff-context':\x1b[0m
+    A diff file (.diff.html) shows the whole stdout and golden files, side by
+    side, by default ('full'); with '--diff-context N', only the changes and
+    N unchanged lines around each are shown. If that has more than 10000
+    rows, 5 unchanged lines are shown around each change, or none. If the
+    diff takes too long, or the changed lines alone have more than 10000
+    rows, only a summary is shown.
+    * '--worker' processes use the coordinator's setting
+
+\x1b[33mStdout and stderr:\x1b[0m
+    A test's stdout is streamed to its stdout file in the log directory as it
+    is printed, so the runner's memory doesn't grow with the output. Color
+    sequences and trailing whitespace are removed, as in the golden files.
+    '--also-stderr'      : the stderr is merged into the stdout
+    '--separate-stderr'  : the stderr is written to a .stderr file next to the
+                           stdout file, as is; "stderr_file" in the results
+    '--max-output-bytes' : the stdout file is cut at N bytes, the rest is
+                           discarded; the result has the exception "stdout
+                           truncated: ..", and with '--write-golden', the
+                           golden file is not written
+    The stdout's SHA-256 is recorded as "stdout.actual_sha256" in the results,
+    so identical outputs can be found across tasks and runs.
+
+\x1b[33m'--artifacts':\x1b[0m
+    How the stdout files are stored in the log directory:
+    plain : each task's stdout file is a file of its own (default)
+    dedup : each distinct stdout is stored once, as objects/ab/abcdef.. in
+            the log directory (named by its SHA-256), and each task's stdout
+            file is a hardlink to it, which saves space and inodes when many
+            tasks print the same, e.g. with '--repeat'; if the file system
+            doesn't support hardlinks, the stdout files are kept as is
+    pack  : the stdout, diff and stderr files of each task are appended to
+            one of a few pack files, packs/*.pack in the log directory, once
+            the task is finished, and removed; removing the log directory is
+            then fast even after a large run
+    With 'pack', the results keep the file paths, but the files don't exist:
+    the "packed" field of a result has "stdout", "diff", "stderr" keys for the
+    packed files, each with "pack" (the pack file), "offset", "length". Each
+    pack file has an index, *.pack.idx, with a JSON line per file. score_ui.py
+    extracts the packed files of the tasks with errors ('--extract-all': all
+    tasks) into the generated directory.
+
+\x1b[33m'--compress-artifacts':\x1b[0m
+    Write the stdout and diff files compressed, as 'gzip' (.gz appended to the
+    file names) or 'lzma' (.xz), while the tests run; test output is usually
+    text that compresses 10x or more. Works with any '--artifacts'. The diff
+    with the golden file is computed from the compressed stdout file, and
+    score_ui.py extracts the files of the tasks with errors ('--extract-all':
+    all tasks) into the generated directory, decompressed.
+    * with '--write-golden', the golden files are written uncompressed
+    * the cache (see '--cache') keeps the stdout uncompressed
+
+\x1b[33m'--meta-cache':\x1b[0m
+    Keep a snapshot of the '--meta' file in DIR: the metadata objects, as
+    parsed, validated and hashed, in a binary format that loads much faster.
+    Later runs with the same file use the snapshot instead of reading the
+    file, as long as the file's size and mtime are unchanged, or else its
+    SHA-256 digest is. A snapshot is written once all the metadata objects
+    are read, with atomic writes so that multiple runners can share DIR.
+    * a file modified less than 2 sec before it's snapshotted is hashed
+      again next time, as it could change again without its mtime changing
+    * snapshots are specific to the Python version
+
+\x1b[33m'--golden-manifest':\x1b[0m
+    Keep the golden files' SHA-256 digests in FILE, keyed by path, with the
+    size and mtime they were computed at. Before the run, each golden file is
+    stat'ed, and hashed again only if changed; then a test passes if its
+    stdout has the golden file's digest, without the golden file being read.
+    FILE is created if it doesn't exist.
+    * a golden file modified less than 2 sec before it's hashed is not
+      recorded, as it could change again without its mtime changing
+
 \x1b[33mExit status object:\x1b[0m
     A JSON object with keys:
     "type"  : string - "return", "timeout", "signal", "quit", "unknown"
@@ -115,11 +354,15 @@ EXPLANATION_STRING = """\x1b[33mSupplementary docs\x1b[0m
     golden file     the file storing the expected stdout output, nullable
     master log      a JSON file log.json under the log directory
     log directory   specified by '--log', which stores the master log
-                    and tests' stdout and diff, if any, among others
+                    and tests' stdout and diff, if any, among others; that
+                    of the previous run is renamed to a hidden trash name,
+                    ".<name>.trash-*" next to it, and deleted in background;
+                    if it's a symlink, the directory it points to is
+                    renamed, and the symlink is kept
 
 \x1b[33mMore on options:\x1b[0m
     Complete list of options: "--help".
     Concurrency is enabled, unless '--sequential' is given.
-    Unless '--help' or '--docs' is given:
+    Unless '--help', '--docs' or '--worker' is given:
         * '--timer' is needed, and
-        * exactly one of '--paths' and '--meta' is needed."""
+        * exactly one of '--paths', '--paths-from' and '--meta' is needed."""
@@ -11,7 +11,7 @@ import os
 import sys
 from io import StringIO, TextIOWrapper
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 from pylibs import schema
 from pylibs.score_utils import err_exit, error_s
@@ -22,6 +22,33 @@ POSSIBLE_TEST_ERRORS = [  # sync with EXPLANATION_STRING's spec
 
 FlakeDecls = Dict[str, List[str]]
 
+_FLAKE_DECLS_SCHEMA = schema.Schema({  # sync with EXPLANATION_STRING's spec
+    str: {
+        "errors": [schema.Or(*POSSIBLE_TEST_ERRORS)],
+        schema.Optional("reason"): str,
+        schema.Optional(str): object,  # Allow more fields, if any.
+    }
+})
+_POSSIBLE_TEST_ERROR_SET = frozenset(POSSIBLE_TEST_ERRORS)
+
+
+# Returns True only if _FLAKE_DECLS_SCHEMA accepts the data, with direct type
+# checks, which is much faster; the schema is only used to explain errors.
+def _is_valid_flake_decls(data: Any) -> bool:
+    if type(data) != dict or not data:  # The schema needs a str key.
+        return False
+    for test_id, decl in data.items():
+        if type(test_id) != str or type(decl) != dict:
+            return False
+        errors = decl.get("errors")
+        if type(errors) != list or not all(
+                type(e) == str and e in _POSSIBLE_TEST_ERROR_SET
+                for e in errors):
+            return False
+        if type(decl.get("reason", "")) != str:
+            return False
+    return True
+
 
 def _parse_file(f: TextIOWrapper, path: Path, flaky_tests_decls: FlakeDecls,
                 errors: List[str]) -> None:
@@ -31,13 +58,8 @@ def _parse_file(f: TextIOWrapper, path: Path, flaky_tests_decls: FlakeDecls,
         errors.append("not a JSON file: %s" % path)
         data = {}
     try:
-        schema.Schema({  # sync with EXPLANATION_STRING's spec
-            str: {
-                "errors": [schema.Or(*POSSIBLE_TEST_ERRORS)],
-                schema.Optional("reason"): str,
-                schema.Optional(str): object,  # Allow more fields, if any.
-            }
-        }).validate(data)
+        if not _is_valid_flake_decls(data):
+            _FLAKE_DECLS_SCHEMA.validate(data)
         for test_id, tolerable_errors in data.items():
             if test_id in flaky_tests_decls:
                 errors.append(
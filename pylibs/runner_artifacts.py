@@ -0,0 +1,198 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# How the tests' artifacts (stdout, diff and stderr files) are stored in the
+# log directory ('--artifacts'):
+#   plain: each task's artifact is a file of its own.
+#   dedup: content-addressed, i.e. each distinct stdout is stored once, as
+#          objects/ab/abcdef... (named by its SHA-256) in the log directory,
+#          and each task's stdout file is a hardlink to it. With '--repeat',
+#          identical stdout files then take one inode and one copy of data.
+#          The stdout file is at the same path as with 'plain'.
+#   pack:  once a task is finished, its artifacts are appended to one of a few
+#          append-only pack files, packs/*.pack in the log directory, and
+#          removed. The result's "packed" field has each artifact's
+#          PackRef; the artifact's file path in the result is kept, but
+#          the file doesn't exist. Readers extract artifacts on demand, see
+#          extract_artifact().
+#
+# Each pack file has an index, *.pack.idx, where each line is a JSON object
+# with keys "offset", "length", "file" (the artifact's file path), so the pack
+# file can be read without the master log.
+#
+# Artifacts may also be compressed, see runner_compress; the packed bytes are
+# those of the compressed file.
+
+import json
+import os
+import secrets
+import threading
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+from pylibs.runner_compress import make_decompressor
+
+ARTIFACTS_PLAIN = "plain"
+ARTIFACTS_DEDUP = "dedup"
+ARTIFACTS_PACK = "pack"
+ARTIFACTS_MODES = [ARTIFACTS_PLAIN, ARTIFACTS_DEDUP, ARTIFACTS_PACK]
+
+OBJECTS_DIR_BASE = "objects"
+PACKS_DIR_BASE = "packs"
+
+# A dict with keys "pack" (abs path), "offset", "length".
+PackRef = Dict[str, Any]
+
+_COPY_CHUNK_SIZE = 1 << 20
+
+
+def get_object_path(log_dirname: str, sha256: str) -> Path:
+    return Path(log_dirname, OBJECTS_DIR_BASE, sha256[:2], sha256)
+
+
+def store_deduplicated(log_dirname: str, filename: str, sha256: str) -> None:
+    """
+    Called once the file is written, and not to be modified any more. The file
+    becomes the object of its content, or else is replaced by a hardlink to
+    the existing object. If hardlinks are not supported, or the object has too
+    many, the file is kept as is.
+    """
+    object_path = get_object_path(log_dirname, sha256)
+    try:
+        os.makedirs(object_path.parent, exist_ok=True)
+        os.link(filename, object_path)
+        return  # The first file with this content.
+    except FileExistsError:
+        pass
+    except OSError:
+        return
+    temp_filename = filename + ".tmp"
+    try:
+        os.link(object_path, temp_filename)
+        os.replace(temp_filename, filename)  # Atomic.
+    except OSError:
+        if os.path.lexists(temp_filename):
+            os.remove(temp_filename)
+
+
+class _Pack:
+    def __init__(self, filename: str):
+        self.filename_ = filename
+        # Unbuffered: what's appended can be read at once, e.g. by the cache.
+        self.file_: BinaryIO = open(filename, 'ab', buffering=0)
+        self.index_file_ = open(filename + ".idx", 'a')
+        self.size_ = os.fstat(self.file_.fileno()).st_size
+
+    def append(self, filename: str) -> PackRef:
+        offset = self.size_
+        with open(filename, 'rb') as src:
+            for chunk in iter(lambda: src.read(_COPY_CHUNK_SIZE), b""):
+                self.file_.write(chunk)
+                self.size_ += len(chunk)
+        length = self.size_ - offset
+        self.index_file_.write(
+            json.dumps({
+                "offset": offset,
+                "length": length,
+                "file": filename
+            }) + "\n")
+        self.index_file_.flush()
+        return {"pack": self.filename_, "offset": offset, "length": length}
+
+    def close(self) -> None:
+        self.file_.close()
+        self.index_file_.close()
+
+
+class PackWriter:
+    """
+    Thread-safe. Appends artifacts to the pack files of this process, which
+    are opened as needed: a thread appends to a pack file that no other thread
+    is appending to, so there are as many pack files as threads appending at
+    the same time. Pack files are named uniquely, so processes (e.g. '--worker'
+    processes) can write to the same log directory.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.free_packs_: List[_Pack] = []
+        self.pack_count_ = 0
+        self.name_prefix_ = "%d-%s" % (os.getpid(), secrets.token_hex(4))
+
+    def append(self, log_dirname: str, filename: str) -> PackRef:
+        """
+        Appends the file to a pack file, and removes it.
+        """
+        with self.lock_:
+            pack = self._take_pack(log_dirname)
+        try:
+            ref = pack.append(filename)
+        finally:
+            with self.lock_:
+                self.free_packs_.append(pack)
+        os.remove(filename)
+        return ref
+
+    def close(self) -> None:
+        """
+        Closes the pack files; later appends open new ones.
+        """
+        with self.lock_:
+            for pack in self.free_packs_:
+                pack.close()
+            self.free_packs_.clear()
+
+    def _take_pack(self, log_dirname: str) -> _Pack:  # With the lock held.
+        packs_dirname = os.path.abspath(Path(log_dirname, PACKS_DIR_BASE))
+        for i, pack in enumerate(self.free_packs_):
+            if os.path.dirname(pack.filename_) == packs_dirname:
+                return self.free_packs_.pop(i)
+        os.makedirs(packs_dirname, exist_ok=True)
+        self.pack_count_ += 1
+        return _Pack(
+            str(
+                Path(packs_dirname,
+                     "%s-%d.pack" % (self.name_prefix_, self.pack_count_))))
+
+
+PACK_WRITER = PackWriter()
+
+
+def iter_artifact_chunks(filename: str,
+                         ref: Optional[PackRef]) -> Iterator[bytes]:
+    """
+    Yields the artifact's content: from the pack file if it's packed, or else
+    from the file.
+    """
+    with open(ref["pack"] if ref else filename, 'rb') as f:
+        if ref == None:
+            yield from iter(lambda: f.read(_COPY_CHUNK_SIZE), b"")
+            return
+        f.seek(ref["offset"])
+        remaining = ref["length"]
+        while remaining > 0:
+            chunk = f.read(min(remaining, _COPY_CHUNK_SIZE))
+            if not chunk:
+                raise OSError("pack file truncated: %s" % ref["pack"])
+            yield chunk
+            remaining -= len(chunk)
+
+
+def copy_artifact(filename: str, ref: Optional[PackRef],
+                  dst: BinaryIO) -> None:
+    """
+    Writes the artifact's content to dst, decompressed if it's compressed.
+    """
+    decompressor = make_decompressor(filename)
+    for chunk in iter_artifact_chunks(filename, ref):
+        dst.write(decompressor.decompress(chunk) if decompressor else chunk)
+
+
+def extract_artifact(filename: str, ref: Optional[PackRef],
+                     dest_filename: str) -> None:
+    """
+    Writes the artifact's content to dest_filename, decompressed.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dest_filename)),
+                exist_ok=True)
+    with open(dest_filename, 'wb') as f:
+        copy_artifact(filename, ref, f)
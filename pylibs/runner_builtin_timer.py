@@ -0,0 +1,184 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# The built-in timer, '--timer builtin': the test is spawned directly, instead
+# of by an external timer program, which saves one fork and exec per task. The
+# stats are read from the rusage given by wait4(), and are in the same form as
+# the external timer's stats JSON:
+#   {"maxrss_kb": int, "exit": {"type": str, "repr": int or None},
+#    "times_ms": {"total": float}}
+#
+# The timeout (processor time) is enforced by RLIMIT_CPU. It's set on the child
+# with prlimit() right after the spawn, as preexec_fn isn't thread-safe and
+# posix_spawn() can't set resource limits. The processor time used before that
+# is still counted against the limit.
+
+import asyncio
+import math
+import os
+import resource
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pylibs.runner_capture import READ_CHUNK_SIZE
+
+Stats = Dict[str, Any]
+
+# ru_maxrss is in KiB on Linux, but in bytes on macOS.
+_MAXRSS_UNIT_BYTES = 1 if sys.platform == "darwin" else 1024
+
+
+def is_builtin_timer_supported() -> bool:
+    return hasattr(os, "posix_spawnp") and hasattr(resource, "prlimit")
+
+
+def spawn_inspectee(cmd: List[str], env: Dict[str, str], also_stderr: bool,
+                    stderr_filename: Optional[str],
+                    timeout_ms: Optional[int]) -> Tuple[int, int]:
+    """
+    Spawns the command in a new session, and returns its pid and the read end
+    of its stdout pipe. The stderr goes to the stdout if also_stderr, or else
+    to the file if given. Raises OSError if the command can't be executed.
+    """
+    read_fd, write_fd = os.pipe()  # Not inherited, unless dup'ed to stdout.
+    file_actions = [(os.POSIX_SPAWN_DUP2, write_fd, 1)]
+    if also_stderr:
+        file_actions.append((os.POSIX_SPAWN_DUP2, write_fd, 2))
+    elif stderr_filename:
+        file_actions.append(
+            (os.POSIX_SPAWN_OPEN, 2, stderr_filename,
+             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+    else:
+        file_actions.append(
+            (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0))
+    try:
+        pid = os.posix_spawnp(cmd[0],
+                              cmd,
+                              env,
+                              file_actions=file_actions,
+                              setsid=True)
+    except OSError:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    if timeout_ms:
+        # RLIMIT_CPU is in whole seconds: SIGXCPU at the soft limit, SIGKILL
+        # at the hard limit.
+        limit_sec = math.ceil(timeout_ms / 1000.0)
+        try:
+            resource.prlimit(pid, resource.RLIMIT_CPU,
+                             (limit_sec, limit_sec + 1))
+        except ProcessLookupError:
+            pass  # Already exited.
+    return pid, read_fd
+
+
+def read_chunks(fd: int, on_chunk: Callable[[bytes], None]) -> None:
+    """
+    Reads until EOF, passing each chunk to on_chunk(), and closes the file
+    descriptor.
+    """
+    try:
+        for chunk in iter(lambda: os.read(fd, READ_CHUNK_SIZE), b""):
+            on_chunk(chunk)
+    finally:
+        os.close(fd)
+
+
+def wait_inspectee(pid: int, timeout_ms: Optional[int]) -> Stats:
+    _, status, rusage = os.wait4(pid, 0)
+    return _make_stats(status, rusage, timeout_ms)
+
+
+async def read_chunks_async(fd: int, on_chunk: Callable[[bytes],
+                                                         None]) -> None:
+    """
+    Same as read_chunks(), but the reading is done by the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    eof = loop.create_future()
+
+    def on_readable() -> None:
+        if eof.done():
+            return
+        try:
+            while True:
+                chunk = os.read(fd, READ_CHUNK_SIZE)
+                if not chunk:
+                    eof.set_result(None)
+                    return
+                on_chunk(chunk)
+        except BlockingIOError:
+            pass  # Wait for more.
+        except Exception as e:  # pylint: disable=broad-except
+            eof.set_exception(e)  # Including on_chunk()'s.
+
+    os.set_blocking(fd, False)
+    loop.add_reader(fd, on_readable)
+    try:
+        await eof
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+async def wait_inspectee_async(pid: int, timeout_ms: Optional[int]) -> Stats:
+    """
+    Same as wait_inspectee(), but waiting for the exit is done by the running
+    event loop with a pidfd (Linux 5.3+), or else by polling.
+    """
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd != None:
+        loop = asyncio.get_running_loop()
+        exited = loop.create_future()
+        loop.add_reader(
+            pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+    # The stdout EOF is usually seen when the child exits, so polling is rare.
+    while True:
+        waited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if waited_pid == pid:
+            return _make_stats(status, rusage, timeout_ms)
+        await asyncio.sleep(0.001)
+
+
+def get_spawn_failure_stats() -> Stats:
+    return {
+        "maxrss_kb": 0,
+        "exit": {
+            "type": "quit",  # The inspectee quit before it could run.
+            "repr": None,
+        },
+        "times_ms": {
+            "total": 0.0
+        },
+    }
+
+
+def _make_stats(status: int, rusage: Any, timeout_ms: Optional[int]) -> Stats:
+    total_ms = (rusage.ru_utime + rusage.ru_stime) * 1000.0
+    if timeout_ms and total_ms > timeout_ms:
+        # Killed by RLIMIT_CPU, or exited before the limit (which is rounded
+        # up to whole seconds) was reached; either way it timed out.
+        exit_stats = {"type": "timeout", "repr": timeout_ms}
+    elif os.WIFSIGNALED(status):
+        exit_stats = {"type": "signal", "repr": os.WTERMSIG(status)}
+    elif os.WIFEXITED(status):
+        exit_stats = {"type": "return", "repr": os.WEXITSTATUS(status)}
+    else:
+        exit_stats = {"type": "unknown", "repr": None}
+    return {
+        "maxrss_kb": rusage.ru_maxrss * _MAXRSS_UNIT_BYTES // 1024,
+        "exit": exit_stats,
+        "times_ms": {
+            "total": total_ms
+        },
+    }
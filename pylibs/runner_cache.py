@@ -0,0 +1,169 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Content-addressed cache of passing task results, so that tests whose inputs
+# are unchanged since they last passed need not be run again.
+#
+# The cache key of a test covers everything that may affect its result: the
+# bytes of the test executable, of the prefix binaries and of the timer, the
+# arguments, environment variables, timeout, expected exit and golden file
+# content, and the options that change how the result is recorded. Layout
+# under the cache directory:
+#   results/ab/abcdef...json    the result object, as in the master log
+#   stdout/ab/abcdef...stdout   the test's stdout, if it was written, not
+#                               compressed
+#   digests.json                the digests of the files hashed for the keys,
+#                               which are hashed again only if their size or
+#                               mtime change (see GoldenManifest)
+# Files are written to a temporary name then renamed, so several runners can
+# share the same cache directory.
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Optional
+
+from pylibs.runner_artifacts import copy_artifact
+from pylibs.runner_common import BUILTIN_TIMER, TaskMetadata, TaskResult
+from pylibs.runner_compress import open_maybe_compressed
+from pylibs.runner_golden import GoldenManifest
+
+CACHE_VERSION = 2
+
+
+class ResultCache:
+    """
+    run_options: the options that change the results, e.g. the stderr mode,
+    which are part of the keys.
+    """
+    def __init__(self, cache_dir: Path, timer: str,
+                 run_options: Dict[str, Any]):
+        self.cache_dir_ = cache_dir
+        self.run_options_ = run_options
+        self.lock_ = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.file_digests_ = GoldenManifest(cache_dir.joinpath("digests.json"))
+        # Key: program name, value: its path found in PATH.
+        self.program_paths_: Dict[str, str] = {}
+        self.timer_digest_ = (timer if timer == BUILTIN_TIMER else
+                              self._get_file_digest(timer))
+
+    def compute_key(self, metadata: TaskMetadata) -> str:
+        prefix_digests = []
+        for i, e in enumerate(metadata["prefix"]):
+            # The driver (e.g. an interpreter) is usually looked up in PATH.
+            path = e if (i > 0 or os.sep in e) else self._find_program(e)
+            prefix_digests.append(self._get_file_digest(path))
+        key_data = {
+            "version": CACHE_VERSION,
+            "timer": self.timer_digest_,
+            "hashed_id": metadata["hashed_id"],
+            "path": metadata["path"],
+            "program": self._get_file_digest(metadata["path"]),
+            "prefix": metadata["prefix"],
+            "prefix_programs": prefix_digests,
+            "args": metadata["args"],
+            "envs": metadata["envs"],
+            "timeout_ms": metadata["timeout_ms"],
+            "exit": metadata["exit"],
+            "golden": (self._get_file_digest(metadata["golden"])
+                       if metadata["golden"] else None),
+            "run_options": self.run_options_,
+        }
+        return hashlib.sha256(
+            json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def save_digests(self) -> None:
+        """
+        Records the digests of the files hashed so far, for later runs.
+        """
+        with self.lock_:
+            try:
+                self.file_digests_.save()
+            except OSError:
+                pass  # Only makes the next run hash the files again.
+
+    def lookup(self, key: str, metadata: TaskMetadata,
+               stdout_filename: str) -> Optional[TaskResult]:
+        """
+        Returns the cached result adapted to this run, or None if not cached.
+        The cached stdout, if any, is copied to stdout_filename, compressed
+        per its suffix, see runner_compress.
+        """
+        try:
+            with open(self._get_result_path(key), 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("version") != CACHE_VERSION:
+            return None
+        result: TaskResult = cached["result"]
+        if result["stdout"]["actual_file"] != None:
+            try:
+                os.makedirs(os.path.dirname(stdout_filename), exist_ok=True)
+                with open(self._get_stdout_path(key), 'rb') as src, \
+                     open_maybe_compressed(stdout_filename, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            except OSError:
+                return None
+            result["stdout"]["actual_file"] = stdout_filename
+        # Fields that are not part of the key, or describe this run.
+        now_ms = time.time() * 1000.0
+        result["times_ms"]["abs_start"] = now_ms
+        result["times_ms"]["abs_end"] = now_ms
+        result["repeat"] = copy.deepcopy(metadata["repeat"])
+        result["flaky_errors"] = copy.deepcopy(metadata["flaky_errors"])
+        result["cached"] = True
+        result["cpu"] = None
+        result["stderr_file"] = None  # The stderr is not cached.
+        result["packed"] = None  # The stdout is copied to stdout_filename.
+        return result
+
+    def store(self, key: str, result: TaskResult) -> None:
+        """
+        Only passing results should be stored.
+        """
+        assert result["ok"] == True
+        stdout_filename = result["stdout"]["actual_file"]
+        if stdout_filename != None:  # Store stdout first, see lookup().
+            ref = (result.get("packed") or {}).get("stdout")
+            self._write_atomically(
+                self._get_stdout_path(key),
+                lambda f: copy_artifact(stdout_filename, ref, f))
+        data = json.dumps({"version": CACHE_VERSION, "result": result})
+        self._write_atomically(self._get_result_path(key),
+                               lambda f: f.write(data.encode()))
+
+    def _get_result_path(self, key: str) -> Path:
+        return self.cache_dir_.joinpath("results", key[:2], key + ".json")
+
+    def _get_stdout_path(self, key: str) -> Path:
+        return self.cache_dir_.joinpath("stdout", key[:2], key + ".stdout")
+
+    def _get_file_digest(self, path: str) -> Optional[str]:
+        with self.lock_:
+            return self.file_digests_.get_digests([path]).get(path)
+
+    def _find_program(self, name: str) -> str:
+        with self.lock_:
+            if name not in self.program_paths_:
+                self.program_paths_[name] = shutil.which(name) or name
+            return self.program_paths_[name]
+
+    @staticmethod
+    def _write_atomically(path: Path, write: Callable[[BinaryIO], Any]) -> None:
+        os.makedirs(path.parent, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
@@ -0,0 +1,335 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Streaming stdout capture: the timer's stdout is read in fixed-size chunks and
+# written to the stdout file as it comes, so a worker holds no more than a few
+# chunks of it, however much the test prints.
+#
+# The output is processed as if the whole of it were read first:
+#   1. decoded as UTF-8, undecodable bytes escaped (backslashreplace),
+#   2. split at the delimiter, if any: the part before the first delimiter is
+#      the inspectee's stdout, the part between the first and the last
+#      delimiter is the timer's stats report,
+#   3. trailing whitespace removed (rstrip), then
+#   4. color sequences removed (see _ANSI_COLOR_REGEX).
+# Each step keeps the few characters that could change meaning with the next
+# chunk, e.g. a trailing "\x1b[3" which might turn out to be "\x1b[31m".
+#
+# If the test has a golden file, the written bytes are also compared with it
+# as they come (see GoldenMatcher), or, if the golden file's digest is known
+# from '--golden-manifest', their digest is compared with it, so that a passing
+# test's stdout is never read back; only if they differ is the diff computed
+# from the files.
+
+import asyncio
+import codecs
+import contextlib
+import hashlib
+import mmap
+import os
+import re
+import subprocess
+import tempfile
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Union
+
+from pylibs.runner_compress import open_maybe_compressed
+
+READ_CHUNK_SIZE = 1 << 16
+
+# Values of 'stderr_mode' in TaskWorkerArgs.
+STDERR_TO_NULL = "null"
+STDERR_TO_STDOUT = "stdout"  # '--also-stderr'
+STDERR_TO_FILE = "file"  # '--separate-stderr'
+
+_ANSI_COLOR_REGEX = re.compile(r"\x1b\[.*?m")
+# An unterminated color sequence longer than this is taken as plain text, so
+# that a stray "\x1b[" can't make the capture hold back the rest of the line.
+_MAX_ANSI_CARRY_CHARS = 1 << 12
+# Trailing whitespace held back beyond this is spilled to a temporary file.
+_MAX_HELD_WHITESPACE_CHARS = READ_CHUNK_SIZE
+# The stats report is small; a large one means the output is broken.
+_MAX_STATS_REPORT_CHARS = 1 << 20
+
+
+class CapturedOutput(NamedTuple):
+    filename: str  # The inspectee's processed stdout.
+    stats_report: Optional[str]  # None if the delimiter is not found.
+    truncated: bool  # Whether the stdout exceeded max_bytes.
+    # Whether the stdout file is byte-equal to the golden file, or None if
+    # there's no golden file to compare with. False doesn't mean there's a
+    # diff, as the golden file is read with universal newlines.
+    same_as_golden: Optional[bool]
+    sha256: str  # Of the stdout file.
+
+
+class GoldenMatcher:
+    """
+    Compares the bytes given by update() with the golden file's, which is
+    memory-mapped, until the first mismatch.
+    """
+    def __init__(self, golden_filename: str):
+        self.golden_: Optional[mmap.mmap] = None
+        self.size_ = 0
+        self.offset_ = 0
+        self.mismatched_ = False
+        try:
+            with open(golden_filename, 'rb') as f:
+                self.size_ = os.fstat(f.fileno()).st_size
+                if self.size_ > 0:  # Empty files can't be mapped.
+                    self.golden_ = mmap.mmap(f.fileno(),
+                                             0,
+                                             access=mmap.ACCESS_READ)
+        except OSError:
+            self.mismatched_ = True  # Not found, left to the diff.
+
+    def update(self, data: bytes) -> None:
+        if self.mismatched_:
+            return
+        end = self.offset_ + len(data)
+        if end > self.size_ or self.golden_[self.offset_:end] != data:
+            self.mismatched_ = True
+            self.close()
+        self.offset_ = end
+
+    def is_same(self) -> bool:
+        return not self.mismatched_ and self.offset_ == self.size_
+
+    def close(self) -> None:
+        if self.golden_ != None:
+            self.golden_.close()
+            self.golden_ = None
+
+
+class OutputCapture:
+    """
+    Writes the processed stdout to the file, in the 'with' block, compressed
+    per the file's suffix (see runner_compress). The stdout is fed by feed(),
+    and finish() is called at EOF. If max_bytes is given,
+    the stdout file is cut at that size, and the rest is discarded. If the
+    golden file is given, the stdout is compared with it, or with its digest
+    if given.
+    """
+    def __init__(self,
+                 filename: str,
+                 delimiter: Optional[str],
+                 max_bytes: Optional[int],
+                 golden_filename: Optional[str] = None,
+                 golden_sha256: Optional[str] = None):
+        self.filename_ = filename
+        self.delimiter_ = delimiter
+        self.max_bytes_ = max_bytes
+        self.file_: BinaryIO = open_maybe_compressed(filename, 'wb')
+        self.sha256_ = hashlib.sha256()
+        self.golden_sha256_ = golden_sha256
+        self.golden_matcher_ = None
+        if golden_filename != None and golden_sha256 == None:
+            self.golden_matcher_ = GoldenMatcher(golden_filename)
+        self.decoder_ = codecs.getincrementaldecoder("utf-8")(
+            errors="backslashreplace")
+        self.delimiter_carry_ = ""  # Might be the start of the delimiter.
+        self.stats_: Optional[List[str]] = None  # After the first delimiter.
+        self.stats_size_ = 0
+        self.held_whitespace_: List[str] = []  # Dropped if nothing follows.
+        self.held_whitespace_size_ = 0
+        self.held_whitespace_file_ = None  # Spilled held whitespace, if any.
+        self.ansi_carry_ = ""  # Might be the start of a color sequence.
+        self.written_size_ = 0
+        self.truncated_ = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close()
+
+    def feed(self, data: bytes) -> None:
+        self._feed_text(self.decoder_.decode(data))
+
+    def finish(self) -> CapturedOutput:
+        self._feed_text(self.decoder_.decode(b"", final=True))
+        if self.stats_ == None:
+            self._feed_inspectee(self.delimiter_carry_)
+        self._write(self.ansi_carry_)  # Never terminated.
+        self._close()
+        stats_report = None
+        if self.stats_ != None:
+            s = "".join(self.stats_)
+            report_end_index = s.rfind(self.delimiter_)
+            # Empty if there's only one delimiter.
+            stats_report = (s[:report_end_index].rstrip()
+                            if report_end_index != -1 else "")
+        sha256 = self.sha256_.hexdigest()
+        same_as_golden = None
+        if self.golden_sha256_ != None:
+            same_as_golden = sha256 == self.golden_sha256_
+        elif self.golden_matcher_:
+            same_as_golden = self.golden_matcher_.is_same()
+        return CapturedOutput(filename=self.filename_,
+                              stats_report=stats_report,
+                              truncated=self.truncated_,
+                              same_as_golden=same_as_golden,
+                              sha256=sha256)
+
+    def _close(self) -> None:
+        self.file_.close()
+        if self.golden_matcher_:
+            self.golden_matcher_.close()
+        if self.held_whitespace_file_:
+            self.held_whitespace_file_.close()
+            self.held_whitespace_file_ = None
+
+    def _feed_text(self, text: str) -> None:
+        if self.stats_ != None:
+            self._feed_stats(text)
+            return
+        if self.delimiter_ == None:
+            self._feed_inspectee(text)
+            return
+        text = self.delimiter_carry_ + text
+        begin_index = text.find(self.delimiter_)
+        if begin_index != -1:
+            self._feed_inspectee(text[:begin_index])
+            self.delimiter_carry_ = ""
+            self.stats_ = []
+            self._feed_stats(text[begin_index + len(self.delimiter_):])
+            return
+        carry_size = min(len(text), len(self.delimiter_) - 1)
+        self._feed_inspectee(text[:len(text) - carry_size])
+        self.delimiter_carry_ = text[len(text) - carry_size:]
+
+    def _feed_stats(self, text: str) -> None:
+        assert self.stats_ != None
+        self.stats_size_ += len(text)
+        if self.stats_size_ > _MAX_STATS_REPORT_CHARS:
+            raise RuntimeError("ctimer stats report too large")
+        self.stats_.append(text)
+
+    def _feed_inspectee(self, text: str) -> None:
+        # Trailing whitespace is held back until something else follows.
+        stripped = text.rstrip()
+        if not stripped:
+            self._hold_whitespace(text)
+            return
+        self._release_whitespace()
+        self._strip_ansi(stripped)
+        self._hold_whitespace(text[len(stripped):])
+
+    def _hold_whitespace(self, text: str) -> None:
+        if not text:
+            return
+        self.held_whitespace_.append(text)
+        self.held_whitespace_size_ += len(text)
+        if self.held_whitespace_size_ > _MAX_HELD_WHITESPACE_CHARS:
+            if not self.held_whitespace_file_:
+                self.held_whitespace_file_ = tempfile.TemporaryFile(
+                    'w+', encoding="utf-8", newline="")
+            self.held_whitespace_file_.write("".join(self.held_whitespace_))
+            self.held_whitespace_.clear()
+            self.held_whitespace_size_ = 0
+
+    def _release_whitespace(self) -> None:
+        if self.held_whitespace_file_:
+            self.held_whitespace_file_.seek(0)
+            for chunk in iter(
+                    lambda: self.held_whitespace_file_.read(READ_CHUNK_SIZE),
+                    ""):
+                self._strip_ansi(chunk)
+            self.held_whitespace_file_.close()
+            self.held_whitespace_file_ = None
+        self._strip_ansi("".join(self.held_whitespace_))
+        self.held_whitespace_.clear()
+        self.held_whitespace_size_ = 0
+
+    def _strip_ansi(self, text: str) -> None:
+        if not text:
+            return
+        text = self.ansi_carry_ + text
+        pieces, pos = [], 0
+        # A match is final: the regex takes the first "m" after "\x1b[".
+        for m in _ANSI_COLOR_REGEX.finditer(text):
+            pieces.append(text[pos:m.start()])
+            pos = m.end()
+        # The rest has no match, but a "\x1b" (or "\x1b[") on its last line
+        # might start one with more text.
+        carry_index = len(text)
+        line_start = text.rfind("\n", pos) + 1
+        i = text.find("\x1b", max(pos, line_start))
+        while i != -1:
+            if i + 1 == len(text) or text[i + 1] == "[":
+                carry_index = i
+                break
+            i = text.find("\x1b", i + 1)
+        if len(text) - carry_index > _MAX_ANSI_CARRY_CHARS:
+            carry_index = len(text)
+        pieces.append(text[pos:carry_index])
+        self.ansi_carry_ = text[carry_index:]
+        self._write("".join(pieces))
+
+    def _write(self, text: str) -> None:
+        if not text or self.truncated_:
+            return
+        data = text.encode()
+        if (self.max_bytes_ != None
+                and self.written_size_ + len(data) > self.max_bytes_):
+            # Cut at a character boundary.
+            data = data[:self.max_bytes_ - self.written_size_].decode(
+                errors="ignore").encode()
+            self.truncated_ = True
+        self.file_.write(data)
+        self.written_size_ += len(data)
+        self.sha256_.update(data)
+        if self.golden_matcher_:
+            self.golden_matcher_.update(data)
+
+
+def capture_fd(fd: int, capture: OutputCapture) -> None:
+    """
+    Feeds the capture with what's read from the file descriptor until EOF.
+    """
+    for chunk in iter(lambda: os.read(fd, READ_CHUNK_SIZE), b""):
+        capture.feed(chunk)
+
+
+async def capture_stream(stream: asyncio.StreamReader,
+                         capture: OutputCapture) -> None:
+    while True:
+        chunk = await stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        capture.feed(chunk)
+
+
+@contextlib.contextmanager
+def open_stderr_target(
+        stderr_mode: str,
+        stderr_filename: Optional[str]) -> Iterator[Union[int, BinaryIO]]:
+    """
+    Yields the 'stderr' argument for subprocess. With STDERR_TO_FILE, the stderr
+    is written to the file by the child itself, as is.
+    """
+    if stderr_mode == STDERR_TO_FILE:
+        assert stderr_filename
+        with open(stderr_filename, 'wb') as f:
+            yield f
+    elif stderr_mode == STDERR_TO_STDOUT:
+        yield subprocess.STDOUT
+    else:
+        yield subprocess.DEVNULL
+
+
+def is_same_content(golden_filename: str, captured_filename: str) -> bool:
+    """
+    Compares chunk by chunk, as the golden file's content used to be compared
+    with the stdout in memory: the golden file is read with universal newlines,
+    the captured stdout is read as is.
+    """
+    with open(golden_filename, 'r') as golden, open(captured_filename,
+                                                    'r',
+                                                    encoding="utf-8",
+                                                    newline="") as captured:
+        while True:
+            expected = golden.read(READ_CHUNK_SIZE)
+            if expected != captured.read(READ_CHUNK_SIZE):
+                return False
+            if not expected:
+                return True
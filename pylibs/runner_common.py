@@ -5,8 +5,9 @@ import argparse
 import multiprocessing
 import os
 import sys
+from collections.abc import Mapping
 from enum import Enum
-from typing import Any, Dict, OrderedDict, Tuple
+from typing import Any, Callable, Dict, Iterator, Optional, OrderedDict, Tuple
 
 from pylibs.score_utils import error_s
 
@@ -15,24 +16,62 @@ from pylibs.score_utils import error_s
 Args = argparse.Namespace
 TaskMetadata = Dict[str, Any]
 TaskResult = OrderedDict[str, Any]
-TaskWorkerArgs = Tuple[str, bool, str, bool, TaskMetadata]
+# Timer, timer stats mode, stderr mode (see runner_capture), max stdout bytes,
+# compression (see runner_compress, or None), diff context lines (None: whole
+# files), artifacts mode (see runner_artifacts), log directory, write golden,
+# metadata.
+TaskWorkerArgs = Tuple[str, str, str, Optional[int], Optional[str],
+                       Optional[int], str, str, bool, TaskMetadata]
+ResultCallback = Callable[[int, TaskResult], None]  # Index, result.
+
+
+class TaskSpec(Mapping):
+    """
+    A task, i.e. a repeat of a test, read like a metadata dict with "repeat":
+    the test's metadata dict is shared by its repeats, and so is the "repeat"
+    dict by the tasks of the same repeat count, instead of each task having a
+    copy. They are not modified, except for fields of the test set before
+    the run (e.g. "golden_sha256"), which are set in the metadata dict. To be
+    serialized, it's converted with dict().
+    """
+    __slots__ = ("metadata", "repeat")
+
+    def __init__(self, metadata: TaskMetadata, repeat: Dict[str, int]):
+        self.metadata = metadata
+        self.repeat = repeat
+
+    def __getitem__(self, key: str) -> Any:
+        return self.repeat if key == "repeat" else self.metadata[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from (k for k in self.metadata if k != "repeat")
+        yield "repeat"
+
+    def __len__(self) -> int:
+        return len(self.metadata) + (0 if "repeat" in self.metadata else 1)
 
 # Constants.
 
 LOG_FILE_BASE = "log.json"
+STREAM_LOG_FILE_BASE = "log.jsonl"
 DELIMITER_STR = "#####"
+BUILTIN_TIMER = "builtin"  # '--timer builtin', see runner_builtin_timer.
 GOLDEN_NOT_WRITTEN_PREFIX = "golden file not written"
 
 
 class TaskExceptions(Enum):
     GOLDEN_NOT_WRITTEN_SAME_CONTENT = "%s: content is the same" % GOLDEN_NOT_WRITTEN_PREFIX
     GOLDEN_NOT_WRITTEN_WRONG_EXIT = "%s: the test's exit is not as expected" % GOLDEN_NOT_WRITTEN_PREFIX
+    GOLDEN_NOT_WRITTEN_TRUNCATED = "%s: stdout truncated by '--max-output-bytes'" % GOLDEN_NOT_WRITTEN_PREFIX
     GOLDEN_FILE_MISSING = "golden file missing"
+    STDOUT_TRUNCATED = "stdout truncated: exceeded '--max-output-bytes'"
+    TASK_SKIPPED = "task skipped: the run was stopped by '--max-failures'"
 
 
 class TaskEnvKeys(Enum):
     CTIMER_DELIMITER_ENVKEY = "CTIMER_DELIMITER"
     CTIMER_TIMEOUT_ENVKEY = "CTIMER_TIMEOUT"
+    CTIMER_STATS_ENVKEY = "CTIMER_STATS"
 
 
 def get_num_workers(env_var: str) -> int:
@@ -0,0 +1,181 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# CPU pinning for '--pin-cpus': each worker slot is given a dedicated CPU, and
+# the timers it spawns (with their tests) are confined to that CPU, so that
+# the processor time measurements are not disturbed by migrations and by SMT
+# siblings. The runner's own threads are not confined, so the capture, the
+# golden file check and the diff of one task don't run on the CPU of another
+# task's test. Linux only.
+
+import contextlib
+import contextvars
+import math
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# The CPU of the worker slot running in the current thread or asyncio task.
+PINNED_CPU = contextvars.ContextVar(
+    "PINNED_CPU", default=None)  # type: contextvars.ContextVar[Optional[int]]
+
+_SYSFS_CPU_DIR = Path("/sys/devices/system/cpu")
+_CGROUP_DIR = Path("/sys/fs/cgroup")
+_PROC_SELF_CGROUP = Path("/proc/self/cgroup")
+
+
+def is_cpu_pinning_supported() -> bool:
+    return hasattr(os, "sched_setaffinity")
+
+
+def parse_cpu_list(spec: str) -> List[int]:
+    """
+    Parses lists like "0-3,8,10-11". Raises ValueError.
+    """
+    cpus: List[int] = []
+    for part in spec.split(","):
+        m = re.fullmatch(r"(\d+)(?:-(\d+))?", part.strip())
+        if not m:
+            raise ValueError("CPU list should be like '0-3,8', but found '%s'" %
+                             spec)
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) else first
+        cpus.extend(e for e in range(first, last + 1) if e not in cpus)
+    return cpus
+
+
+def _read_sysfs_int(path: Path) -> Optional[int]:
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _get_own_cgroup_paths() -> Dict[str, str]:
+    # Maps the cgroup v1 controller (e.g. "cpu"), or "" for cgroup v2, to the
+    # path of this process's cgroup, relative to the hierarchy's root.
+    paths: Dict[str, str] = {}
+    try:
+        lines = _PROC_SELF_CGROUP.read_text().splitlines()
+    except OSError:
+        return paths
+    for line in lines:
+        fields = line.split(":", 2)  # "$ID:$CONTROLLERS:$PATH"
+        if len(fields) != 3:
+            continue
+        for controller in fields[1].split(","):
+            paths[controller] = fields[2].lstrip("/")
+    return paths
+
+
+def _iter_cgroup_dirs(root: Path, path: Optional[str]) -> Iterator[Path]:
+    # This process's cgroup and its ancestors up to the root, as a quota of
+    # any of them applies; the root alone if the path is unknown, or is not
+    # visible in this mount (e.g. in a container without a cgroup namespace).
+    if path:
+        own_dir = root.joinpath(path)
+        if own_dir.is_dir():
+            yield own_dir
+            yield from (e for e in own_dir.parents
+                        if e != root and root in e.parents)
+    yield root
+
+
+def _read_cgroup_v2_quota(cgroup_dir: Path) -> Optional[float]:
+    # "$MAX $PERIOD" in cpu.max, where $MAX may be "max".
+    try:
+        fields = cgroup_dir.joinpath("cpu.max").read_text().split()
+        if fields[0] == "max":
+            return None
+        return _get_quota_in_cpus(int(fields[0]), int(fields[1]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _read_cgroup_v1_quota(cgroup_dir: Path) -> Optional[float]:
+    return _get_quota_in_cpus(
+        _read_sysfs_int(cgroup_dir.joinpath("cpu.cfs_quota_us")),
+        _read_sysfs_int(cgroup_dir.joinpath("cpu.cfs_period_us")))
+
+
+def _get_quota_in_cpus(quota: Optional[int],
+                       period: Optional[int]) -> Optional[float]:
+    if quota == None or period == None or quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def _get_cgroup_cpu_limit() -> Optional[int]:
+    # The CPU quota of this process's cgroup, rounded down to whole CPUs (at
+    # least 1), or None if there is no quota. In a container, the quota is
+    # usually set on the container's cgroup, not on the root.
+    own_paths = _get_own_cgroup_paths()
+    if _CGROUP_DIR.joinpath("cgroup.controllers").is_file():  # cgroup v2
+        quotas = [
+            _read_cgroup_v2_quota(e)
+            for e in _iter_cgroup_dirs(_CGROUP_DIR, own_paths.get(""))
+        ]
+    else:  # cgroup v1
+        quotas = [
+            _read_cgroup_v1_quota(e) for e in _iter_cgroup_dirs(
+                _CGROUP_DIR.joinpath("cpu"), own_paths.get("cpu"))
+        ]
+    known_quotas = [e for e in quotas if e != None]
+    if not known_quotas:
+        return None
+    return max(1, math.floor(min(known_quotas)))
+
+
+def _get_one_cpu_per_core(cpus: List[int]) -> List[int]:
+    # Keeps the first logical CPU of each physical core, so that no two slots
+    # are SMT siblings, unless the topology is unknown.
+    seen_cores: Dict[Tuple[int, int], int] = {}
+    for cpu in cpus:
+        topology_dir = _SYSFS_CPU_DIR.joinpath("cpu%d" % cpu, "topology")
+        package_id = _read_sysfs_int(
+            topology_dir.joinpath("physical_package_id"))
+        core_id = _read_sysfs_int(topology_dir.joinpath("core_id"))
+        if package_id == None or core_id == None:
+            return cpus
+        seen_cores.setdefault((package_id, core_id), cpu)
+    return sorted(seen_cores.values())
+
+
+def select_cpus(spec: Optional[str]) -> List[int]:
+    """
+    Returns the CPUs to pin the worker slots to: the CPUs in the spec, or one
+    per physical core if the spec is None, among the CPUs this process is
+    allowed to run on, and no more than the cgroup's CPU quota. Raises
+    ValueError.
+    """
+    allowed = sorted(os.sched_getaffinity(0))
+    if spec != None:
+        cpus = [e for e in parse_cpu_list(spec) if e in allowed]
+        if not cpus:
+            raise ValueError(
+                "none of CPUs '%s' is allowed for this process (allowed: %s)" %
+                (spec, ",".join(map(str, allowed))))
+    else:
+        cpus = _get_one_cpu_per_core(allowed)
+    limit = _get_cgroup_cpu_limit()
+    return cpus[:limit] if limit != None else cpus
+
+
+@contextlib.contextmanager
+def pinned_for_spawn(cpu: Optional[int]) -> Iterator[None]:
+    """
+    Processes spawned by the calling thread in the 'with' block are confined to
+    the CPU, if not None. The calling thread itself is confined only in the
+    block, so the work it does for the task after the spawn (reading the
+    stdout, diffing, ...) doesn't compete with the test for the CPU.
+    """
+    if cpu == None:
+        yield
+        return
+    saved = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, {cpu})  # On Linux, 0 is the calling thread.
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, saved)
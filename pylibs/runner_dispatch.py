@@ -0,0 +1,323 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# The task queue shared by whatever runs the tasks: worker threads, the asyncio
+# engine's coroutines, and remote worker processes served by the coordinator.
+# A task is identified by its index into the list of tasks to dispatch.
+
+import collections
+import math
+import threading
+from enum import Enum
+from typing import (Callable, Deque, Dict, Iterable, List, Optional, Set,
+                    Tuple, Union)
+
+from pylibs.runner_common import ResultCallback, TaskResult
+
+# Max times a task is put back to the queue after its worker was lost, before
+# it is considered to be the cause.
+MAX_REQUEUE_COUNT = 3
+# Max tasks taken ahead of the first task in a CostQueue, before no other task
+# is taken until it fits.
+MAX_BYPASS_COUNT = 64
+
+
+class TakeStatus(Enum):
+    READY = 1  # A task is taken.
+    WAIT = 2  # No task is available now, but there may be one later.
+    DONE = 3  # All tasks are finished, or the run is aborted or stopped.
+
+
+class CostQueue:
+    """
+    Not thread-safe: a queue of tasks with costs, which takes the first task,
+    in the order of the queue, that fits in a given budget. Tasks are grouped
+    in classes of costs within 9% of each other, and only the first task of
+    each class is considered, so a task is taken in time proportional to the
+    number of classes, instead of the queue's length.
+    Once the first task in the queue is passed over by MAX_BYPASS_COUNT tasks,
+    no other task is taken until it fits, so a large task is not starved by a
+    stream of smaller ones.
+    """
+    def __init__(self, costs: List[float]):
+        self.costs_ = costs
+        # Key: cost class, value: non-empty queue of (sequence number, task).
+        self.classes_: Dict[int, Deque[Tuple[int, int]]] = {}
+        self.first_seq_ = 0
+        self.next_seq_ = 0
+        self.size_ = 0
+        self.bypassed_index_: Optional[int] = None
+        self.bypass_count_ = 0
+
+    def __len__(self) -> int:
+        return self.size_
+
+    def append(self, index: int) -> None:
+        self._get_class(index).append((self.next_seq_, index))
+        self.next_seq_ += 1
+        self.size_ += 1
+
+    def appendleft(self, index: int) -> None:
+        self.first_seq_ -= 1
+        self._get_class(index).appendleft((self.first_seq_, index))
+        self.size_ += 1
+
+    def take(self, available: float) -> Optional[int]:
+        """
+        Removes and returns the first task whose cost is within available, or
+        returns None if there is none, or if the first task should be waited
+        for.
+        """
+        first, fit = None, None
+        for queue in self.classes_.values():
+            head = queue[0]
+            if first == None or head < first:
+                first = head
+            if self.costs_[head[1]] <= available and (fit == None
+                                                      or head < fit):
+                fit = head
+        if fit == None:
+            return None
+        if fit != first:
+            if self.bypassed_index_ != first[1]:
+                self.bypassed_index_, self.bypass_count_ = first[1], 0
+            if self.bypass_count_ == MAX_BYPASS_COUNT:
+                return None
+            self.bypass_count_ += 1
+        key = self._get_class_key(fit[1])
+        self.classes_[key].popleft()
+        if not self.classes_[key]:
+            del self.classes_[key]
+        self.size_ -= 1
+        return fit[1]
+
+    def _get_class_key(self, index: int) -> int:
+        return int(8 * math.log2(1 + self.costs_[index]))  # 8 per doubling.
+
+    def _get_class(self, index: int) -> Deque[Tuple[int, int]]:
+        key = self._get_class_key(index)
+        if key not in self.classes_:
+            self.classes_[key] = collections.deque()
+        return self.classes_[key]
+
+
+class Dispatcher:
+    """
+    Thread-safe. on_result() is called in the thread that finishes a task, but
+    never concurrently with itself. Tasks in held_indexes are not dispatched
+    until they are released by release(), or dropped by drop().
+    If costs and budget are given, a task is dispatched only if its cost, plus
+    that of the tasks in flight, is within the budget; such a task is taken by
+    CostQueue. A task over the budget is taken if no task is in flight.
+    If open_ended, more tasks may be added by add_tasks(), until end_tasks() is
+    called; this is not supported with held tasks or costs.
+    """
+    def __init__(self,
+                 num_tasks: int,
+                 on_result: ResultCallback,
+                 held_indexes: Iterable[int] = (),
+                 costs: Optional[List[float]] = None,
+                 budget: Optional[float] = None,
+                 open_ended: bool = False):
+        assert not (open_ended and (held_indexes or costs))
+        self.num_tasks_ = num_tasks
+        self.open_ended_ = open_ended
+        self.on_result_ = on_result
+        self.cond_ = threading.Condition()
+        self.result_lock_ = threading.Lock()  # Serializes on_result().
+        self.held_: Set[int] = set(held_indexes)
+        self.costs_ = costs if budget != None else None
+        self.pending_: Union[Deque[int], CostQueue] = collections.deque(
+        ) if self.costs_ == None else CostQueue(self.costs_)
+        for i in range(num_tasks):
+            if i not in self.held_:
+                self.pending_.append(i)
+        self.in_flight_: Set[int] = set()
+        self.budget_ = budget
+        self.in_flight_cost_ = 0.0
+        self.requeue_counts_ = [0] * num_tasks
+        self.finished_count_ = 0
+        self.finished_ = [False] * num_tasks
+        self.stopped_ = False
+        self.error_: Optional[BaseException] = None
+        self.listeners_: List[Callable[[], None]] = []
+
+    def subscribe(self, listener: Callable[[], None]) -> None:
+        """
+        listener() is called, in any thread, whenever a task may have become
+        available or the run may have ended.
+        """
+        with self.cond_:
+            self.listeners_.append(listener)
+
+    def add_tasks(self, count: int) -> bool:
+        """
+        Appends tasks to the queue, indexed after the existing ones. Returns
+        False if the run is already over, i.e. the tasks will not be run.
+        """
+        with self.cond_:
+            assert self.open_ended_
+            if self.error_ != None or self.stopped_:
+                return False
+            self.pending_.extend(
+                range(self.num_tasks_, self.num_tasks_ + count))
+            self.num_tasks_ += count
+            self.requeue_counts_.extend([0] * count)
+            self.finished_.extend([False] * count)
+            self._notify()
+            return True
+
+    def end_tasks(self) -> None:
+        """
+        Declares that no more tasks will be added.
+        """
+        with self.cond_:
+            self.open_ended_ = False
+            self._notify()
+
+    def try_take(self) -> Tuple[TakeStatus, int]:
+        with self.cond_:
+            if self.error_ != None or self.stopped_ or self._all_finished():
+                return TakeStatus.DONE, -1
+            if not self.pending_:
+                return TakeStatus.WAIT, -1
+            if self.costs_ == None:
+                index = self.pending_.popleft()
+            else:
+                index = self._take_within_budget()
+                if index == None:
+                    return TakeStatus.WAIT, -1
+            self._add_in_flight(index)
+            return TakeStatus.READY, index
+
+    def take(self) -> Optional[int]:
+        """
+        Blocks until a task is taken, or returns None if there will be none.
+        """
+        with self.cond_:
+            while True:
+                status, index = self.try_take()
+                if status == TakeStatus.READY:
+                    return index
+                if status == TakeStatus.DONE:
+                    return None
+                self.cond_.wait()
+
+    def finish(self, index: int, result: TaskResult) -> None:
+        with self.result_lock_:
+            with self.cond_:
+                if self.stopped_:
+                    return  # The task is left unfinished.
+                if index not in self.in_flight_:
+                    return  # Finished by another worker after a requeue.
+                self._remove_in_flight(index)
+            self.on_result_(index, result)
+            with self.cond_:
+                self.finished_count_ += 1
+                self.finished_[index] = True
+                self._notify()
+
+    def requeue(self, index: int) -> None:
+        """
+        Puts a taken task back to the queue, as its worker is lost.
+        """
+        with self.cond_:
+            if index not in self.in_flight_:
+                return
+            self._remove_in_flight(index)
+            self.requeue_counts_[index] += 1
+            if self.requeue_counts_[index] > MAX_REQUEUE_COUNT:
+                self.error_ = RuntimeError(
+                    "task %d is re-queued too many times, as the workers "
+                    "running it were lost" % index)
+            else:
+                self.pending_.appendleft(index)
+            self._notify()
+
+    def release(self, indexes: Iterable[int]) -> None:
+        """
+        Puts held tasks to the end of the queue. It may be called by
+        on_result().
+        """
+        with self.cond_:
+            for index in indexes:
+                self.held_.remove(index)
+                self.pending_.append(index)
+            self._notify()
+
+    def drop(self, indexes: Iterable[int]) -> None:
+        """
+        Considers held tasks finished without running them, and without calling
+        on_result(). It may be called by on_result().
+        """
+        with self.cond_:
+            for index in indexes:
+                self.held_.remove(index)
+                self.finished_count_ += 1
+                self.finished_[index] = True
+            self._notify()
+
+    def fail(self, error: BaseException) -> None:
+        """
+        Aborts the run; wait() will raise the error.
+        """
+        with self.cond_:
+            if self.stopped_:
+                return  # Likely caused by the task being killed after stop().
+            if self.error_ == None:
+                self.error_ = error
+            self._notify()
+
+    def stop(self) -> None:
+        """
+        Stops dispatching tasks; wait() returns without waiting for the running
+        tasks, whose results are then discarded. It may be called by
+        on_result().
+        """
+        with self.cond_:
+            self.stopped_ = True
+            self._notify()
+
+    def get_unfinished_indexes(self) -> List[int]:
+        """
+        Returns the tasks whose results are not passed to on_result(), except
+        the dropped ones.
+        """
+        with self.result_lock_:
+            with self.cond_:
+                return [i for i, e in enumerate(self.finished_) if not e]
+
+    def wait(self) -> None:
+        """
+        Blocks until all tasks are finished or the run is stopped, or raises the
+        error that aborted the run.
+        """
+        with self.cond_:
+            while (self.error_ == None and not self.stopped_
+                   and not self._all_finished()):
+                self.cond_.wait()
+            if self.error_ != None:
+                raise self.error_
+
+    def _take_within_budget(self) -> Optional[int]:
+        return self.pending_.take(self.budget_ - self.in_flight_cost_
+                                  if self.in_flight_ else float("inf"))
+
+    def _add_in_flight(self, index: int) -> None:
+        self.in_flight_.add(index)
+        if self.costs_ != None:
+            self.in_flight_cost_ += self.costs_[index]
+
+    def _remove_in_flight(self, index: int) -> None:
+        self.in_flight_.remove(index)
+        if self.costs_ != None:
+            self.in_flight_cost_ -= self.costs_[index]
+
+    def _all_finished(self) -> bool:
+        return (not self.open_ended_
+                and self.finished_count_ == self.num_tasks_)
+
+    def _notify(self) -> None:
+        self.cond_.notify_all()
+        for listener in self.listeners_:
+            listener()
@@ -0,0 +1,108 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Golden file manifest for '--golden-manifest': the SHA-256 digest of each
+# golden file, with the size and mtime it was computed at. Before a run, each
+# golden file is stat'ed, and hashed again only if it has changed; a test whose
+# stdout has the golden file's digest then passes without the golden file
+# being opened.
+#
+# Like Git's index, a file modified within the mtime granularity of the time it
+# was hashed could be modified again without its mtime changing, so such a
+# file's digest is not recorded, and it's hashed again next time.
+
+import hashlib
+import json
+import os
+import stat
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+GOLDEN_MANIFEST_VERSION = 1
+
+_READ_CHUNK_SIZE = 1 << 20
+# Wider than the mtime granularity of common file systems.
+_RACY_MTIME_NS = 2 * 1000 * 1000 * 1000
+
+
+def get_file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class GoldenManifest:
+    """
+    Not thread-safe: used before and after the tasks are run.
+    """
+    def __init__(self, path: Path):
+        self.path_ = path
+        # Key: abs path, value: dict with keys "size", "mtime_ns", "sha256".
+        self.entries_: Dict[str, Dict] = {}
+        self.changed_ = False
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data["version"] == GOLDEN_MANIFEST_VERSION:
+                self.entries_ = data["goldens"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # Missing or corrupted: rebuilt as the goldens are hashed.
+
+    def get_digests(self, golden_filenames: Iterable[str]) -> Dict[str, str]:
+        """
+        Returns the digests of the golden files that exist, keyed by the given
+        paths. Only new or changed files are read.
+        """
+        digests = {}
+        for filename in set(golden_filenames):
+            digest = self._refresh(os.path.abspath(filename))
+            if digest != None:
+                digests[filename] = digest
+        return digests
+
+    def save(self) -> None:
+        """
+        Writes the file atomically, if changed.
+        """
+        if not self.changed_:
+            return
+        temp_path = self.path_.with_name(self.path_.name +
+                                         ".tmp%d" % os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(
+                {
+                    "version": GOLDEN_MANIFEST_VERSION,
+                    "goldens": self.entries_
+                },
+                f,
+                separators=(",", ":"))
+        os.replace(temp_path, self.path_)
+        self.changed_ = False
+
+    def _refresh(self, abs_path: str) -> Optional[str]:
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            st = None
+        if st == None or not stat.S_ISREG(st.st_mode):
+            if self.entries_.pop(abs_path, None) != None:
+                self.changed_ = True
+            return None
+        entry = self.entries_.get(abs_path)
+        if (entry != None and entry["size"] == st.st_size
+                and entry["mtime_ns"] == st.st_mtime_ns):
+            return entry["sha256"]
+        digest = get_file_sha256(abs_path)
+        if time.time_ns() - st.st_mtime_ns > _RACY_MTIME_NS:
+            self.entries_[abs_path] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "sha256": digest,
+            }
+            self.changed_ = True
+        elif self.entries_.pop(abs_path, None) != None:
+            self.changed_ = True
+        return digest
@@ -0,0 +1,142 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Tests' historical run times, used to dispatch the tasks expected to take the
+# longest first (LPT), so that a long test doesn't start last and set the wall
+# time of the whole run.
+#
+# The history is read from either a history file written by this module, or a
+# master log written by a previous run.
+
+import heapq
+import json
+import os
+import statistics
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pylibs.runner_common import TaskMetadata, TaskResult
+from pylibs.runner_task_res import is_skipped_result
+
+HISTORY_FILE_VERSION = 1
+# Weight of the latest run when it's merged into the history.
+_NEW_RUN_WEIGHT = 0.5
+
+# Key: hashed_id, value: dict with keys "wall_ms", "proc_ms", "maxrss_kb" and
+# "runs" (the number of runs merged into the record).
+History = Dict[str, Dict[str, float]]
+
+
+def _get_record_from_result(result: TaskResult) -> Dict[str, float]:
+    times = result["times_ms"]
+    return {
+        "wall_ms": times["abs_end"] - times["abs_start"],
+        "proc_ms": times["proc"],
+        "maxrss_kb": result["maxrss_kb"],
+        "runs": 1,
+    }
+
+
+def _merge_record(old: Optional[Dict[str, float]],
+                  new: Dict[str, float]) -> Dict[str, float]:
+    if old == None:
+        return new
+    merged = dict((k, old[k] * (1 - _NEW_RUN_WEIGHT) + v * _NEW_RUN_WEIGHT)
+                  for k, v in new.items() if k != "runs")
+    merged["runs"] = old["runs"] + new["runs"]
+    return merged
+
+
+def _make_history_from_results(results: Iterable[TaskResult],
+                               history: Optional[History] = None) -> History:
+    # Repeats of one test in the same run are averaged before being merged.
+    this_run: Dict[str, List[Dict[str, float]]] = {}
+    for result in results:
+        if result.get("cached") or is_skipped_result(result):
+            continue  # Not run, so the times aren't measured.
+        this_run.setdefault(result["hashed_id"],
+                            []).append(_get_record_from_result(result))
+    history = dict(history) if history else {}
+    for hashed_id, records in this_run.items():
+        averaged = dict((k, statistics.mean(e[k] for e in records))
+                        for k in ("wall_ms", "proc_ms", "maxrss_kb"))
+        averaged["runs"] = 1
+        history[hashed_id] = _merge_record(history.get(hashed_id), averaged)
+    return history
+
+
+def load_history(path: Path) -> Tuple[History, bool]:
+    """
+    Returns the history, and whether it's read from a master log (which should
+    not be overwritten with a history file). Returns an empty history if the
+    file doesn't exist. Raises ValueError if the file is neither a history file
+    nor a master log.
+    """
+    if not path.is_file():
+        return {}, False
+    with open(path, 'r') as f:
+        data = json.load(f)
+    try:
+        if isinstance(data, list):  # Master log.
+            return _make_history_from_results(data), True
+        if data["version"] != HISTORY_FILE_VERSION:
+            raise ValueError("unsupported history file version: %s" %
+                             data["version"])
+        return data["tests"], False
+    except (KeyError, TypeError) as e:
+        raise ValueError("corrupted history file %s: %s" % (path, e))
+
+
+def update_history_file(path: Path, history: History,
+                        results: Iterable[TaskResult]) -> None:
+    """
+    Merges the results of this run into the history, and writes the file
+    atomically. Results from the result cache, or of skipped tasks, are not
+    merged.
+    """
+    history = _make_history_from_results(results, history)
+    temp_path = path.with_name(path.name + ".tmp%d" % os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump({"version": HISTORY_FILE_VERSION, "tests": history},
+                  f,
+                  separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def get_expected_times_ms(metadata_list: List[TaskMetadata],
+                          history: History) -> List[float]:
+    """
+    Returns the expected wall time of each task. Tests not found in the history
+    are expected to take the median time of the tests that are found, or 0 if
+    none is found.
+    """
+    known = [
+        history[m["hashed_id"]]["wall_ms"] for m in metadata_list
+        if m["hashed_id"] in history
+    ]
+    default_time = statistics.median(known) if known else 0
+    return [
+        history[m["hashed_id"]]["wall_ms"]
+        if m["hashed_id"] in history else default_time for m in metadata_list
+    ]
+
+
+def get_longest_first_order(expected_times: List[float],
+                            indexes: List[int]) -> List[int]:
+    """
+    Returns the indexes in the order to dispatch. The sorting is stable, so the
+    order of tasks with the same expected time is kept.
+    """
+    return sorted(indexes, key=lambda i: expected_times[i], reverse=True)
+
+
+def predict_makespan_ms(expected_times_in_order: Iterable[float],
+                        num_workers: int) -> float:
+    """
+    Simulates dispatching the tasks in the given order to the workers, each
+    task going to the worker that becomes free first.
+    """
+    worker_end_times = [0.0] * num_workers
+    for t in expected_times_in_order:
+        heapq.heapreplace(worker_end_times, worker_end_times[0] + t)
+    return max(worker_end_times)
@@ -0,0 +1,146 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Streaming master log: each task result is appended to a JSON-lines file as
+# soon as the task finishes, so that an interrupted run keeps the results of
+# finished tasks, and the runner need not hold all results in memory.
+#
+# Files under the log directory:
+#   log.jsonl      one compact JSON result object per line, in the order the
+#                  tasks finished (not the order they were given)
+#   log.jsonl.idx  fixed-size binary records (task index, byte offset, byte
+#                  length), one per line in log.jsonl, so that a tool can seek
+#                  to any task without parsing the lines before it
+# The sorted master log log.json is built from these two files.
+
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+# Little-endian: task index, offset, length.
+_INDEX_RECORD = struct.Struct("<QQQ")
+_FSYNC_INTERVAL_SEC = 1.0
+
+IndexRecord = Tuple[int, int, int]
+
+
+def get_index_path(stream_log_path: Path) -> Path:
+    return stream_log_path.with_name(stream_log_path.name + ".idx")
+
+
+class StreamLogWriter:
+    """
+    Appends task results to the JSON-lines log and its offset index. The data
+    is flushed and fsync'ed at most every _FSYNC_INTERVAL_SEC seconds, and when
+    the writer is closed. It can be used concurrently.
+    """
+    def __init__(self, stream_log_path: Path):
+        self.lock_ = threading.Lock()
+        self.log_f_ = open(stream_log_path, 'wb')
+        self.index_f_ = open(get_index_path(stream_log_path), 'wb')
+        self.offset_ = 0
+        self.last_sync_time_ = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, task_index: int, result: Dict[str, Any]) -> None:
+        line = (json.dumps(result, separators=(",", ":")) + "\n").encode()
+        with self.lock_:
+            # Write the line before its index record, so that an index record
+            # never points to data that isn't there.
+            self.log_f_.write(line)
+            self.index_f_.write(
+                _INDEX_RECORD.pack(task_index, self.offset_, len(line)))
+            self.offset_ += len(line)
+            if time.monotonic() - self.last_sync_time_ >= _FSYNC_INTERVAL_SEC:
+                self._sync()
+
+    def close(self) -> None:
+        with self.lock_:
+            if self.log_f_.closed:
+                return
+            self._sync()
+            self.log_f_.close()
+            self.index_f_.close()
+
+    def _sync(self) -> None:
+        for f in (self.log_f_, self.index_f_):
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_sync_time_ = time.monotonic()
+
+
+def read_index(stream_log_path: Path) -> List[IndexRecord]:
+    """
+    Returns the index records in the order they were written. A trailing
+    partial record, left by an interrupted run, is ignored.
+    """
+    with open(get_index_path(stream_log_path), 'rb') as f:
+        data = f.read()
+    usable_size = len(data) - len(data) % _INDEX_RECORD.size
+    return list(_INDEX_RECORD.iter_unpack(data[:usable_size]))
+
+
+def read_entry(stream_log_f, record: IndexRecord) -> Dict[str, Any]:
+    """
+    stream_log_f: the JSON-lines log opened in binary mode.
+    """
+    _, offset, length = record
+    stream_log_f.seek(offset)
+    return json.loads(stream_log_f.read(length))
+
+
+def iter_sorted_entries(stream_log_path: Path) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the result objects sorted by task index, i.e. the order in which the
+    tasks were given. Only the index is held in memory.
+    """
+    records = sorted(read_index(stream_log_path))
+    with open(stream_log_path, 'rb') as f:
+        for record in records:
+            yield read_entry(f, record)
+
+
+def write_master_log_from_stream(stream_log_path: Path,
+                                 master_log_path: Path) -> None:
+    """
+    Writes the master log from the streaming log.
+    """
+    write_master_log(iter_sorted_entries(stream_log_path), master_log_path)
+
+
+def write_master_log(entries: Iterable[Dict[str, Any]],
+                     master_log_path: Path) -> None:
+    """
+    Writes the master log byte-for-byte the same as json.dump(list(entries),
+    f, indent=2, separators=(",", ": ")), one entry at a time.
+    """
+    with open(master_log_path, 'w') as f:
+        is_first = True
+        for entry in entries:
+            f.write("[\n  " if is_first else ",\n  ")
+            f.write(
+                json.dumps(entry, indent=2,
+                           separators=(",", ": ")).replace("\n", "\n  "))
+            is_first = False
+        f.write("[]" if is_first else "\n]")
+
+
+def main():  # Rebuild log.json, e.g. after an interrupted run.
+    if len(sys.argv) != 3:
+        sys.exit("usage: %s STREAM_LOG MASTER_LOG" % sys.argv[0])
+    write_master_log_from_stream(Path(sys.argv[1]), Path(sys.argv[2]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
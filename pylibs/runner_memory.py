@@ -0,0 +1,114 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Memory budget: with '--mem-budget', a task is started only if the expected
+# peak RSS of the running tasks, plus its own, fits in the budget, so that
+# memory-hungry tests are queued instead of pushing the machine into swap.
+#
+# A test's expected peak RSS is the "max_rss_kb" field in its metadata, or its
+# "maxrss_kb" in the history; tests with neither are expected to take the
+# median of the known tests.
+
+import heapq
+import re
+import statistics
+from typing import Iterable, List, NamedTuple, Optional
+
+from pylibs.runner_common import TaskMetadata, TaskResult
+from pylibs.runner_dispatch import CostQueue
+from pylibs.runner_history import History
+from pylibs.runner_task_res import is_skipped_result
+
+_MEM_SIZE_UNITS_KB = {"K": 1, "M": 1 << 10, "G": 1 << 20, "T": 1 << 30}
+
+
+class Concurrency(NamedTuple):
+    average: float  # Sum of the tasks' wall times, divided by the makespan.
+    peak: int  # Max number of tasks running at the same time.
+    peak_rss_kb: float  # Max sum of the peak RSS of the running tasks.
+
+
+def parse_mem_size_kb(spec: str) -> int:
+    """
+    Parses sizes like "48G", "512M" or "1048576K" (binary units; bare numbers
+    are in KiB) into KiB. Raises ValueError.
+    """
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)(?:i?B)?", spec.strip(),
+                     re.IGNORECASE)
+    if not m or float(m.group(1)) <= 0:
+        raise ValueError("memory size should be like '48G', but found '%s'" %
+                         spec)
+    return int(
+        float(m.group(1)) * _MEM_SIZE_UNITS_KB[(m.group(2) or "K").upper()])
+
+
+def get_expected_rss_kb(metadata_list: List[TaskMetadata],
+                        history: History) -> List[float]:
+    known: List[Optional[float]] = []
+    for metadata in metadata_list:
+        if metadata.get("max_rss_kb") != None:
+            known.append(metadata["max_rss_kb"])
+        elif metadata["hashed_id"] in history:
+            known.append(history[metadata["hashed_id"]]["maxrss_kb"])
+        else:
+            known.append(None)
+    known_values = [e for e in known if e != None]
+    default_rss = statistics.median(known_values) if known_values else 0
+    return [e if e != None else default_rss for e in known]
+
+
+def simulate_concurrency(expected_times_in_order: List[float],
+                         expected_rss_in_order: List[float], num_workers: int,
+                         budget_kb: int) -> Concurrency:
+    """
+    Simulates dispatching the tasks in the given order as the dispatcher does:
+    whenever a worker is free, a task that fits in the budget is taken from a
+    CostQueue and started, and a task that doesn't fit even alone is started
+    when no task is running.
+    """
+    pending = CostQueue(expected_rss_in_order)
+    for i in range(len(expected_times_in_order)):
+        pending.append(i)
+    running: List[tuple] = []  # Heap of (end time, task).
+    now, running_rss, total_time = 0.0, 0.0, 0.0
+    peak, peak_rss = 0, 0.0
+    while pending or running:
+        while pending and len(running) < num_workers:
+            available = budget_kb - running_rss if running else float("inf")
+            i = pending.take(available)
+            if i == None:
+                break
+            heapq.heappush(running, (now + expected_times_in_order[i], i))
+            running_rss += expected_rss_in_order[i]
+            total_time += expected_times_in_order[i]
+            peak, peak_rss = max(peak, len(running)), max(peak_rss, running_rss)
+        now, i = heapq.heappop(running)
+        running_rss -= expected_rss_in_order[i]
+    return Concurrency(average=total_time / now if now > 0 else float(peak),
+                       peak=peak,
+                       peak_rss_kb=peak_rss)
+
+
+def get_observed_concurrency(results: Iterable[TaskResult]) -> Concurrency:
+    # Sweep over the start and end times; ends sort before starts at the same
+    # time, as the tasks didn't run at the same time.
+    events = []
+    total_time = 0.0
+    for result in results:
+        if result.get("cached") or is_skipped_result(result):
+            continue  # Not run.
+        times = result["times_ms"]
+        events.append((times["abs_start"], 1, result["maxrss_kb"]))
+        events.append((times["abs_end"], -1, -result["maxrss_kb"]))
+        total_time += times["abs_end"] - times["abs_start"]
+    if not events:
+        return Concurrency(average=0.0, peak=0, peak_rss_kb=0.0)
+    events.sort()
+    count, rss, peak, peak_rss = 0, 0.0, 0, 0.0
+    for _, delta, rss_delta in events:
+        count, rss = count + delta, rss + rss_delta
+        peak, peak_rss = max(peak, count), max(peak_rss, rss)
+    makespan = events[-1][0] - events[0][0]
+    return Concurrency(average=total_time / makespan if makespan > 0 else 1.0,
+                       peak=peak,
+                       peak_rss_kb=peak_rss)
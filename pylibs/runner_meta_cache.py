@@ -0,0 +1,150 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Snapshots of '--meta' files for '--meta-cache DIR': the metadata records, as
+# parsed, validated and given their "hashed_id", are stored in DIR in a binary
+# format (marshal), so later runs with the same file load them instead of
+# parsing, validating and hashing again.
+#
+# A snapshot is keyed by the file's absolute path, and records the file's size,
+# mtime and SHA-256 digest. It's used if the size and mtime are unchanged, or
+# else if the digest is; like '--golden-manifest', the size and mtime of a file
+# modified within 2 sec before it's snapshotted are not recorded.
+#
+# Layout of a snapshot file: a JSON header line, then a marshal'ed list of
+# chunks, each a marshal'ed list of records, so the first records are decoded
+# at once and the others as they are iterated.
+
+import gc
+import hashlib
+import json
+import marshal
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from pylibs.runner_common import TaskMetadata
+from pylibs.runner_golden import get_file_sha256
+
+META_CACHE_VERSION = 1
+
+_CHUNK_SIZE = 4096  # Records.
+_RACY_MTIME_NS = 2 * 1000 * 1000 * 1000
+
+
+def _iter_chunk_records(chunks: List[bytes]) -> Iterator[TaskMetadata]:
+    for chunk in chunks:
+        # The records are many small objects that outlive the collections
+        # their allocation would trigger, which take twice as long as decoding.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            records = marshal.loads(chunk)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        yield from records
+
+
+class MetadataSnapshot:
+    """
+    Not thread-safe: the snapshot of one '--meta' file.
+    """
+    def __init__(self, cache_dir: Path, meta_filename: str):
+        self.meta_path_ = os.path.abspath(meta_filename)
+        self.snapshot_path_ = cache_dir.joinpath(
+            hashlib.sha256(self.meta_path_.encode()).hexdigest()[:32] +
+            ".snapshot")
+
+    def load(self) -> Optional[Iterator[TaskMetadata]]:
+        """
+        Returns the records, or None if there is no snapshot of the file's
+        current content.
+        """
+        try:
+            with open(self.snapshot_path_, 'rb') as f:
+                header = json.loads(f.readline())
+                if (header.get("version") != META_CACHE_VERSION
+                        or header.get("python") != self._get_python_version()
+                        or header.get("path") != self.meta_path_):
+                    return None
+                st = os.stat(self.meta_path_)
+                if (header["size"], header["mtime_ns"]) == (st.st_size,
+                                                            st.st_mtime_ns):
+                    return _iter_chunk_records(marshal.loads(f.read()))
+                if get_file_sha256(self.meta_path_) != header["sha256"]:
+                    return None
+                chunks = marshal.loads(f.read())
+        except (OSError, ValueError, KeyError, TypeError, EOFError):
+            return None  # Missing or corrupted.
+        try:
+            self._write(chunks)  # Only the mtime changed: record the new one.
+        except OSError:
+            pass  # The cache is optional.
+        return _iter_chunk_records(chunks)
+
+    def save_as_read(
+            self, records: Iterator[TaskMetadata]) -> Iterator[TaskMetadata]:
+        """
+        Yields the records, and writes the snapshot once all are read, unless
+        the file is changed meanwhile. The records should not be modified
+        before they are all read.
+        """
+        try:
+            st = os.stat(self.meta_path_)
+        except OSError:
+            st = None
+        chunks: List[bytes] = []
+        chunk: List[TaskMetadata] = []
+        for record in records:
+            yield record
+            chunk.append(record)
+            if len(chunk) == _CHUNK_SIZE:
+                chunks.append(marshal.dumps(chunk))
+                chunk = []
+        if chunk:
+            chunks.append(marshal.dumps(chunk))
+        try:
+            if st == None or self._stat_changed(st):
+                return
+            self._write(chunks)
+        except OSError:
+            pass  # The cache is optional.
+
+    def _write(self, chunks: List[bytes]) -> None:
+        st = os.stat(self.meta_path_)
+        sha256 = get_file_sha256(self.meta_path_)
+        if self._stat_changed(st):
+            return  # Being modified.
+        racy = time.time_ns() - st.st_mtime_ns < _RACY_MTIME_NS
+        header: Dict[str, Any] = {
+            "version": META_CACHE_VERSION,
+            "python": self._get_python_version(),
+            "path": self.meta_path_,
+            "size": None if racy else st.st_size,
+            "mtime_ns": None if racy else st.st_mtime_ns,
+            "sha256": sha256,
+        }
+        os.makedirs(self.snapshot_path_.parent, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.snapshot_path_.parent,
+                                         prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(header).encode() + b"\n")
+                f.write(marshal.dumps(chunks))
+            os.replace(temp_path, self.snapshot_path_)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _stat_changed(self, st: os.stat_result) -> bool:
+        now = os.stat(self.meta_path_)
+        return (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def _get_python_version() -> str:
+        # The marshal format may change with Python versions.
+        return "%d.%d" % sys.version_info[:2]
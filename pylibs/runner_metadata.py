@@ -0,0 +1,188 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Reading the tests' metadata one record at a time, so that the tasks can be
+# dispatched while later records are still being read. The '--meta' file is
+# either a JSON array of metadata objects (parsed as a whole), or JSON lines,
+# i.e. one metadata object per line (parsed line by line); the format is told
+# by the first non-whitespace character. The '--paths-from' file has a test
+# executable path per line.
+#
+# Errors are raised as MetadataError when the bad record is reached, which may
+# be after some tasks have run.
+#
+# Records are checked by _is_valid_metadata(), which does what the schema does
+# with direct type checks, and is much faster; the schema is only used to
+# explain why a record is bad.
+
+import json
+import os
+import sys
+from typing import Any, Dict, Iterator, Optional, Set, TextIO, Tuple
+
+from pylibs import schema
+from pylibs.runner_common import TaskMetadata
+
+# A record with its position in the file, e.g. "line 3", for error messages.
+PositionedRecord = Tuple[str, Any]
+
+_METADATA_SCHEMA = schema.Schema({  # sync with EXPLANATION_STRING's spec
+    "id": str,
+    "path": str,
+    "args": [str],
+    "prefix": [str],
+    "golden": schema.Or(str, None),
+    "timeout_ms": schema.And(int, lambda v: v > 0),
+    "envs": schema.Or({schema.Optional(str): str}, None),
+    "exit": {
+        "type": schema.Or("return", "timeout", "signal", "quit", "unknown"),
+        "repr": int,
+        schema.Optional(str): object,  # Allow more fields, if any.
+    },
+    schema.Optional("max_rss_kb"): schema.And(int, lambda v: v >= 0),
+    schema.Optional(str): object,  # Allow more fields, if any.
+})
+
+_EXIT_TYPES = frozenset(["return", "timeout", "signal", "quit", "unknown"])
+
+
+def _is_str_list(value: Any) -> bool:
+    return type(value) == list and all(type(e) == str for e in value)
+
+
+def _is_valid_metadata(metadata: Any) -> bool:
+    """
+    Returns True only if _METADATA_SCHEMA accepts the metadata; it may be
+    False for some odd ones accepted, e.g. with values of subclasses of int.
+    """
+    if type(metadata) != dict:
+        return False
+    try:
+        envs, exit_status = metadata["envs"], metadata["exit"]
+        if not (type(metadata["id"]) == str and type(metadata["path"]) == str
+                and _is_str_list(metadata["args"])
+                and _is_str_list(metadata["prefix"])
+                and (metadata["golden"] == None
+                     or type(metadata["golden"]) == str)
+                and type(metadata["timeout_ms"]) == int
+                and metadata["timeout_ms"] > 0):
+            return False
+        if envs != None and not (type(envs) == dict and all(
+                type(k) == str and type(v) == str for k, v in envs.items())):
+            return False
+        if not (type(exit_status) == dict
+                and exit_status["type"] in _EXIT_TYPES
+                and type(exit_status["repr"]) == int):
+            return False
+    except (KeyError, TypeError):  # TypeError: e.g. unhashable exit type.
+        return False
+    max_rss_kb = metadata.get("max_rss_kb", 0)
+    return type(max_rss_kb) == int and max_rss_kb >= 0
+
+
+class MetadataError(Exception):
+    pass
+
+
+def get_metadata_from_path(test_id: str, path: str) -> Dict[str, Any]:
+    return {  # Docs: see pylibs.docs.EXPLANATION_STRING.
+        "id": test_id, "path": path, "args": [], "envs": None, "prefix": [],
+        "golden": None, "timeout_ms": None,
+        "exit": {"type": "return", "repr": 0}
+    }
+
+
+def validate_metadata_noexcept(
+        metadata: Any) -> Optional[str]:  # Error explanation, None if OK.
+    if _is_valid_metadata(metadata):
+        return None
+    try:
+        _METADATA_SCHEMA.validate(metadata)
+        return None
+    except schema.SchemaError as e:  # Carries explanations.
+        return str(e)
+
+
+def _is_json_array(f: TextIO) -> bool:
+    while True:
+        c = f.read(1)
+        if c == "" or not c.isspace():
+            f.seek(0)
+            return c == "["
+
+
+def iter_meta_file(filename: str) -> Iterator[PositionedRecord]:
+    """
+    Yields the records of the '--meta' file, unchecked.
+    """
+    try:
+        yield from _iter_meta_file(filename)
+    except (OSError, UnicodeDecodeError) as e:
+        raise MetadataError("cannot read '--meta' file: %s" % e)
+
+
+def _iter_meta_file(filename: str) -> Iterator[PositionedRecord]:
+    with open(filename, 'r') as f:
+        if _is_json_array(f):
+            try:
+                records = json.load(f)
+            except ValueError:
+                raise MetadataError("not a valid JSON file: %s" % filename)
+            for i, record in enumerate(records):
+                yield "entry %d" % (i + 1), record
+            return
+        for lineno, line in enumerate(f, 1):
+            if line.isspace():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise MetadataError("not a valid JSON line: %s:%d" %
+                                    (filename, lineno))
+            yield "line %d" % lineno, record
+
+
+def iter_checked_metadata(
+        records: Iterator[PositionedRecord]) -> Iterator[TaskMetadata]:
+    """
+    Yields the records after checking their format and test IDs.
+    """
+    ids_seen: Set[str] = set()
+    for position, record in records:
+        error_str = validate_metadata_noexcept(record)
+        if error_str:
+            raise MetadataError(
+                "metadata format is bad at %s; check out '--docs'\n\t%s" %
+                (position, error_str))
+        if record["id"] in ids_seen:
+            raise MetadataError("test ID repeated: %s" % record["id"])
+        ids_seen.add(record["id"])
+        yield record
+
+
+def iter_paths_file(filename: str) -> Iterator[TaskMetadata]:
+    """
+    Yields the metadata of the test executables listed in the file, or stdin
+    if filename is "-".
+    """
+    try:
+        yield from _iter_paths_file(filename)
+    except (OSError, UnicodeDecodeError) as e:
+        raise MetadataError("cannot read '--paths-from' file: %s" % e)
+
+
+def _iter_paths_file(filename: str) -> Iterator[TaskMetadata]:
+    f = sys.stdin if filename == "-" else open(filename, 'r')
+    try:
+        test_count = 0
+        for line in f:
+            path = line.strip()
+            if not path:
+                continue
+            if not os.path.isfile(path):
+                raise MetadataError("executable not found: %s" % path)
+            test_count += 1
+            yield get_metadata_from_path(str(test_count), path)
+    finally:
+        if f is not sys.stdin:
+            f.close()
@@ -0,0 +1,143 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Post-processing stage for '--postprocess-workers N': the CPU-bound work done
+# after a test exits, i.e. computing and rendering the diff with the golden
+# file, is done by a pool of N processes, so that it doesn't hold the GIL that
+# the worker threads (or the event loop) need to keep the test slots busy. With
+# N = 0, it's done by the task's own worker, as before.
+#
+# The pool is saturated while all its processes are busy, i.e. new work has to
+# wait; how long it was saturated is reported after the run, as a hint that N
+# is too small.
+
+import concurrent.futures
+import contextlib
+import multiprocessing
+import signal
+import threading
+import time
+from typing import Any, Callable, Iterator, NamedTuple, Optional, Tuple
+
+from pylibs.differ import get_diff_html_str
+from pylibs.runner_compress import open_maybe_compressed
+
+
+class PostprocessStats(NamedTuple):
+    num_workers: int
+    job_count: int
+    saturated_sec: float
+
+
+def write_diff_html(html_title: str, desc: str, expected_filename: str,
+                    actual_filename: str, diff_filename: str,
+                    context_lines: Optional[int]) -> Tuple[bool, bool]:
+    """
+    Returns whether the golden file is found, and whether the diff file is
+    written, i.e. the diff is non-empty. The HTML string is not returned, as it
+    would be pickled to the caller's process. See get_diff_html_str() for
+    context_lines.
+    """
+    found_golden, diff_html = get_diff_html_str(
+        html_title=html_title,
+        desc=desc,
+        expected_filename=expected_filename,
+        actual_filename=actual_filename,
+        context_lines=context_lines,
+    )
+    if diff_html == None:
+        return found_golden, False
+    assert diff_html != ""
+    with open_maybe_compressed(diff_filename, 'wt') as f:
+        f.write(diff_html)
+    return found_golden, True
+
+
+def _init_worker_process() -> None:
+    # Ctrl-C is handled by the main process, which shuts the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _get_mp_context():
+    # Not "fork": the main process has threads.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn")
+
+
+class PostprocessPool:
+    """
+    Thread-safe. Runs functions in the worker processes while in the 'with'
+    block of started(), or in the calling thread otherwise.
+    """
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.executor_: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.num_workers_ = 0
+        self.job_count_ = 0
+        self.pending_count_ = 0  # Submitted but not done.
+        self.saturated_since_: Optional[float] = None
+        self.saturated_sec_ = 0.0
+
+    @contextlib.contextmanager
+    def started(self, num_workers: int) -> Iterator[None]:
+        if num_workers == 0:
+            yield
+            return
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=_get_mp_context(),
+            initializer=_init_worker_process)
+        # Start the processes from this thread, so they don't inherit the CPU
+        # pinning of a worker thread, see runner_cpu.
+        concurrent.futures.wait(
+            [executor.submit(int) for _ in range(num_workers)])
+        with self.lock_:
+            self.executor_ = executor
+            self.num_workers_ = num_workers
+        try:
+            yield
+        finally:
+            with self.lock_:
+                self.executor_ = None
+            executor.shutdown(wait=True)
+
+    def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Returns func(*args), which is picklable, as are the args and the return
+        value. Blocks the calling thread without holding the GIL.
+        """
+        with self.lock_:
+            executor = self.executor_
+            if executor != None:
+                self._on_submit()
+        if executor == None:
+            return func(*args)
+        future = executor.submit(func, *args)
+        future.add_done_callback(lambda _: self._on_done())
+        return future.result()
+
+    def get_stats(self) -> PostprocessStats:
+        with self.lock_:
+            saturated_sec = self.saturated_sec_
+            if self.saturated_since_ != None:
+                saturated_sec += time.monotonic() - self.saturated_since_
+            return PostprocessStats(num_workers=self.num_workers_,
+                                    job_count=self.job_count_,
+                                    saturated_sec=saturated_sec)
+
+    def _on_submit(self) -> None:  # With the lock held.
+        self.job_count_ += 1
+        self.pending_count_ += 1
+        if self.pending_count_ == self.num_workers_:
+            self.saturated_since_ = time.monotonic()
+
+    def _on_done(self) -> None:
+        with self.lock_:
+            if self.pending_count_ == self.num_workers_:
+                self.saturated_sec_ += time.monotonic() - self.saturated_since_
+                self.saturated_since_ = None
+            self.pending_count_ -= 1
+
+
+POSTPROCESS_POOL = PostprocessPool()
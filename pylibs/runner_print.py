@@ -4,7 +4,7 @@
 import os
 import sys
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
 from pylibs import rotating_logger
 from pylibs import score_utils
@@ -17,9 +17,11 @@ from pylibs.runner_common import (
     TaskMetadata,
     TaskResult,
     TaskExceptions,
+    BUILTIN_TIMER,
     GOLDEN_NOT_WRITTEN_PREFIX,
     LOG_FILE_BASE,
 )
+from pylibs.runner_task_res import is_skipped_result
 
 IS_ATTY = sys.stdin.isatty() and sys.stdout.isatty()
 TERMINAL_COLS = int(os.popen('stty size',
@@ -44,7 +46,13 @@ def get_error_summary(task_result: TaskResult) -> Dict[str, Optional[str]]:
     else:
         exit_error = None
     diff_file = task_result["stdout"]["diff_file"]
-    if diff_file != None:
+    diff_ref = (task_result.get("packed") or {}).get("diff")
+    if diff_ref != None:  # '--artifacts pack': the file doesn't exist.
+        diff_file_hyperlink = score_utils.hyperlink_str(
+            diff_ref["pack"],
+            description="%s in %s" % (os.path.basename(diff_file),
+                                      os.path.basename(diff_ref["pack"])))
+    elif diff_file != None:
         diff_file_hyperlink = score_utils.hyperlink_str(
             diff_file, description=os.path.basename(diff_file))
     else:
@@ -93,8 +101,8 @@ def print_one_task_realtime_log(
 
 
 def count_and_print_for_test_running(
-    result_list: List[TaskResult],
-    timer_prog: str,
+    result_list: Iterable[TaskResult],
+    timer_prog: Optional[str],
 ) -> Tuple[int, int]:
     error_task_count, unique_error_tests = 0, set()
     for result in result_list:
@@ -107,33 +115,42 @@ def count_and_print_for_test_running(
 
 POST_PROCESSING_SUMMARY_TEMPLATE = """\
 {color}{bold}{status}{no_color}{color} total {total_task_info}, time {time}
-  summary: {error_count_info}
+  summary: {error_count_info}{makespan_info}
   raw log: {log_path}{no_color}"""
 
 
 def print_summary_report(
     args: Args,
     num_tasks: int,
-    result_list: List[TaskResult],
+    unique_count: int,
+    result_list: Iterable[TaskResult],
     master_log_filepath: Path,
     time_sec: float,
+    predicted_makespan_sec: Optional[float] = None,
+    skipped_count: int = 0,
 ) -> Tuple[int, int]:
-    assert len(result_list) == num_tasks
+    # The rerun commands of '--timer builtin' runs have no timer.
+    timer_prog = args.timer if args.timer != BUILTIN_TIMER else None
     if args.write_golden:
         error_task_count = count_and_print_for_golden_writing(
-            result_list, args.timer)
+            result_list, timer_prog)
         unique_error_task_count = error_task_count
     else:
         error_task_count, unique_error_task_count = \
-            count_and_print_for_test_running(result_list, args.timer)
+            count_and_print_for_test_running(result_list, timer_prog)
     assert unique_error_task_count <= error_task_count
     color = "" if not IS_ATTY else (
         "\x1b[32m" if error_task_count == 0 else "\x1b[38;5;203m")
-    total_task_info = "%s (unique: %s)" % (num_tasks,
-                                           int(num_tasks / args.repeat))
+    total_task_info = "%s (unique: %s)" % (num_tasks, unique_count)
     error_count_info = ("all passed" if error_task_count == 0 else
                         ("unexpected error %s (unique: %s)" %
                          (error_task_count, unique_error_task_count)))
+    if skipped_count > 0:
+        error_count_info += ", skipped %d (run stopped early)" % skipped_count
+    makespan_info = ""
+    if predicted_makespan_sec != None:
+        makespan_info = "\n  makespan: predicted %.3f sec, actual %.3f sec" % (
+            predicted_makespan_sec, time_sec)
     sys.stderr.write(
         POST_PROCESSING_SUMMARY_TEMPLATE.format(
             color=color,
@@ -142,6 +159,7 @@ def print_summary_report(
             status="✓ SUCCESS" if error_task_count == 0 else "! ERROR",
             total_task_info=total_task_info,
             error_count_info=error_count_info,
+            makespan_info=makespan_info,
             time="%.3f sec" % time_sec,
             log_path=score_utils.hyperlink_str(  # Clickable link if possible
                 os.path.relpath(master_log_filepath),
@@ -150,13 +168,15 @@ def print_summary_report(
 
 
 def count_and_print_for_golden_writing(
-    result_list: List[TaskResult],
-    timer_prog: str,
+    result_list: Iterable[TaskResult],
+    timer_prog: Optional[str],
 ) -> int:
     error_task_count = 0
     golden_written_count = 0
     golden_same_content_count, golden_wrong_exit_count = 0, 0
     for result in result_list:
+        if is_skipped_result(result):
+            continue
         assert result["stdout"]["golden_file"] != None
         if result["ok"] == False:
             error_task_count += 1
@@ -164,7 +184,8 @@ def count_and_print_for_golden_writing(
             result, timer_prog)
         if written_or_not == TaskExceptions.GOLDEN_NOT_WRITTEN_SAME_CONTENT:
             golden_same_content_count += 1
-        elif written_or_not == TaskExceptions.GOLDEN_NOT_WRITTEN_WRONG_EXIT:
+        elif written_or_not in (TaskExceptions.GOLDEN_NOT_WRITTEN_WRONG_EXIT,
+                                TaskExceptions.GOLDEN_NOT_WRITTEN_TRUNCATED):
             golden_wrong_exit_count += 1
         elif not written_or_not:
             golden_written_count += 1
@@ -184,17 +205,17 @@ UNEXPECTED_ERROR_FORMAT = """\n\x1b[33m[unexpected error] {desc}\x1b[0m{repeat}
 
 
 # when not using '--write-golden'
-def print_test_running_result_to_stderr(result: TaskResult, timer: str) -> None:
+def print_test_running_result_to_stderr(result: TaskResult,
+                                        timer: Optional[str]) -> None:
     rerun_command = score_utils.make_command_invocation_str(timer,
                                                             result,
                                                             indent=2)
-    if result["ok"] == True or result["error_is_flaky"] == True:
+    if (result["ok"] == True or result["error_is_flaky"] == True
+            or is_skipped_result(result)):
         return
     assert result["ok"] == False
     result_exceptions = [TaskExceptions(e) for e in result["exceptions"]]
-    if len(result_exceptions) > 0:
-        assert (len(result_exceptions) == 1
-                and result_exceptions[0] == TaskExceptions.GOLDEN_FILE_MISSING)
+    if TaskExceptions.GOLDEN_FILE_MISSING in result_exceptions:
         error_summary = "%s: %s" % (TaskExceptions.GOLDEN_FILE_MISSING,
                                     os.path.relpath(
                                         result["stdout"]["golden_file"]))
@@ -203,6 +224,8 @@ def print_test_running_result_to_stderr(result: TaskResult, timer: str) -> None:
         error_summary = '\n'.join([
             "  %s: %s" % (k, v) for k, v in error_summary.items() if v != None
         ])
+    if TaskExceptions.STDOUT_TRUNCATED in result_exceptions:
+        error_summary += "\n  %s" % TaskExceptions.STDOUT_TRUNCATED.value
     if result["repeat"]["all"] > 1:
         repeat_report = " (repeat %d/%d)" % (result["repeat"]["count"],
                                              result["repeat"]["all"])
@@ -217,7 +240,7 @@ def print_test_running_result_to_stderr(result: TaskResult, timer: str) -> None:
 
 # when using '--write-golden'
 def print_golden_overwriting_result_to_stderr(
-        result: TaskResult, timer: str) -> Optional[TaskExceptions]:
+        result: TaskResult, timer: Optional[str]) -> Optional[TaskExceptions]:
     attempted_golden_file: str = result["stdout"]["golden_file"]  # abs path
     not_written_exceptions = [
         TaskExceptions(e) for e in result["exceptions"]
@@ -247,4 +270,9 @@ def print_golden_overwriting_result_to_stderr(
             "  \x1b[2mskipped: %s\n%s\x1b[0m\n" %
             (result["id"], hyperlink_to_golden_file, rerun_command))
         return TaskExceptions.GOLDEN_NOT_WRITTEN_WRONG_EXIT  # the only one item
+    if TaskExceptions.GOLDEN_NOT_WRITTEN_TRUNCATED in not_written_exceptions:
+        sys.stderr.write("\n\x1b[33m[error: stdout truncated] %s\x1b[0m\n"
+                         "  \x1b[2mskipped: %s\x1b[0m\n" %
+                         (result["id"], hyperlink_to_golden_file))
+        return TaskExceptions.GOLDEN_NOT_WRITTEN_TRUNCATED
     raise RuntimeError("should not reach here")
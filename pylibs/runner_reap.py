@@ -0,0 +1,109 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Removal of the previous log directory without delaying the run: the
+# directory is renamed (atomically) to a trash name next to it, so the run can
+# start with a fresh log directory at once, and the trash is deleted by a
+# detached process at low CPU and I/O priority, which may outlive the run.
+#
+# A trash directory is named ".<log dir name>.trash-<token>": it's hidden, and
+# it's never mistaken for the log directory, even if the deletion is cut
+# short, e.g. by a crash or a reboot; such leftovers are deleted by the next
+# run with the same log directory.
+#
+# If the log directory is a symlink, the directory it points to is the one
+# moved to the trash, next to itself; the symlink is left in place.
+#
+# This file is also the reaper's script: python3 runner_reap.py DIR...
+
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+_TRASH_INFIX = ".trash-"
+
+
+def _get_trash_prefix(dirname: str) -> str:
+    path = Path(os.path.realpath(dirname))
+    return ".%s%s" % (path.name, _TRASH_INFIX)
+
+
+def move_to_trash(dirname: str) -> Optional[str]:
+    """
+    Renames the directory to a new trash name, and returns the name, or None
+    if it can't be renamed, e.g. it's a mount point.
+    """
+    path = Path(os.path.realpath(dirname))
+    trash_path = path.with_name(
+        _get_trash_prefix(dirname) + secrets.token_hex(4))
+    try:
+        os.rename(path, trash_path)
+    except OSError:
+        return None
+    return str(trash_path)
+
+
+def list_trash(dirname: str) -> List[str]:
+    """
+    Lists the trash directories of the directory, including those left by
+    previous runs. If it's a symlink, also the trash of the symlink itself,
+    which older versions moved to the trash instead of the directory.
+    """
+    paths = {Path(os.path.abspath(dirname)), Path(os.path.realpath(dirname))}
+    return sorted(
+        str(e) for path in paths
+        for e in path.parent.glob(".%s%s*" % (path.name, _TRASH_INFIX))
+        if e.is_dir() or e.is_symlink())
+
+
+def _make_reaper_command(trash_dirnames: List[str]) -> List[str]:
+    cmd = [sys.executable, os.path.abspath(__file__)] + trash_dirnames
+    ionice = shutil.which("ionice")
+    if ionice:
+        cmd = [ionice, "-c", "3"] + cmd  # Idle class: only when disk is idle.
+    return cmd
+
+
+def reap_trash(dirname: str) -> None:
+    """
+    Deletes the trash directories of the directory, in a detached process, or
+    in a background thread if the process can't be spawned (then what's left
+    by the end of the run is deleted by the next run).
+    """
+    trash_dirnames = list_trash(dirname)
+    if not trash_dirnames:
+        return
+    try:
+        subprocess.Popen(_make_reaper_command(trash_dirnames),
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True)  # Not killed by Ctrl-C.
+    except OSError:
+        threading.Thread(target=_delete_all,
+                         args=(trash_dirnames, ),
+                         daemon=True).start()
+
+
+def _delete_all(trash_dirnames: List[str]) -> None:
+    for trash_dirname in trash_dirnames:
+        if os.path.islink(trash_dirname):
+            try:
+                os.remove(trash_dirname)  # Not what it points to.
+            except OSError:
+                pass
+        else:
+            shutil.rmtree(trash_dirname, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+    _delete_all(sys.argv[1:])
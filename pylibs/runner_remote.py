@@ -0,0 +1,269 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Coordinator/worker mode: the coordinator (a normal score_run.py invocation,
+# with '--coordinator ADDR') owns the task queue, and any number of worker
+# processes ('score_run.py --worker ADDR') connect to it, pull tasks and send
+# back the results. Workers may join late; tasks taken by a worker that is lost
+# are put back to the queue.
+#
+# ADDR is either a Unix domain socket path, or HOST:PORT for TCP. Each worker
+# slot uses its own connection, on which JSON messages are exchanged, one per
+# line:
+#   worker: {"op": "hello", "token": str}  (first on each connection)
+#   coord.: {"config": {"cwd": .., "timer": .., "timer_stats": ..,
+#                       "stderr_mode": .., "max_output_bytes": ..,
+#                       "compression": .., "diff_context": ..,
+#                       "artifacts": .., "log": .., "write_golden": ..}}
+#           or {"error": str}
+#   worker: {"op": "take"}
+#   coord.: {"index": int, "metadata": {..}} or {"done": true}
+#   worker: {"op": "result", "index": int, "result": {..}}
+#   worker: {"op": "take"} ...
+#
+# The token is the run's secret, given to the coordinator and the workers (see
+# get_coordinator_token()), so that other processes that can reach ADDR can't
+# take tasks or post fabricated results. Messages that don't follow the
+# protocol end the connection, with the task taken on it, if any, put back to
+# the queue.
+
+import hmac
+import json
+import os
+import re
+import secrets
+import socket
+import socketserver
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from pylibs.runner_common import TaskMetadata, TaskResult
+from pylibs.runner_dispatch import Dispatcher
+
+RemoteConfig = Dict[str, Any]
+
+# Environment variable of the token, see get_coordinator_token().
+COORDINATOR_TOKEN_ENV = "SCORE_COORDINATOR_TOKEN"
+# The coordinator's token file, in its log directory.
+COORDINATOR_TOKEN_FILE_BASE = "coordinator.token"
+
+_CONFIG_KEYS = ("cwd", "timer", "timer_stats", "stderr_mode",
+                "max_output_bytes", "compression", "diff_context", "artifacts",
+                "log", "write_golden")
+
+_TCP_ADDR_REGEX = re.compile(r"([^/]*):(\d+)")
+
+
+class RemoteProtocolError(Exception):
+    pass
+
+
+def get_coordinator_token() -> str:
+    """
+    Returns the token in the environment, or a new random one.
+    """
+    return os.environ.get(COORDINATOR_TOKEN_ENV) or secrets.token_hex(16)
+
+
+def save_coordinator_token(filename: str, token: str) -> None:
+    """
+    Writes the token to a file only the user can read.
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + "\n")
+
+
+def _parse_addr(addr: str) -> Tuple[int, Union[str, Tuple[str, int]]]:
+    m = _TCP_ADDR_REGEX.fullmatch(addr)
+    if m:
+        return socket.AF_INET, (m.group(1) or "localhost", int(m.group(2)))
+    return socket.AF_UNIX, addr
+
+
+def _send(f, message: Dict[str, Any]) -> None:
+    f.write((json.dumps(message, separators=(",", ":")) + "\n").encode())
+    f.flush()
+
+
+def _receive(f) -> Optional[Dict[str, Any]]:
+    line = f.readline()
+    if not line:
+        return None  # Connection closed.
+    try:
+        message = json.loads(line)
+    except ValueError:
+        raise RemoteProtocolError("not a JSON message")
+    if type(message) != dict:
+        raise RemoteProtocolError("not a JSON object")
+    return message
+
+
+def _get_field(message: Dict[str, Any], key: str, value_type: type) -> Any:
+    value = message.get(key)
+    if type(value) != value_type:
+        raise RemoteProtocolError("bad or missing '%s' in message" % key)
+    return value
+
+
+class _CoordinatorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        taken_index = None
+        try:
+            message = _receive(self.rfile)
+            if message == None:
+                return
+            if not (message.get("op") == "hello" and hmac.compare_digest(
+                    str(message.get("token")), self.server.token)):
+                _send(self.wfile, {"error": "bad token"})
+                return
+            _send(self.wfile, {"config": self.server.config})
+            while True:
+                message = _receive(self.rfile)
+                if message == None:
+                    break
+                op = message.get("op")
+                if op == "take":
+                    taken_index = self.server.dispatcher.take()
+                    if taken_index == None:
+                        _send(self.wfile, {"done": True})
+                        break
+                    _send(
+                        self.wfile, {
+                            "index": taken_index,
+                            "metadata": self.server.get_metadata(taken_index),
+                        })
+                elif op == "result":
+                    if (taken_index == None or
+                            _get_field(message, "index", int) != taken_index):
+                        raise RemoteProtocolError("result of a task not taken")
+                    result = _get_field(message, "result", dict)
+                    self.server.on_remote_result(taken_index, result)
+                    taken_index = None
+                else:
+                    raise RemoteProtocolError("bad op: %s" % op)
+        except (OSError, RemoteProtocolError):
+            pass  # The worker is lost, or is broken.
+        finally:
+            if taken_index != None:
+                self.server.dispatcher.requeue(taken_index)
+
+
+class _UnixCoordinatorServer(socketserver.ThreadingMixIn,
+                             socketserver.UnixStreamServer):
+    daemon_threads = True  # Don't wait for workers at exit.
+
+
+class _TcpCoordinatorServer(socketserver.ThreadingMixIn,
+                            socketserver.TCPServer):
+    daemon_threads = True  # Don't wait for workers at exit.
+    allow_reuse_address = True
+
+
+class coordinator_server:
+    """
+    Serves tasks from the dispatcher to worker processes at the address, in
+    another thread, while in the 'with' block.
+    Only workers that present the token are served.
+    on_remote_result(index, result) should eventually call dispatcher.finish().
+    """
+    def __init__(self, addr: str, token: str, dispatcher: Dispatcher,
+                 config: RemoteConfig,
+                 get_metadata: Callable[[int], TaskMetadata],
+                 on_remote_result: Callable[[int, TaskResult], None]):
+        self.family_, self.addr_ = _parse_addr(addr)
+        self.token_ = token
+        self.dispatcher_ = dispatcher
+        self.config_ = config
+        self.get_metadata_ = get_metadata
+        self.on_remote_result_ = on_remote_result
+        self.server_ = None
+
+    def __enter__(self):
+        if self.family_ == socket.AF_UNIX and os.path.exists(self.addr_):
+            os.remove(self.addr_)  # Left by a previous run.
+        server_class = (_UnixCoordinatorServer if self.family_
+                        == socket.AF_UNIX else _TcpCoordinatorServer)
+        server = server_class(self.addr_, _CoordinatorRequestHandler)
+        server.token = self.token_
+        server.dispatcher = self.dispatcher_
+        server.config = self.config_
+        server.get_metadata = self.get_metadata_
+        server.on_remote_result = self.on_remote_result_
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.server_ = server
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.server_:
+            self.server_.shutdown()
+            self.server_.server_close()
+            if self.family_ == socket.AF_UNIX:
+                os.remove(self.addr_)
+
+
+def _connect(addr: str) -> socket.socket:
+    family, sock_addr = _parse_addr(addr)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_addr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _say_hello(rfile, wfile, token: str) -> Optional[RemoteConfig]:
+    _send(wfile, {"op": "hello", "token": token})
+    reply = _receive(rfile)
+    if reply == None:
+        return None
+    if "error" in reply:
+        raise RemoteProtocolError("rejected: %s" % reply["error"])
+    config = _get_field(reply, "config", dict)
+    missing_keys = [e for e in _CONFIG_KEYS if e not in config]
+    if missing_keys:
+        raise RemoteProtocolError("missing in config: %s" %
+                                  ", ".join(missing_keys))
+    return config
+
+
+def fetch_remote_config(addr: str, token: str) -> Optional[RemoteConfig]:
+    """
+    Returns the coordinator's config, or None if it is closing. Raises OSError
+    if the coordinator isn't reachable, or RemoteProtocolError if it rejects
+    the token or replies in a bad format.
+    """
+    with _connect(addr) as sock:
+        with sock.makefile('rb') as rfile, sock.makefile('wb') as wfile:
+            return _say_hello(rfile, wfile, token)
+
+
+def run_worker_slot(addr: str, token: str,
+                    run_task: Callable[[TaskMetadata], TaskResult]) -> int:
+    """
+    Connects to the coordinator and runs the tasks it gives, until there is no
+    more task. Returns the number of tasks run. Raises OSError if the
+    coordinator isn't reachable, or RemoteProtocolError as fetch_remote_config()
+    does.
+    """
+    count = 0
+    with _connect(addr) as sock:
+        with sock.makefile('rb') as rfile, sock.makefile('wb') as wfile:
+            if _say_hello(rfile, wfile, token) == None:
+                return count
+            while True:
+                _send(wfile, {"op": "take"})
+                message = _receive(rfile)
+                if message == None or message.get("done"):
+                    return count
+                index = _get_field(message, "index", int)
+                result = run_task(_get_field(message, "metadata", dict))
+                _send(wfile, {
+                    "op": "result",
+                    "index": index,
+                    "result": result,
+                })
+                count += 1
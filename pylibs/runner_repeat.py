@@ -0,0 +1,109 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Adaptive repeating: with '--repeat N --adaptive-repeat K', a test whose first
+# K repeats all pass, with the same exit status and the same stdout, is retired
+# early; other tests are repeated N times. Most tests are deterministic, so this
+# saves most of a deflaking run.
+#
+# The results of a test's first K repeats are held back until the test is
+# decided, so that their "repeat.all" can be set to the number of repeats that
+# are actually run.
+
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from pylibs.runner_common import ResultCallback, TaskMetadata, TaskResult
+from pylibs.runner_compress import open_maybe_compressed
+
+_READ_CHUNK_SIZE = 1 << 20
+
+
+def _get_stdout_digest(result: TaskResult) -> Optional[str]:
+    if result["stdout"].get("actual_sha256") != None:
+        return result["stdout"]["actual_sha256"]  # Computed while captured.
+    filename = result["stdout"]["actual_file"]
+    if filename == None:
+        return None
+    h = hashlib.sha256()
+    with open_maybe_compressed(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _is_stable(results: List[TaskResult]) -> bool:
+    if not all(e["ok"] for e in results):
+        return False
+    exits = set((e["exit"]["real"]["type"], e["exit"]["real"]["repr"])
+                for e in results)
+    return len(exits) == 1 and len(set(map(_get_stdout_digest, results))) == 1
+
+
+class AdaptiveRepeat:
+    """
+    Not thread-safe: add_result() should be called in the dispatcher's
+    on_result(), which is never called concurrently.
+    """
+    def __init__(self, metadata_list: List[TaskMetadata], min_repeat: int,
+                 on_result: ResultCallback):
+        self.min_repeat_ = min_repeat
+        self.on_result_ = on_result
+        # Key: hashed_id, value: indexes of the repeats after the first K.
+        self.later_indexes_: Dict[str, List[int]] = {}
+        for i, metadata in enumerate(metadata_list):
+            if metadata["repeat"]["count"] > min_repeat:
+                self.later_indexes_.setdefault(metadata["hashed_id"],
+                                               []).append(i)
+        # Key: hashed_id, value: results held back, with their indexes.
+        self.first_results_: Dict[str, List[Tuple[int, TaskResult]]] = {}
+        self.retired_count_ = 0
+
+    def get_held_indexes(self) -> List[int]:
+        """
+        Returns the indexes of the tasks that are run only if the test is not
+        retired.
+        """
+        return [i for e in self.later_indexes_.values() for i in e]
+
+    def add_result(self, index: int,
+                   result: TaskResult) -> Optional[Tuple[bool, List[int]]]:
+        """
+        Passes the result on, or holds it back until the test is decided. If
+        the test is decided with this result, returns whether it's retired, and
+        the indexes of the tasks to drop (if retired) or to run (otherwise).
+        """
+        hashed_id = result["hashed_id"]
+        if (hashed_id not in self.later_indexes_
+                or result["repeat"]["count"] > self.min_repeat_):
+            self.on_result_(index, result)
+            return None
+        first_results = self.first_results_.setdefault(hashed_id, [])
+        first_results.append((index, result))
+        if len(first_results) < self.min_repeat_:
+            return None
+        del self.first_results_[hashed_id]
+        retired = _is_stable([e[1] for e in first_results])
+        for i, e in first_results:
+            if retired:
+                e["repeat"] = {
+                    "count": e["repeat"]["count"],
+                    "all": self.min_repeat_,
+                }
+            self.on_result_(i, e)
+        if retired:
+            self.retired_count_ += 1
+        return retired, self.later_indexes_.pop(hashed_id)
+
+    def flush(self) -> None:
+        """
+        Passes on the results held back for tests not decided, e.g. because the
+        run is stopped early.
+        """
+        for first_results in self.first_results_.values():
+            for i, e in first_results:
+                self.on_result_(i, e)
+        self.first_results_.clear()
+
+    def get_retired_count(self) -> int:
+        return self.retired_count_
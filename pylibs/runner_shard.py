@@ -0,0 +1,95 @@
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Deterministically partition tests into shards, so that one suite can be split
+# across machines, each running one shard. Given the same metadata and history,
+# every machine computes the same partition.
+
+import hashlib
+import re
+import statistics
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from pylibs.runner_history import History
+
+SHARD_MANIFEST_FILE_BASE = "shard.json"
+
+
+class ShardPlan(NamedTuple):
+    indexes: List[int]  # Indexes of the tests in this shard.
+    method: str  # "runtime" (history available) or "hash".
+    expected_times_ms: Optional[List[float]]  # Of each shard, or None.
+
+
+def parse_shard_spec(spec: str) -> Tuple[int, int]:
+    """
+    Parses "I/N" into (I, N), where 1 <= I <= N. Raises ValueError.
+    """
+    m = re.fullmatch(r"(\d+)/(\d+)", spec)
+    if not m:
+        raise ValueError("shard should be like '2/5', but found '%s'" % spec)
+    index, count = int(m.group(1)), int(m.group(2))
+    if not 1 <= index <= count:
+        raise ValueError("shard index should be in [1, %d], but found %d" %
+                         (count, index))
+    return index, count
+
+
+def _get_hash_bucket(hashed_id: str, count: int) -> int:
+    return int(hashlib.sha1(hashed_id.encode()).hexdigest(), 16) % count
+
+
+def plan_shard(hashed_ids: List[str], shard_index: int, shard_count: int,
+               history: History) -> ShardPlan:
+    """
+    shard_index is 1-based. If any test is found in the history, the tests are
+    distributed by greedy bin packing of their expected wall time (tests not
+    found are expected to take the median time), longest first, each to the
+    shard with the least total so far. Otherwise, they are distributed by the
+    hash of their IDs.
+    """
+    known = [history[e]["wall_ms"] for e in hashed_ids if e in history]
+    if not known:
+        return ShardPlan(
+            indexes=[
+                i for i, e in enumerate(hashed_ids)
+                if _get_hash_bucket(e, shard_count) == shard_index - 1
+            ],
+            method="hash",
+            expected_times_ms=None,
+        )
+    default_time = statistics.median(known)
+    weights = [
+        history[e]["wall_ms"] if e in history else default_time
+        for e in hashed_ids
+    ]
+    # Ties are broken by the hashed ID, not the metadata order, so the plan
+    # doesn't change if the metadata file is merely reordered.
+    order = sorted(range(len(hashed_ids)),
+                   key=lambda i: (-weights[i], hashed_ids[i]))
+    loads = [0.0] * shard_count
+    assignment = [0] * len(hashed_ids)
+    for i in order:
+        bin_index = min(range(shard_count), key=lambda b: (loads[b], b))
+        assignment[i] = bin_index
+        loads[bin_index] += weights[i]
+    return ShardPlan(
+        indexes=[
+            i for i in range(len(hashed_ids))
+            if assignment[i] == shard_index - 1
+        ],
+        method="runtime",
+        expected_times_ms=loads,
+    )
+
+
+def make_shard_manifest(shard_index: int, shard_count: int, plan: ShardPlan,
+                        test_ids: List[str]) -> Dict[str, Any]:
+    return {
+        "shard": shard_index,  # 1-based
+        "shard_count": shard_count,
+        "method": plan.method,
+        # Expected wall time (ms) of each shard, or null for "hash" method.
+        "expected_times_ms": plan.expected_times_ms,
+        "test_ids": test_ids,  # Tests in this shard.
+    }
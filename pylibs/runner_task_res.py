@@ -2,7 +2,10 @@
 # Use of this source code is governed under the MIT LICENSE.txt file.
 
 import os
-from typing import Any, List, Optional, OrderedDict
+import time
+from typing import Any, Dict, Iterator, List, Optional, OrderedDict, Tuple
+
+from pylibs.runner_common import TaskExceptions
 
 INFINITE_TIME = 0  # it means effectively infinite time required by timer
 
@@ -46,6 +49,9 @@ def generate_result_dict(
     stdout_filename: Optional[str],
     diff_filename: Optional[str],
     exceptions: list,
+    stderr_filename: Optional[str] = None,
+    stdout_sha256: Optional[str] = None,
+    golden_sha256: Optional[str] = None,
 ) -> TaskResult:
     all_ok = match_exit and diff_filename == None
     golden_filename = os.path.abspath(
@@ -134,9 +140,104 @@ def generate_result_dict(
                 # abs path (str), or None meaning 1) if "golden_file" == None: no need to compare
                 #                              or 2) if "golden_file" != None: no diff found
                 ("diff_file", diff_filename),
+                # str, SHA-256 of the stdout (even if written to golden file),
+                # or None if the test was not run
+                ("actual_sha256", stdout_sha256),
+                # str, SHA-256 of the golden file, or None if not known, i.e.
+                # not given by '--golden-manifest' and not the same as stdout
+                ("golden_sha256", golden_sha256),
             ]),
         ),
 
+        # abs path (str) of the stderr written by '--separate-stderr', or None.
+        ("stderr_file", stderr_filename),
+
+        # dict, or None if not '--artifacts pack': the keys are "stdout",
+        # "diff", "stderr", for the files above that are packed, and the values
+        # are dicts with keys "pack" (abs path), "offset", "length" (int), see
+        # runner_artifacts. The packed files don't exist.
+        ("packed", None),
+
         # List of str, describe errors encountered in run_one() (not in test).
-        ("exceptions", [e.value for e in exceptions])
+        ("exceptions", [e.value for e in exceptions]),
+
+        # bool, True if the test was not run and the result is from '--cache'.
+        ("cached", False),
+
+        # int, the CPU the test was pinned to by '--pin-cpus', or None.
+        ("cpu", None),
     ])  # NOTE any changes (key, value, meaning) made in this data structure must be honored in score_ui.py
+
+
+# Used by run_tasks(), for tasks not run because the run was stopped early.
+def generate_skipped_result_dict(metadata: dict,
+                                 write_golden: bool) -> TaskResult:
+    now = time.time()
+    result = generate_result_dict(
+        metadata, {
+            "maxrss_kb": 0,
+            "exit": {
+                "type": "unknown",
+                "repr": None
+            },
+            "times_ms": {
+                "total": 0
+            },
+        },
+        match_exit=False,
+        write_golden=write_golden,
+        start_abs_time=now,
+        end_abs_time=now,
+        stdout_filename=None,
+        diff_filename=None,
+        exceptions=[TaskExceptions.TASK_SKIPPED])
+    result["error_is_flaky"] = None  # Neither a definite nor a flaky error.
+    result["stdout"]["ok"] = None
+    return result
+
+
+def is_skipped_result(result: TaskResult) -> bool:
+    return TaskExceptions.TASK_SKIPPED.value in result["exceptions"]
+
+
+# Keys of the result's nested objects, see generate_result_dict().
+_NESTED_KEYS = frozenset(["times_ms", "exit", "expected", "real", "stdout"])
+# Key: a layout, value: the same layout, shared by the compact results.
+_LAYOUTS: Dict[Tuple, Tuple] = {}
+
+
+class CompactResult:
+    """
+    A result held until the master log is written, in a fraction of the
+    memory of the result's OrderedDicts: the values of the result's fields
+    in a tuple, with the layout of the keys, i.e. a tuple of keys and (key,
+    nested layout) pairs, which is shared by the results of the same layout.
+    Converted back to the result with expand(), e.g. to be serialized.
+    """
+    __slots__ = ("layout", "values")
+
+    def __init__(self, result: TaskResult):
+        values: List[Any] = []
+        layout = _flatten(result, values)
+        self.layout = _LAYOUTS.setdefault(layout, layout)
+        self.values = tuple(values)
+
+    def expand(self) -> TaskResult:
+        return _unflatten(self.layout, iter(self.values))
+
+
+def _flatten(obj: dict, values: List[Any]) -> Tuple:
+    layout: List[Any] = []
+    for key, value in obj.items():
+        if key in _NESTED_KEYS and isinstance(value, dict):
+            layout.append((key, _flatten(value, values)))
+        else:
+            layout.append(key)
+            values.append(value)
+    return tuple(layout)
+
+
+def _unflatten(layout: Tuple, values: Iterator[Any]) -> TaskResult:
+    return TaskResult(
+        (e, next(values)) if type(e) == str else (e[0], _unflatten(
+            e[1], values)) for e in layout)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 Leedehai. All rights reserved.
+# Use of this source code is governed under the MIT LICENSE.txt file.
+# -----
+# Benchmarks validating the metadata and flakiness declarations: with the
+# schema alone, and with the fast path that falls back to the schema only for
+# bad entries.
+# Usage: sanity/bench-validate.py [N], from the project root; N is the entry
+# count, default: 100000.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pylibs import flakiness, runner_metadata
+
+
+def make_metadata(i: int) -> dict:
+    return {
+        "id": "test_%d" % i,
+        "path": "out/tests/test_%d" % (i % 100),
+        "args": ["--case", str(i), "--verbose"],
+        "prefix": [],
+        "golden": "goldens/test_%d.txt" % i if i % 2 else None,
+        "timeout_ms": 5000,
+        "envs": {
+            "LANG": "C"
+        } if i % 3 else None,
+        "exit": {
+            "type": "return",
+            "repr": 0
+        },
+        "max_rss_kb": 1024,
+    }
+
+
+def make_flake_decls(count: int) -> dict:
+    return {
+        "test_%d" % i: {
+            "errors": ["timeout", "signal"],
+            "reason": "flaky on CI"
+        }
+        for i in range(count)
+    }
+
+
+def measure(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def validate_metadata_list(metadata_list: list, with_fast_path: bool) -> None:
+    for metadata in metadata_list:
+        if with_fast_path:
+            assert runner_metadata.validate_metadata_noexcept(metadata) == None
+        else:
+            runner_metadata._METADATA_SCHEMA.validate(metadata)
+
+
+def validate_flake_decls(data: dict, with_fast_path: bool) -> None:
+    if not (with_fast_path and flakiness._is_valid_flake_decls(data)):
+        flakiness._FLAKE_DECLS_SCHEMA.validate(data)
+
+
+def main() -> int:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    metadata_list = [make_metadata(i) for i in range(count)]
+    flake_decls = make_flake_decls(count)
+    print("%d entries     schema (sec)  fast path (sec)  speedup" % count)
+    for name, func, data in [("metadata", validate_metadata_list,
+                              metadata_list),
+                             ("flakes", validate_flake_decls, flake_decls)]:
+        slow = measure(func, data, False)
+        fast = measure(func, data, True)
+        print("%-16s  %12.3f  %15.3f  %6.1fx" % (name, slow, fast, slow / fast))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,34 @@
 
 has_error=0
 
+# check_log LOG EXPECTED: the master log's test ids (sorted, with repeats),
+# and its counts of ok and not ok results, should be EXPECTED, e.g.
+# "lorem_1,lorem_2 1 1".
+check_log() {
+    local summary=$(python3 -c 'import json, sys
+log = json.load(open(sys.argv[1]))
+ok_count = sum(1 for e in log if e["ok"])
+print(",".join(sorted(e["id"] for e in log)), ok_count, len(log) - ok_count)
+' "$1")
+    if [ "$summary" != "$2" ] ; then
+        printf "\033[31;1m$1 incorrect (expect '$2'):\n\033[0m"
+        echo "$summary"
+        has_error=1
+    fi
+}
+
+# check_log_expr LOG EXPR: the Python expression EXPR, on the master log's
+# results "log", should be true.
+check_log_expr() {
+    if ! python3 -c 'import gzip, hashlib, json, lzma, os, sys
+log = json.load(open(sys.argv[1]))
+sys.exit(0 if eval(sys.argv[2]) else 1)
+' "$1" "$2" ; then
+        printf "\033[31;1m$1 incorrect (expect $2)\n\033[0m"
+        has_error=1
+    fi
+}
+
 if [ ! -d sanity ]; then
   echo "Your current working directory is not at the project root"
   exit 1
@@ -41,6 +69,20 @@ if [ ! -f logs1/html/index.html ] ; then
     has_error=1
 fi
 
+printf "\033[32;1m\n# run tests that are all good, with the asyncio engine\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs1 --engine async\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs1 --engine async ; exit_code=$?
+
+if [ $exit_code -ne 0 ]; then
+    printf "\033[31;1mexit code is not 0\n\033[0m"
+    has_error=1
+fi
+if [ $(ls logs1/*/*.stdout | wc -l) -ne 2 ] ; then
+    printf "\033[31;1m*.stdout count incorrect (expect 2):\n\033[0m"
+    ls logs1/*.stdout
+    has_error=1
+fi
+
 # run tests, some of them being bad
 printf "\033[32;1m\n# run tests, some of them being bad\n\033[0m"
 printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs2\n\033[0m"
@@ -105,6 +147,375 @@ if [ -f should_not_be_created.gold ] ; then
     has_error=1
 fi
 
+printf "\033[32;1m\n# run tests with a timer that doesn't write CTIMER_STATS files\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-old-timer.json -g logs4\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-old-timer.json -g logs4 ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2 1 1"
+check_log_expr logs4/log.json '[e["times_ms"]["proc"] for e in log] == [1.01, 1500.02]'
+check_log_expr logs4/log.json '[e["exit"]["real"]["type"] for e in log] == ["return", "timeout"]'
+if [ $(ls logs4/*.stats.json 2> /dev/null | wc -l) -ne 0 ] ; then
+    printf "\033[31;1m*.stats.json count incorrect (expect 0):\n\033[0m"
+    ls logs4/*.stats.json
+    has_error=1
+fi
+if grep -q "#####" logs4/*/*.stdout ; then
+    printf "\033[31;1mstats report found in *.stdout\n\033[0m"
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests, with the stats reported between delimiters\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --timer-stats delimiter\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --timer-stats delimiter ; exit_code=$?
+
+if [ $exit_code -ne 0 ]; then
+    printf "\033[31;1mexit code is not 0\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2 2 0"
+check_log_expr logs4/log.json '[e["times_ms"]["proc"] for e in log] == [1.01, 1.01]'
+
+printf "\033[32;1m\n# run tests, some of them being bad, with the streaming master log\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --stream-log\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --stream-log ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+if [ ! -f logs4/log.jsonl ] ; then
+    printf "\033[31;1mmissing: logs4/log.jsonl\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+if [ $(ls logs4/*/*.diff.html | wc -l) -ne 3 ] ; then
+    printf "\033[31;1m*.diff.html count incorrect (expect 3):\n\033[0m"
+    ls logs4/*/*.diff.html
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests that are all good twice, with the result cache\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --cache logs5/cache\n\033[0m"
+rm -rf logs5
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --cache logs5/cache ; exit_code=$?
+check_log_expr logs4/log.json '[e["cached"] for e in log] == [False, False]'
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --cache logs5/cache ; exit_code=$?
+
+if [ $exit_code -ne 0 ]; then
+    printf "\033[31;1mexit code is not 0\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2 2 0"
+check_log_expr logs4/log.json '[e["cached"] for e in log] == [True, True]'
+if [ $(ls logs4/*/*.stdout | wc -l) -ne 2 ] ; then
+    printf "\033[31;1m*.stdout count incorrect (expect 2):\n\033[0m"
+    ls logs4/*/*.stdout
+    has_error=1
+fi
+if ! cmp -s mocks/lorem.gold $(python3 -c 'import json
+print([e for e in json.load(open("logs4/log.json")) if e["id"] == "lorem_2"][0]["stdout"]["actual_file"])') ; then
+    printf "\033[31;1mcached stdout of lorem_2 differs from mocks/lorem.gold\n\033[0m"
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests in two shards, balanced by the run times in a master log\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --shard 1/2 --history logs2/log.json\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs5 --shard 2/2 --history logs2/log.json\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --shard 1/2 --history logs2/log.json
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs5 --shard 2/2 --history logs2/log.json
+
+for log_dir in logs4 logs5 ; do
+    if [ ! -f $log_dir/shard.json ] ; then
+        printf "\033[31;1mmissing: $log_dir/shard.json\n\033[0m"
+        has_error=1
+    fi
+done
+if ! python3 -c 'import json
+shards = [(json.load(open(d + "/shard.json"))["test_ids"],
+           [e["id"] for e in json.load(open(d + "/log.json"))])
+          for d in ["logs4", "logs5"]]
+ids = sorted(shards[0][1] + shards[1][1])
+assert all(sorted(e) == sorted(f) for e, f in shards)
+assert ids == ["lorem_%d" % i for i in range(1, 6)], ids
+' ; then
+    printf "\033[31;1mshards incorrect (expect each test in one shard)\n\033[0m"
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests sequentially, some of them being bad, stopping at the first failure\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 -1 --max-failures 1\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 -1 --max-failures 1 ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+check_log_expr logs4/log.json '[len(e["exceptions"]) > 0 and e["exceptions"][0].startswith("task skipped") for e in log] == [False, False, True, True, True]'
+if [ $(ls logs4/*/*.stdout | wc -l) -ne 2 ] ; then
+    printf "\033[31;1m*.stdout count incorrect (expect 2):\n\033[0m"
+    ls logs4/*/*.stdout
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests that are all good, repeating each until 2 repeats agree\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --repeat 5 --adaptive-repeat 2\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --repeat 5 --adaptive-repeat 2 ; exit_code=$?
+
+if [ $exit_code -ne 0 ]; then
+    printf "\033[31;1mexit code is not 0\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_1,lorem_2,lorem_2 4 0"
+check_log_expr logs4/log.json '[e["repeat"] for e in log] == [{"count": i, "all": 2} for i in (1, 2)] * 2'
+if [ $(ls logs4/*/*.stdout | wc -l) -ne 4 ] ; then
+    printf "\033[31;1m*.stdout count incorrect (expect 4):\n\033[0m"
+    ls logs4/*/*.stdout
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests, some of them being bad, with a memory budget that fits one test\n\033[0m"
+printf "\033[32;1mNUM_WORKERS=4 ./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --mem-budget 1M --history logs2/log.json\n\033[0m"
+NUM_WORKERS=4 ./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --mem-budget 1M --history logs2/log.json ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+# The mock timer reports 1000 KiB, so no two tests should overlap in time.
+check_log_expr logs4/log.json '(lambda spans: all(e[1] <= f[0] for e, f in zip(spans, spans[1:])))(sorted((r["times_ms"]["abs_start"], r["times_ms"]["abs_end"]) for r in log))'
+
+if [ "$(uname)" = "Linux" ] ; then
+    printf "\033[32;1m\n# run tests that are all good, with each worker pinned to a CPU\n\033[0m"
+    printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --pin-cpus\n\033[0m"
+    ./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --pin-cpus ; exit_code=$?
+
+    if [ $exit_code -ne 0 ]; then
+        printf "\033[31;1mexit code is not 0\n\033[0m"
+        has_error=1
+    fi
+    check_log logs4/log.json "lorem_1,lorem_2 2 0"
+    check_log_expr logs4/log.json 'all(e["cpu"] in os.sched_getaffinity(0) for e in log)'
+fi
+
+for engine in thread async ; do
+    printf "\033[32;1m\n# run tests without a timer, one of them being bad, with the $engine engine\n\033[0m"
+    printf "\033[32;1m./score_run.py --timer builtin --meta mocks/meta-builtin-timer.json -g logs4 --engine $engine\n\033[0m"
+    ./score_run.py --timer builtin --meta mocks/meta-builtin-timer.json -g logs4 --engine $engine ; exit_code=$?
+
+    if [ $exit_code -ne 1 ]; then
+        printf "\033[31;1mexit code is not 1\n\033[0m"
+        has_error=1
+    fi
+    check_log logs4/log.json "lorem_1,lorem_2 1 1"
+    check_log_expr logs4/log.json '[e["exit"]["real"] for e in log] == [{"type": "return", "repr": e} for e in (0, 3)]'
+    check_log_expr logs4/log.json 'all(e["times_ms"]["proc"] > 0 and e["maxrss_kb"] > 0 for e in log)'
+    if [ $(ls logs4/*/*.diff.html 2> /dev/null | wc -l) -ne 0 ] ; then
+        printf "\033[31;1m*.diff.html count incorrect (expect 0):\n\033[0m"
+        ls logs4/*/*.diff.html
+        has_error=1
+    fi
+done
+
+printf "\033[32;1m\n# run tests that are all good twice, with a golden file digest manifest\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --golden-manifest logs5/golden.json\n\033[0m"
+rm -rf logs5 && mkdir logs5
+for i in 1 2 ; do
+    ./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4 --golden-manifest logs5/golden.json ; exit_code=$?
+
+    if [ $exit_code -ne 0 ]; then
+        printf "\033[31;1mexit code is not 0\n\033[0m"
+        has_error=1
+    fi
+    check_log logs4/log.json "lorem_1,lorem_2 2 0"
+    check_log_expr logs4/log.json '[e["stdout"]["golden_sha256"] for e in log] == [None, hashlib.sha256(open("mocks/lorem.gold", "rb").read()).hexdigest()]'
+done
+if [ ! -f logs5/golden.json ] ; then
+    printf "\033[31;1mmissing: logs5/golden.json\n\033[0m"
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests, some of them being bad, with the diffs computed in a process pool\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --postprocess-workers 2\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --postprocess-workers 2 ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+check_log_expr logs4/log.json '[e["stdout"]["ok"] for e in log] == [True, False, False, False, True]'
+check_log_expr logs4/log.json 'all(os.path.isfile(e["stdout"]["diff_file"]) for e in log if e["stdout"]["diff_file"])'
+if [ $(ls logs4/*/*.diff.html | wc -l) -ne 3 ] ; then
+    printf "\033[31;1m*.diff.html count incorrect (expect 3):\n\033[0m"
+    ls logs4/*/*.diff.html
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests twice each, some of them being bad, storing identical stdout once\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --repeat 2 --artifacts dedup\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --repeat 2 --artifacts dedup ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_1,lorem_2,lorem_2,lorem_3,lorem_3,lorem_4,lorem_4,lorem_5,lorem_5 2 8"
+# Three distinct stdout: empty, lorem.gold and its tweaked version.
+if [ $(ls logs4/objects/*/* | wc -l) -ne 3 ] ; then
+    printf "\033[31;1mlogs4/objects/*/* count incorrect (expect 3):\n\033[0m"
+    ls logs4/objects/*/*
+    has_error=1
+fi
+check_log_expr logs4/log.json 'all(os.stat(e["stdout"]["actual_file"]).st_nlink > 1 and hashlib.sha256(open(e["stdout"]["actual_file"], "rb").read()).hexdigest() == e["stdout"]["actual_sha256"] for e in log)'
+
+printf "\033[32;1m\n# run tests, some of them being bad, appending the artifacts to pack files\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --artifacts pack\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --artifacts pack ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+if [ $(ls logs4/*/*.stdout logs4/*/*.diff.html 2> /dev/null | wc -l) -ne 0 ] ; then
+    printf "\033[31;1m*.stdout, *.diff.html count incorrect (expect 0, as packed):\n\033[0m"
+    ls logs4/*/*.stdout logs4/*/*.diff.html
+    has_error=1
+fi
+if [ $(ls logs4/packs/*.pack.idx | wc -l) -ne $(ls logs4/packs/*.pack | wc -l) ] ; then
+    printf "\033[31;1m*.pack.idx count incorrect (expect one per *.pack):\n\033[0m"
+    ls logs4/packs
+    has_error=1
+fi
+check_log_expr logs4/log.json 'all(hashlib.sha256(open(p["pack"], "rb").read()[p["offset"]:p["offset"] + p["length"]]).hexdigest() == e["stdout"]["actual_sha256"] for e in log for p in [e["packed"]["stdout"]])'
+
+printf "\033[32;1m./score_ui.py --title \"Mock tests\" --timer mocks/timer.py --log logs4/log.json --to-dir logs4/html --extract-all\n\033[0m"
+./score_ui.py --title "Mock tests" --timer mocks/timer.py --log logs4/log.json --to-dir logs4/html --extract-all ; exit_code=$?
+if [ $exit_code -ne 0 ]; then
+    printf "\033[31;1mexit code is not 0\n\033[0m"
+    has_error=1
+fi
+if [ $(ls logs4/html/artifacts/*.stdout | wc -l) -ne 5 ] ; then
+    printf "\033[31;1mextracted *.stdout count incorrect (expect 5):\n\033[0m"
+    ls logs4/html/artifacts
+    has_error=1
+fi
+if [ $(ls logs4/html/artifacts/*.diff.html | wc -l) -ne 3 ] ; then
+    printf "\033[31;1mextracted *.diff.html count incorrect (expect 3):\n\033[0m"
+    ls logs4/html/artifacts
+    has_error=1
+fi
+
+for compression in gzip:.gz lzma:.xz ; do
+    format=${compression%:*}
+    suffix=${compression#*:}
+    printf "\033[32;1m\n# run tests, some of them being bad, compressing the artifacts with $format\n\033[0m"
+    printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --compress-artifacts $format\n\033[0m"
+    ./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.json -g logs4 --compress-artifacts $format ; exit_code=$?
+
+    if [ $exit_code -ne 1 ]; then
+        printf "\033[31;1mexit code is not 1\n\033[0m"
+        has_error=1
+    fi
+    check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+    if [ $(ls logs4/*/*.stdout$suffix | wc -l) -ne 5 ] ; then
+        printf "\033[31;1m*.stdout$suffix count incorrect (expect 5):\n\033[0m"
+        ls logs4/*/*
+        has_error=1
+    fi
+    if [ $(ls logs4/*/*.diff.html$suffix | wc -l) -ne 3 ] ; then
+        printf "\033[31;1m*.diff.html$suffix count incorrect (expect 3):\n\033[0m"
+        ls logs4/*/*
+        has_error=1
+    fi
+    check_log_expr logs4/log.json 'all(hashlib.sha256((gzip if f.endswith(".gz") else lzma).open(f).read()).hexdigest() == e["stdout"]["actual_sha256"] for e in log for f in [e["stdout"]["actual_file"]])'
+done
+
+printf "\033[32;1m\n# run tests that are all good, replacing a log directory and a symlinked one\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs5/link\n\033[0m"
+rm -rf logs5 && mkdir -p logs5/real && ln -s real logs5/link
+touch logs4/stale logs5/real/stale
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs4
+./score_run.py --timer mocks/timer.py --meta mocks/meta-all-good.json -g logs5/link
+
+for stale_file in logs4/stale logs5/real/stale ; do
+    if [ -e $stale_file ] ; then
+        printf "\033[31;1mshould not exist: $stale_file\n\033[0m"
+        has_error=1
+    fi
+done
+if [ ! -L logs5/link ] || [ ! -f logs5/real/log.json ] ; then
+    printf "\033[31;1mlogs5/link should be a symlink to logs5/real, with log.json\n\033[0m"
+    has_error=1
+fi
+# The previous log directories are deleted in background.
+for i in $(seq 50) ; do
+    if [ $(ls -d .logs4.trash-* logs5/.real.trash-* 2> /dev/null | wc -l) -eq 0 ] ; then
+        break
+    fi
+    sleep 0.1
+done
+if [ $(ls -d .logs4.trash-* logs5/.real.trash-* 2> /dev/null | wc -l) -ne 0 ] ; then
+    printf "\033[31;1mtrash directories count incorrect (expect 0):\n\033[0m"
+    ls -d .logs4.trash-* logs5/.real.trash-*
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests, some of them being bad, read from a JSON lines metadata file\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.jsonl -g logs4\n\033[0m"
+./score_run.py --timer mocks/timer.py --meta mocks/meta-with-error.jsonl -g logs4 ; exit_code=$?
+
+if [ $exit_code -ne 1 ]; then
+    printf "\033[31;1mexit code is not 1\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+if [ $(ls logs4/*/*.diff.html | wc -l) -ne 3 ] ; then
+    printf "\033[31;1m*.diff.html count incorrect (expect 3):\n\033[0m"
+    ls logs4/*/*.diff.html
+    has_error=1
+fi
+
+printf "\033[32;1m\n# run tests without a timer, with the paths read from stdin\n\033[0m"
+printf "\033[32;1mprintf \"mocks/inspectee.py\\\\n\\\\nmocks/inspectee.py\\\\n\" | ./score_run.py --timer builtin --paths-from - -g logs4\n\033[0m"
+printf "mocks/inspectee.py\n\nmocks/inspectee.py\n" | ./score_run.py --timer builtin --paths-from - -g logs4 ; exit_code=$?
+
+if [ $exit_code -ne 0 ]; then
+    printf "\033[31;1mexit code is not 0\n\033[0m"
+    has_error=1
+fi
+check_log logs4/log.json "1,2 2 0"
+check_log_expr logs4/log.json '[e["path"] for e in log] == ["mocks/inspectee.py"] * 2'
+
+printf "\033[32;1m\n# run tests, some of them being bad, with a snapshot of the metadata file\n\033[0m"
+printf "\033[32;1m./score_run.py --timer mocks/timer.py --meta logs5/meta.json -g logs4 --meta-cache logs5/meta-cache\n\033[0m"
+rm -rf logs5 && mkdir logs5 && cp mocks/meta-with-error.json logs5/meta.json
+for i in 1 2 ; do
+    ./score_run.py --timer mocks/timer.py --meta logs5/meta.json -g logs4 --meta-cache logs5/meta-cache ; exit_code=$?
+
+    if [ $exit_code -ne 1 ]; then
+        printf "\033[31;1mexit code is not 1\n\033[0m"
+        has_error=1
+    fi
+    check_log logs4/log.json "lorem_1,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+done
+if [ $(ls logs5/meta-cache/*.snapshot | wc -l) -ne 1 ] ; then
+    printf "\033[31;1mlogs5/meta-cache/*.snapshot count incorrect (expect 1):\n\033[0m"
+    ls logs5/meta-cache
+    has_error=1
+fi
+# The snapshot is not used once the file is changed.
+sed -e 's/lorem_1/lorem_0/' mocks/meta-with-error.json > logs5/meta.json
+./score_run.py --timer mocks/timer.py --meta logs5/meta.json -g logs4 --meta-cache logs5/meta-cache
+check_log logs4/log.json "lorem_0,lorem_2,lorem_3,lorem_4,lorem_5 1 4"
+
 if [ $has_error -ne 1 ] ; then
     printf "\033[32;1m\nSummary: All is fine\n\033[0m"
 else
@@ -11,45 +11,202 @@ if py.major == 2 or (py.major == 3 and py.minor < 7):
     sys.exit("[Error] mininum Python version is 3.7")
 
 import argparse
-import copy
+import asyncio
+import contextlib
 import hashlib
+import itertools
 import json
-import multiprocessing.dummy as mp  # threading wrapped using multiprocessing API
 import os
-import re
+import secrets
 import shutil
 import signal
 import subprocess
+import threading
 import time
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from pylibs import score_utils
 from pylibs.docs import EXPLANATION_STRING
-from pylibs.differ import get_diff_html_str
 from pylibs.flakiness import maybe_parse_flakiness_decls_from_dir
-from pylibs.runner_task_res import generate_result_dict
+from pylibs.runner_task_res import (
+    CompactResult,
+    generate_result_dict,
+    generate_skipped_result_dict,
+)
 from pylibs import rotating_logger
 from pylibs.runner_common import (
     Args,
+    ResultCallback,
     TaskMetadata,
     TaskResult,
+    TaskSpec,
     TaskWorkerArgs,
     TaskEnvKeys,
     TaskExceptions,
+    BUILTIN_TIMER,
     DELIMITER_STR,
     LOG_FILE_BASE,
     NUM_WORKERS_MAX,
+    STREAM_LOG_FILE_BASE,
+)
+from pylibs.runner_artifacts import (
+    ARTIFACTS_DEDUP,
+    ARTIFACTS_MODES,
+    ARTIFACTS_PACK,
+    PACK_WRITER,
+    store_deduplicated,
+)
+from pylibs.runner_builtin_timer import (
+    get_spawn_failure_stats,
+    is_builtin_timer_supported,
+    read_chunks,
+    read_chunks_async,
+    spawn_inspectee,
+    wait_inspectee,
+    wait_inspectee_async,
+)
+from pylibs.runner_cache import ResultCache
+from pylibs.runner_capture import (
+    STDERR_TO_FILE,
+    STDERR_TO_NULL,
+    STDERR_TO_STDOUT,
+    CapturedOutput,
+    OutputCapture,
+    capture_fd,
+    capture_stream,
+    is_same_content,
+    open_stderr_target,
+)
+from pylibs.runner_compress import (
+    COMPRESSION_SUFFIXES,
+    get_compressed_filename,
+)
+from pylibs.runner_dispatch import Dispatcher, TakeStatus
+from pylibs.runner_golden import GoldenManifest
+from pylibs.runner_history import (
+    History,
+    get_expected_times_ms,
+    get_longest_first_order,
+    load_history,
+    predict_makespan_ms,
+    update_history_file,
+)
+from pylibs.runner_log_stream import (
+    StreamLogWriter,
+    iter_sorted_entries,
+    write_master_log,
+    write_master_log_from_stream,
+)
+from pylibs.runner_cpu import (
+    PINNED_CPU,
+    is_cpu_pinning_supported,
+    pinned_for_spawn,
+    select_cpus,
+)
+from pylibs.runner_memory import (
+    get_expected_rss_kb,
+    get_observed_concurrency,
+    parse_mem_size_kb,
+    simulate_concurrency,
+)
+from pylibs.runner_meta_cache import MetadataSnapshot
+from pylibs.runner_metadata import (
+    MetadataError,
+    get_metadata_from_path,
+    iter_checked_metadata,
+    iter_meta_file,
+    iter_paths_file,
+)
+from pylibs.runner_postprocess import POSTPROCESS_POOL, write_diff_html
+from pylibs.runner_reap import move_to_trash, reap_trash
+from pylibs.runner_repeat import AdaptiveRepeat
+from pylibs.runner_remote import (
+    COORDINATOR_TOKEN_ENV,
+    COORDINATOR_TOKEN_FILE_BASE,
+    RemoteProtocolError,
+    coordinator_server,
+    fetch_remote_config,
+    get_coordinator_token,
+    run_worker_slot,
+    save_coordinator_token,
+)
+from pylibs.runner_shard import (
+    SHARD_MANIFEST_FILE_BASE,
+    make_shard_manifest,
+    parse_shard_spec,
+    plan_shard,
 )
 from pylibs.runner_print import (
     print_one_task_realtime_log,
     print_summary_report,
 )
 from pylibs.score_utils import SYS_NAME, err_exit, info_s, error_s
-from pylibs import schema
+
+
+class RunningTimers:
+    """
+    Thread-safe. Each timer is started in a new session, so killing its process
+    group also kills the test it spawned.
+    """
+    def __init__(self):
+        self.lock_ = threading.RLock()  # Reentrant: see sighandler().
+        self.pids_: Set[int] = set()
+        self.killed_ = False
+
+    def add(self, pid: int) -> None:
+        with self.lock_:
+            self.pids_.add(pid)
+            if self.killed_:
+                self._kill(pid)  # Started just after kill_all().
+
+    def remove(self, pid: int) -> None:
+        with self.lock_:
+            self.pids_.discard(pid)
+
+    def kill_all(self) -> None:
+        """
+        Kills the running timers and their tests, and those started later.
+        """
+        with self.lock_:
+            self.killed_ = True
+            for pid in self.pids_:
+                self._kill(pid)
+
+    def is_killed(self) -> bool:
+        with self.lock_:
+            return self.killed_
+
+    @staticmethod
+    def _kill(pid: int) -> None:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass  # Already exited.
+
+
+RUNNING_TIMERS = RunningTimers()
+
+
+# Raised by run_one_task() if the timer is killed by RUNNING_TIMERS.kill_all().
+class TaskCancelled(Exception):
+    pass
 
 
 def sighandler(sig, frame):  # pylint: disable=unused-argument
+    # The timers are not in our process group, so they don't get the signal.
+    RUNNING_TIMERS.kill_all()
     sys.exit(2)  # Do not print: it's ugly if all workers print simultaneously.
 
 
@@ -59,51 +216,119 @@ signal.signal(signal.SIGABRT, sighandler)  # type: ignore
 signal.signal(signal.SIGSEGV, sighandler)  # type: ignore
 
 
-def get_metadata_from_path(test_id: str, path: str) -> Dict[str, Any]:
-    return {  # Docs: see pylibs.docs.EXPLANATION_STRING.
-        "id": test_id, "path": path, "args": [], "envs": None, "prefix": [],
-        "golden": None, "timeout_ms": None,
-        "exit": {"type": "return", "repr": 0}
-    }
-
-
-# Run mp.Pool.map()
-# NOTE The try-except block is to handle KeyboardInterrupt cleanly to fix a flaw
-# in Python: KeyboardInterrupt cannot cleanly kill mp.Pool()'s child processes,
-# printing verbosely: https://stackoverflow.com/a/6191991/8385554
-# NOTE Each 'func' has to ignore SIGINT for the aforementioned fix to work.
+# Run the tasks with a pool of worker threads, each taking tasks from the
+# dispatcher until there is none left. If slot_cpus is given, the processes
+# each worker spawns are pinned to its CPU.
 def pool_map(
     num_workers: int,
     func: Callable[[TaskWorkerArgs], TaskResult],
     inputs: List[TaskWorkerArgs],
-) -> List[TaskResult]:
-    with rotating_logger.logging_server():
-        pool = mp.Pool(num_workers)
-        try:
-            results: List[TaskResult] = pool.map(func, inputs)
-        except KeyboardInterrupt:
-            pool.terminate()
-            pool.join()
-            err_exit("Process pool terminated and child processes joined")
-        pool.close()
-        pool.join()
-        # This should be called after worker threads are joined to avoid
-        # race condition. We don't send a clear command via socket, because
-        # that may arrive at the socket after the logging server is closed.
-        rotating_logger.clear_all_transient_logs()
-        return results
+    dispatcher: Dispatcher,
+    slot_cpus: Optional[List[int]] = None,
+) -> None:
+    def worker_loop(slot: int) -> None:
+        if slot_cpus:  # Each thread has its own context.
+            PINNED_CPU.set(slot_cpus[slot])
+        while True:
+            i = dispatcher.take()
+            if i == None:
+                return
+            try:
+                result = func(inputs[i])
+            except TaskCancelled:
+                continue  # The run is stopped.
+            except BaseException as e:  # pylint: disable=broad-except
+                # The timers are in their own sessions, so they would outlive
+                # the run.
+                RUNNING_TIMERS.kill_all()
+                dispatcher.fail(e)  # Re-raised in the main thread.
+                return
+            dispatcher.finish(i, result)
+
+    # Daemon threads: if the run is aborted, the process exits without them.
+    threads = [
+        threading.Thread(target=worker_loop, args=(slot,), daemon=True)
+        for slot in range(num_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    dispatcher.wait()
+    for thread in threads:
+        thread.join()
+
+
+# The asyncio counterpart of pool_map(): all children are spawned and reaped
+# by one event loop, instead of one blocked OS thread per child. Each of the
+# num_workers coroutines runs one task at a time. The results are passed to
+# the dispatcher in other threads, as on_result() blocks on writing the log
+# and the cache.
+def async_map(
+    num_workers: int,
+    func: Callable[[TaskWorkerArgs], Awaitable[TaskResult]],
+    inputs: List[TaskWorkerArgs],
+    dispatcher: Dispatcher,
+    slot_cpus: Optional[List[int]] = None,
+) -> None:
+    async def worker_loop(slot: int, wakeup: asyncio.Event) -> None:
+        if slot_cpus:  # Each coroutine is run in an asyncio task, with its
+            PINNED_CPU.set(slot_cpus[slot])  # own copy of the context.
+        while True:
+            wakeup.clear()  # Before try_take(), so no wakeup is missed.
+            status, i = dispatcher.try_take()
+            if status == TakeStatus.DONE:
+                return
+            if status == TakeStatus.WAIT:
+                await wakeup.wait()
+                continue
+            try:
+                result = await func(inputs[i])
+            except TaskCancelled:
+                continue  # The run is stopped.
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:  # pylint: disable=broad-except
+                # As in pool_map(): the other coroutines see the run is over
+                # once their killed timers exit.
+                RUNNING_TIMERS.kill_all()
+                dispatcher.fail(e)  # Re-raised by dispatcher.wait().
+                return
+            await asyncio.get_running_loop().run_in_executor(
+                None, dispatcher.finish, i, result)
+
+    async def run_all_async() -> None:
+        maybe_use_pidfd_child_watcher()
+        loop = asyncio.get_running_loop()
+        wakeups = [asyncio.Event() for _ in range(num_workers)]
+
+        def wake_up_all() -> None:  # Called in any thread.
+            try:
+                loop.call_soon_threadsafe(lambda: [e.set() for e in wakeups])
+            except RuntimeError:
+                pass  # The loop is closed.
 
+        dispatcher.subscribe(wake_up_all)
+        await asyncio.gather(
+            *[worker_loop(slot, e) for slot, e in enumerate(wakeups)])
 
-def split_ctimer_out(s: str) -> Tuple[str, str]:
-    ctimer_begin_index = s.find(DELIMITER_STR)
-    if ctimer_begin_index == -1:
-        raise RuntimeError("beginning delimiter of ctimer stats not found")
-    inspectee_stdout = s[:ctimer_begin_index]
-    report_end_index = s.rfind(DELIMITER_STR)
-    if report_end_index == -1:
-        raise RuntimeError("end delimiter of ctimer stats not found")
-    ctimer_stdout = s[ctimer_begin_index + len(DELIMITER_STR):report_end_index]
-    return inspectee_stdout.rstrip(), ctimer_stdout.rstrip()
+    asyncio.run(run_all_async())
+    dispatcher.wait()
+
+
+def maybe_use_pidfd_child_watcher() -> None:
+    # Before Python 3.12, asyncio reaps each child with a dedicated thread
+    # blocked in waitpid() (ThreadedChildWatcher), which is what this engine
+    # tries to avoid. Where pidfd is supported (Linux 5.3+), let the event loop
+    # itself be notified of child exits. Python 3.12+ does this by default.
+    if sys.version_info >= (3, 12) or not hasattr(asyncio,
+                                                  "PidfdChildWatcher"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return
+    watcher = asyncio.PidfdChildWatcher()
+    asyncio.set_child_watcher(watcher)
+    watcher.attach_loop(asyncio.get_running_loop())
 
 
 def compute_hashed_id(prog: Path, id_name: str) -> str:
@@ -140,32 +365,18 @@ def create_dir_if_needed(dirname: str) -> None:
 
 
 # Can be used concurrently.
-def write_file(filename: str,
-               s: str,
-               assert_str_non_empty: bool = False) -> None:
-    assert s != None
-    if assert_str_non_empty:
-        assert s != ""
-    create_dir_if_needed(os.path.dirname(filename))
-    with open(filename, 'w') as f:
-        f.write(s)
-
-
-def process_inspectee_stdout(s: str) -> str:
-    return re.sub(r"\x1b\[.*?m", "", s)  # Remove color sequences.
-
-
 def did_run_one_task(
     log_dirname: str,
     write_golden: bool,
+    compression: Optional[str],
+    diff_context: Optional[int],
     metadata: TaskMetadata,
-    inspectee_stdout: str,
-    ctimer_stdout: str,
+    captured: CapturedOutput,
+    stderr_filename: Optional[str],
+    ctimer_dict: Dict[str, Any],
     start_abs_time: float,
     end_abs_time: float,
 ) -> TaskResult:
-    assert len(ctimer_stdout) > 0
-    ctimer_dict: Dict[str, Any] = json.loads(ctimer_stdout)
     match_exit: bool = \
         (metadata["exit"]["type"] == ctimer_dict["exit"]["type"]
          and metadata["exit"]["repr"] == ctimer_dict["exit"]["repr"])
@@ -174,99 +385,392 @@ def did_run_one_task(
         metadata["hashed_id"], metadata["repeat"]["count"], log_dirname)
     stdout_filename = None
     if not write_golden:
-        stdout_filename = os.path.abspath(filepath_stem + ".stdout")
+        # Already written by the capture, see open_stdout_capture().
+        stdout_filename = captured.filename
+        if captured.truncated:
+            exceptions.append(TaskExceptions.STDOUT_TRUNCATED)
     # diff_filename will be set with a str later if there is need to compare
     # and diff is found.
     diff_filename = None
-    if stdout_filename:
-        assert not write_golden
-        write_file(stdout_filename, inspectee_stdout)  # stdout could be ""
+    golden_written = False
     if metadata["golden"] != None:  # Write golden or compare stdout with it.
         golden_filename = metadata["golden"]
         if write_golden:  # Write stdout to golden.
             if not match_exit:
                 exceptions.append(TaskExceptions.GOLDEN_NOT_WRITTEN_WRONG_EXIT)
+            elif captured.truncated:
+                exceptions.append(TaskExceptions.GOLDEN_NOT_WRITTEN_TRUNCATED)
+            elif captured.same_as_golden or (
+                    os.path.isfile(golden_filename)
+                    and is_same_content(golden_filename, captured.filename)):
+                exceptions.append(
+                    TaskExceptions.GOLDEN_NOT_WRITTEN_SAME_CONTENT)
             else:
-                golden_exists_and_same = False
-                if os.path.isfile(golden_filename):
-                    with open(golden_filename, 'r') as f:
-                        if f.read() == inspectee_stdout:
-                            golden_exists_and_same = True
-                            exceptions.append(
-                                TaskExceptions.GOLDEN_NOT_WRITTEN_SAME_CONTENT)
-                if not golden_exists_and_same:
-                    write_file(golden_filename,
-                               inspectee_stdout)  # The stdout could be "".
-        else:  # Compare stdout with golden.
+                create_dir_if_needed(os.path.dirname(golden_filename))
+                shutil.copyfile(captured.filename,
+                                golden_filename)  # The stdout could be "".
+                golden_written = True
+        elif not captured.same_as_golden:  # Compare stdout with golden,
+            # unless found byte-equal while captured.
             assert stdout_filename
-            found_golden, stdout_comparison_diff = get_diff_html_str(
-                html_title=filepath_stem.split(os.sep)[-1],
-                desc=metadata["id"],
-                expected_filename=golden_filename,
-                actual_filename=stdout_filename,
-            )
+            diff_filename = get_compressed_filename(
+                os.path.abspath(filepath_stem + ".diff.html"), compression)
+            # By a process of '--postprocess-workers', if any.
+            found_golden, diff_written = POSTPROCESS_POOL.run(
+                write_diff_html, filepath_stem.split(os.sep)[-1],
+                metadata["id"], golden_filename, stdout_filename,
+                diff_filename, diff_context)
             if not found_golden:
                 exceptions.append(TaskExceptions.GOLDEN_FILE_MISSING)
-            if stdout_comparison_diff != None:  # Write if diff is non-empty.
-                diff_filename = os.path.abspath(filepath_stem + ".diff.html")
-                write_file(diff_filename,
-                           stdout_comparison_diff,
-                           assert_str_non_empty=True)
-    return generate_result_dict(metadata, ctimer_dict, match_exit, write_golden,
-                                start_abs_time, end_abs_time, stdout_filename,
-                                diff_filename, exceptions)
+            if not diff_written:  # Written only if diff is non-empty.
+                diff_filename = None
+    if write_golden:
+        os.remove(captured.filename)  # Temporary, see open_stdout_capture().
+    golden_sha256 = metadata.get("golden_sha256")  # By '--golden-manifest'.
+    if captured.same_as_golden or golden_written:
+        golden_sha256 = captured.sha256
+    return generate_result_dict(metadata,
+                                ctimer_dict,
+                                match_exit,
+                                write_golden,
+                                start_abs_time,
+                                end_abs_time,
+                                stdout_filename,
+                                diff_filename,
+                                exceptions,
+                                stderr_filename=stderr_filename,
+                                stdout_sha256=captured.sha256,
+                                golden_sha256=golden_sha256)
+
+
+# The capture of the test's stdout, see runner_capture. It's written to the
+# stdout file in the log directory, compressed if '--compress-artifacts', or,
+# if writing golden files, to a temporary file directly under the log
+# directory, which exists; either way, it's compared with the golden file, if
+# any, as it's written.
+def open_stdout_capture(log_dirname: str, write_golden: bool,
+                        delimiter: Optional[str],
+                        max_output_bytes: Optional[int],
+                        compression: Optional[str],
+                        metadata: TaskMetadata) -> OutputCapture:
+    if write_golden:
+        filename = os.path.abspath(
+            Path(log_dirname, "%s-%d.stdout.tmp" %
+                 (metadata["hashed_id"], metadata["repeat"]["count"])))
+    else:
+        filename = get_compressed_filename(
+            os.path.abspath(
+                get_logfile_path_stem(metadata["hashed_id"],
+                                      metadata["repeat"]["count"],
+                                      log_dirname) + ".stdout"), compression)
+        create_dir_if_needed(os.path.dirname(filename))
+    return OutputCapture(filename, delimiter, max_output_bytes,
+                         metadata["golden"], metadata.get("golden_sha256"))
+
+
+# The file to write the test's stderr to (see '--separate-stderr'), or None.
+def get_stderr_filename(stderr_mode: str, log_dirname: str,
+                        metadata: TaskMetadata) -> Optional[str]:
+    if stderr_mode != STDERR_TO_FILE:
+        return None
+    filename = os.path.abspath(
+        get_logfile_path_stem(metadata["hashed_id"], metadata["repeat"]["count"],
+                              log_dirname) + ".stderr")
+    create_dir_if_needed(os.path.dirname(filename))
+    return filename
 
 
 # Used by run_all()
 def remove_prev_log(log_dir: str) -> None:
-    if os.path.isdir(log_dir):
+    # If log_dir is a symlink, the directory it points to is replaced.
+    real_log_dir = os.path.realpath(log_dir)
+    if os.path.isdir(real_log_dir):
         # To prevent perplexing cases e.g. master log says all is good, but
-        # *.diff files from a previous run exist.
-        shutil.rmtree(log_dir)
-    elif os.path.exists(log_dir):
+        # *.diff files from a previous run exist. Deleting a big log directory
+        # takes long, so it's moved away and deleted in background.
+        if move_to_trash(real_log_dir) == None:
+            shutil.rmtree(real_log_dir)
+    elif os.path.exists(real_log_dir):
         err_exit(error_s("path exists as a non-directory: %s" % log_dir))
+    if os.path.islink(log_dir):
+        create_dir_if_needed(real_log_dir)  # Not created through the symlink.
+    reap_trash(log_dir)  # Also that left by previous runs.
 
 
 # Used by run_one()
-def run_one_task_impl(timer: str, also_stderr: bool, log_dirname: str,
-                      write_golden: bool, env_values: Dict[str, str],
-                      metadata: TaskMetadata) -> TaskResult:
-    # The return code of the timer program is guaranteed to be 0
-    # unless the timer itself has errors.
-    try:
-        start_abs_time = time.time()
-        # NOTE We have to spawn timer and let timer spawn the program,
-        # instead of directly spawning the program while using preexec_fn
-        # to set the timeout, because (1) Python's signal.setitimer() and
-        # resource.getrusage() do not measure time as accurate as the timer
-        # written in C++ [1], (2) moreover, preexec_fn is not thread-safe:
-        # https://docs.python.org/3/library/subprocess.html
-        # [1] I wrote a Python program to verify this. I set the timeout
-        #     to be 10 msec and give it a infinite-loop program, when it
-        #     times out the reported time usage is 14 msec, way over 10.
-        o = subprocess.check_output(
-            [timer] + metadata["prefix"] + [metadata["path"]] +
-            metadata["args"],
-            stderr=subprocess.STDOUT if also_stderr else subprocess.DEVNULL,
-            env=env_values)
-        stdout = o.decode(errors="backslashreplace").rstrip()
-        end_abs_time = time.time()
-    except subprocess.CalledProcessError as e:
-        # The code path signals an internal error of the timer (see '--docs').
-        raise RuntimeError("Internal error (exit %d): %s" %
-                           (e.returncode, e.cmd))
-    inspectee_stdout_raw, ctimer_stdout = split_ctimer_out(stdout)
-    inspectee_stdout = process_inspectee_stdout(inspectee_stdout_raw)
-    one_task_result: TaskResult = did_run_one_task(
+def make_task_command(timer: str, metadata: TaskMetadata) -> List[str]:
+    return [timer] + make_task_command_builtin(metadata)
+
+
+# Used by run_one() for '--timer builtin'
+def make_task_command_builtin(metadata: TaskMetadata) -> List[str]:
+    return metadata["prefix"] + [metadata["path"]] + metadata["args"]
+
+
+# Used by run_one()
+def finish_one_task(log_dirname: str, write_golden: bool,
+                    compression: Optional[str], diff_context: Optional[int],
+                    metadata: TaskMetadata,
+                    captured: CapturedOutput,
+                    stderr_filename: Optional[str],
+                    stats_filename: Optional[str], start_abs_time: float,
+                    end_abs_time: float) -> TaskResult:
+    ctimer_dict = read_stats_file(stats_filename) if stats_filename else None
+    if ctimer_dict == None:  # '--timer-stats delimiter', or the timer ignored
+        # CTIMER_STATS: the capture split the stats report from the stdout.
+        if captured.stats_report == None:
+            raise RuntimeError("beginning delimiter of ctimer stats not found")
+        assert len(captured.stats_report) > 0
+        ctimer_dict = json.loads(captured.stats_report)
+    return did_run_one_task(
         log_dirname,
         write_golden,
+        compression,
+        diff_context,
         metadata,
-        inspectee_stdout,
-        ctimer_stdout,
+        captured,
+        stderr_filename,
+        ctimer_dict,
         start_abs_time,
         end_abs_time,
     )
-    return one_task_result
+
+
+# Returns the stats report written by the timer, or None if it's not written,
+# as older timers don't support CTIMER_STATS. The file is removed.
+def read_stats_file(stats_filename: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(stats_filename, 'r') as f:
+            report = f.read()
+        os.remove(stats_filename)
+    except FileNotFoundError:
+        return None
+    return json.loads(report) if report.strip() else None
+
+
+# The file for the timer to write the stats report to (see '--timer-stats'),
+# or None if the stats report is to be printed to stdout. It's directly under
+# the log directory, which exists, and is removed once read.
+def get_stats_filename(timer: str, timer_stats: str, log_dirname: str,
+                       metadata: TaskMetadata) -> Optional[str]:
+    if timer == BUILTIN_TIMER or timer_stats != "file":
+        return None
+    return os.path.abspath(
+        Path(log_dirname, "%s-%d.stats.json" %
+             (metadata["hashed_id"], metadata["repeat"]["count"])))
+
+
+# The delimiter for the timer to print around the stats report, or None if the
+# stdout is the inspectee's alone. With '--timer-stats file', the timer prints
+# it only if it doesn't support CTIMER_STATS; it's made unique, so the test's
+# stdout can't be mistaken for the stats report.
+def get_task_delimiter(timer: str, timer_stats: str) -> Optional[str]:
+    if timer == BUILTIN_TIMER:
+        return None
+    if timer_stats == "file":
+        return "%s%s%s" % (DELIMITER_STR, secrets.token_hex(8), DELIMITER_STR)
+    return DELIMITER_STR
+
+
+# Used by run_one()
+def run_one_task_impl(timer: str, stderr_mode: str,
+                      max_output_bytes: Optional[int],
+                      compression: Optional[str], diff_context: Optional[int],
+                      log_dirname: str, write_golden: bool,
+                      env_values: Dict[str, str],
+                      delimiter: Optional[str], stats_filename: Optional[str],
+                      metadata: TaskMetadata) -> TaskResult:
+    if timer == BUILTIN_TIMER:
+        return run_one_task_impl_builtin(stderr_mode, max_output_bytes,
+                                         compression, diff_context,
+                                         log_dirname, write_golden,
+                                         env_values, metadata)
+    # The return code of the timer program is guaranteed to be 0
+    # unless the timer itself has errors.
+    start_abs_time = time.time()
+    # NOTE We have to spawn timer and let timer spawn the program,
+    # instead of directly spawning the program while using preexec_fn
+    # to set the timeout, because (1) Python's signal.setitimer() and
+    # resource.getrusage() do not measure time as accurate as the timer
+    # written in C++ [1], (2) moreover, preexec_fn is not thread-safe:
+    # https://docs.python.org/3/library/subprocess.html
+    # [1] I wrote a Python program to verify this. I set the timeout
+    #     to be 10 msec and give it a infinite-loop program, when it
+    #     times out the reported time usage is 14 msec, way over 10.
+    # ('--timer builtin' sets the timeout without preexec_fn, see
+    # run_one_task_impl_builtin(), but the limit is in whole seconds.)
+    cmd = make_task_command(timer, metadata)
+    stderr_filename = get_stderr_filename(stderr_mode, log_dirname, metadata)
+    with open_stdout_capture(log_dirname, write_golden, delimiter,
+                             max_output_bytes, compression,
+                             metadata) as capture:
+        with open_stderr_target(stderr_mode, stderr_filename) as stderr, \
+                pinned_for_spawn(PINNED_CPU.get()):
+            proc = subprocess.Popen(cmd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=stderr,
+                                    env=env_values,
+                                    start_new_session=True)
+        with proc:
+            RUNNING_TIMERS.add(proc.pid)
+            try:
+                capture_fd(proc.stdout.fileno(), capture)
+                proc.wait()
+            finally:
+                RUNNING_TIMERS.remove(proc.pid)
+        end_abs_time = time.time()
+        check_timer_returncode(proc.returncode, cmd)
+        captured = capture.finish()
+    result = finish_one_task(log_dirname, write_golden, compression,
+                             diff_context, metadata, captured, stderr_filename,
+                             stats_filename, start_abs_time, end_abs_time)
+    result["cpu"] = PINNED_CPU.get()
+    return result
+
+
+# Used by run_one_async()
+async def run_one_task_impl_async(timer: str, stderr_mode: str,
+                                  max_output_bytes: Optional[int],
+                                  compression: Optional[str],
+                                  diff_context: Optional[int],
+                                  log_dirname: str, write_golden: bool,
+                                  env_values: Dict[str, str],
+                                  delimiter: Optional[str],
+                                  stats_filename: Optional[str],
+                                  metadata: TaskMetadata) -> TaskResult:
+    # Same as run_one_task_impl(), except that waiting for the child's exit
+    # and its stdout EOF is done by the event loop, not by a blocked thread.
+    if timer == BUILTIN_TIMER:
+        return await run_one_task_impl_builtin_async(stderr_mode,
+                                                     max_output_bytes,
+                                                     compression, diff_context,
+                                                     log_dirname, write_golden,
+                                                     env_values, metadata)
+    start_abs_time = time.time()
+    cmd = make_task_command(timer, metadata)
+    cpu = PINNED_CPU.get()
+    stderr_filename = get_stderr_filename(stderr_mode, log_dirname, metadata)
+    with open_stdout_capture(log_dirname, write_golden, delimiter,
+                             max_output_bytes, compression,
+                             metadata) as capture:
+        # The child is forked before the coroutine is first suspended, so
+        # other tasks can't spawn theirs with this CPU pinning.
+        with open_stderr_target(stderr_mode, stderr_filename) as stderr, \
+                pinned_for_spawn(cpu):
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                env=env_values,
+                start_new_session=True)
+        RUNNING_TIMERS.add(proc.pid)
+        try:
+            await capture_stream(proc.stdout, capture)
+            await proc.wait()
+        finally:
+            RUNNING_TIMERS.remove(proc.pid)
+        end_abs_time = time.time()
+        check_timer_returncode(proc.returncode, cmd)
+        captured = capture.finish()
+    # Not in the event loop's thread: the diff takes long if the files are
+    # large, even if it's done by '--postprocess-workers'.
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, finish_one_task, log_dirname, write_golden, compression,
+        diff_context,
+        metadata, captured, stderr_filename, stats_filename, start_abs_time,
+        end_abs_time)
+    result["cpu"] = cpu
+    return result
+
+
+# Used by run_one_task_impl() for '--timer builtin', where the stdout is the
+# inspectee's alone, and the stats are from runner_builtin_timer.
+def run_one_task_impl_builtin(stderr_mode: str,
+                              max_output_bytes: Optional[int],
+                              compression: Optional[str],
+                              diff_context: Optional[int], log_dirname: str,
+                              write_golden: bool,
+                              env_values: Dict[str, str],
+                              metadata: TaskMetadata) -> TaskResult:
+    start_abs_time = time.time()
+    cmd = make_task_command_builtin(metadata)
+    stderr_filename = get_stderr_filename(stderr_mode, log_dirname, metadata)
+    with open_stdout_capture(log_dirname, write_golden, None, max_output_bytes,
+                             compression, metadata) as capture:
+        try:
+            with pinned_for_spawn(PINNED_CPU.get()):
+                pid, stdout_fd = spawn_inspectee(
+                    cmd, env_values, stderr_mode == STDERR_TO_STDOUT,
+                    stderr_filename, metadata["timeout_ms"])
+        except OSError:
+            stats = get_spawn_failure_stats()
+        else:
+            RUNNING_TIMERS.add(pid)
+            try:
+                read_chunks(stdout_fd, capture.feed)
+                stats = wait_inspectee(pid, metadata["timeout_ms"])
+            finally:
+                RUNNING_TIMERS.remove(pid)
+        end_abs_time = time.time()
+        if RUNNING_TIMERS.is_killed():
+            raise TaskCancelled()
+        captured = capture.finish()
+    result = did_run_one_task(log_dirname, write_golden, compression,
+                              diff_context, metadata, captured,
+                              stderr_filename, stats, start_abs_time,
+                              end_abs_time)
+    result["cpu"] = PINNED_CPU.get()
+    return result
+
+
+# Used by run_one_task_impl_async() for '--timer builtin'.
+async def run_one_task_impl_builtin_async(stderr_mode: str,
+                                          max_output_bytes: Optional[int],
+                                          compression: Optional[str],
+                                          diff_context: Optional[int],
+                                          log_dirname: str, write_golden: bool,
+                                          env_values: Dict[str, str],
+                                          metadata: TaskMetadata) -> TaskResult:
+    start_abs_time = time.time()
+    cmd = make_task_command_builtin(metadata)
+    cpu = PINNED_CPU.get()
+    stderr_filename = get_stderr_filename(stderr_mode, log_dirname, metadata)
+    with open_stdout_capture(log_dirname, write_golden, None, max_output_bytes,
+                             compression, metadata) as capture:
+        try:
+            with pinned_for_spawn(cpu):
+                pid, stdout_fd = spawn_inspectee(
+                    cmd, env_values, stderr_mode == STDERR_TO_STDOUT,
+                    stderr_filename, metadata["timeout_ms"])
+        except OSError:
+            stats = get_spawn_failure_stats()
+        else:
+            RUNNING_TIMERS.add(pid)
+            try:
+                await read_chunks_async(stdout_fd, capture.feed)
+                stats = await wait_inspectee_async(pid, metadata["timeout_ms"])
+            finally:
+                RUNNING_TIMERS.remove(pid)
+        end_abs_time = time.time()
+        if RUNNING_TIMERS.is_killed():
+            raise TaskCancelled()
+        captured = capture.finish()
+    # Not in the event loop's thread, see run_one_task_impl_async().
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, did_run_one_task, log_dirname, write_golden, compression,
+        diff_context, metadata, captured, stderr_filename, stats,
+        start_abs_time, end_abs_time)
+    result["cpu"] = cpu
+    return result
+
+
+def check_timer_returncode(returncode: int, cmd: List[str]) -> None:
+    if returncode == 0:
+        return
+    if RUNNING_TIMERS.is_killed():
+        raise TaskCancelled()
+    # The code path signals an internal error of the timer (see '--docs').
+    raise RuntimeError("Internal error (exit %d): %s" % (returncode, cmd))
 
 
 def get_platform_dependent_envs():
@@ -289,95 +793,615 @@ def get_platform_dependent_envs():
 PLATFORM_DEPENDENT_ENVS = get_platform_dependent_envs()
 
 
-def run_one_task(input_args: TaskWorkerArgs) -> TaskResult:
-    timer, also_stderr, log_dirname, write_golden, metadata = input_args
-    env_values = PLATFORM_DEPENDENT_ENVS
-    env_values.update({
-        TaskEnvKeys.CTIMER_DELIMITER_ENVKEY.value: DELIMITER_STR,
-        TaskEnvKeys.CTIMER_TIMEOUT_ENVKEY.value: score_utils.get_timeout(
-            metadata["timeout_ms"]),
-    })
+def make_task_envs(timer: str, delimiter: Optional[str],
+                   stats_filename: Optional[str],
+                   metadata: TaskMetadata) -> Dict[str, str]:
+    # Copy, as the same dict is shared by all tasks (and all worker threads).
+    env_values = dict(PLATFORM_DEPENDENT_ENVS)
+    if timer != BUILTIN_TIMER:  # Otherwise, there is no timer to talk to.
+        # CTIMER_DELIMITER is set even if CTIMER_STATS is, in case the timer
+        # doesn't support the latter.
+        env_values.update({
+            TaskEnvKeys.CTIMER_DELIMITER_ENVKEY.value: delimiter,
+            TaskEnvKeys.CTIMER_TIMEOUT_ENVKEY.value: score_utils.get_timeout(
+                metadata["timeout_ms"]),
+        })
+    if stats_filename:
+        env_values[TaskEnvKeys.CTIMER_STATS_ENVKEY.value] = stats_filename
     if metadata["envs"] != None:
         env_values.update(metadata["envs"])
+    return env_values
+
+
+def run_one_task(input_args: TaskWorkerArgs) -> TaskResult:
+    (timer, timer_stats, stderr_mode, max_output_bytes, compression,
+     diff_context, artifacts_mode, log_dirname, write_golden,
+     metadata) = input_args
+    delimiter = get_task_delimiter(timer, timer_stats)
+    stats_filename = get_stats_filename(timer, timer_stats, log_dirname,
+                                        metadata)
     one_task_result = run_one_task_impl(
         timer,
-        also_stderr,
+        stderr_mode,
+        max_output_bytes,
+        compression,
+        diff_context,
         log_dirname,
         write_golden,
-        env_values,
+        make_task_envs(timer, delimiter, stats_filename, metadata),
+        delimiter,
+        stats_filename,
         metadata,
     )
+    store_task_artifacts(artifacts_mode, log_dirname, one_task_result)
     print_one_task_realtime_log(metadata, one_task_result)
     return one_task_result
 
 
+async def run_one_task_async(input_args: TaskWorkerArgs) -> TaskResult:
+    (timer, timer_stats, stderr_mode, max_output_bytes, compression,
+     diff_context, artifacts_mode, log_dirname, write_golden,
+     metadata) = input_args
+    delimiter = get_task_delimiter(timer, timer_stats)
+    stats_filename = get_stats_filename(timer, timer_stats, log_dirname,
+                                        metadata)
+    one_task_result = await run_one_task_impl_async(
+        timer,
+        stderr_mode,
+        max_output_bytes,
+        compression,
+        diff_context,
+        log_dirname,
+        write_golden,
+        make_task_envs(timer, delimiter, stats_filename, metadata),
+        delimiter,
+        stats_filename,
+        metadata,
+    )
+    # Not in the event loop's thread: packing copies the files.
+    await asyncio.get_running_loop().run_in_executor(None,
+                                                     store_task_artifacts,
+                                                     artifacts_mode,
+                                                     log_dirname,
+                                                     one_task_result)
+    print_one_task_realtime_log(metadata, one_task_result)
+    return one_task_result
+
+
+# Stores the task's artifacts per '--artifacts', see runner_artifacts.
+def store_task_artifacts(artifacts_mode: str, log_dirname: str,
+                         result: TaskResult) -> None:
+    if artifacts_mode == ARTIFACTS_DEDUP:
+        sha256 = result["stdout"].get("actual_sha256")  # Not in older caches.
+        if result["stdout"]["actual_file"] != None and sha256 != None:
+            store_deduplicated(log_dirname, result["stdout"]["actual_file"],
+                               sha256)
+    elif artifacts_mode == ARTIFACTS_PACK:
+        result["packed"] = {
+            key: PACK_WRITER.append(log_dirname, filename)
+            for key, filename in (("stdout", result["stdout"]["actual_file"]),
+                                  ("diff", result["stdout"]["diff_file"]),
+                                  ("stderr", result["stderr_file"]))
+            if filename != None
+        }
+
+
+# history: loaded from args.history, written after run if update_history.
+# shard_manifest: written in the log directory if not None.
+# feed: if given, the tasks are read from it while they run, and appended to
+# metadata_list, which is given empty (see can_stream_tasks()).
 def run_all(
     args: Args,
     metadata_list: List[TaskMetadata],
     unique_count: int,
+    history: History,
+    update_history: bool,
+    shard_manifest: Optional[Dict[str, Any]],
+    feed: Optional[Iterator[TaskMetadata]] = None,
 ) -> int:
     remove_prev_log(args.log)
     num_tasks = len(metadata_list)  # >= unique_count, because of repeating
-    num_workers = 1 if args.sequential else min(num_tasks, NUM_WORKERS_MAX)
-    sys.stderr.write(
-        info_s("task count: %d (unique: %d), worker count: %d" %
-               (num_tasks, unique_count, num_workers)))
-    run_tests_start_time = time.time()
-    result_list: List[TaskResult] = pool_map(
-        num_workers, run_one_task,
-        [(args.timer, args.also_stderr, args.log, args.write_golden, metadata)
-         for metadata in metadata_list])
+    cache = None
+    if args.cache:
+        cache = ResultCache(
+            Path(args.cache), args.timer, {
+                "timer_stats": args.timer_stats,
+                "stderr_mode": args.stderr_mode,
+                "max_output_bytes": args.max_output_bytes,
+            })
+    golden_manifest = None
+    if args.golden_manifest:
+        golden_manifest = GoldenManifest(Path(args.golden_manifest))
+        set_golden_digests(golden_manifest, metadata_list)
+        golden_manifest.save()
+    predicted_makespan_sec: Optional[float] = None
+    result_count = 0  # < num_tasks if some repeats are not run.
+
+    def run(write_result: ResultCallback) -> int:
+        nonlocal predicted_makespan_sec
+
+        def on_result(i: int, result: TaskResult) -> None:
+            nonlocal result_count
+            result_count += 1
+            write_result(i, result)
+
+        if feed != None:
+            num_workers = 1 if args.sequential else NUM_WORKERS_MAX
+            if args.slot_cpus:
+                num_workers = min(num_workers, len(args.slot_cpus))
+            sys.stderr.write(
+                info_s("task count: streamed from the metadata, "
+                       "worker count: %d (%s)" % (num_workers, args.engine)))
+            return run_tasks(args, num_workers, metadata_list, [], None,
+                             on_result, feed)
+        indexes_to_run = list(range(num_tasks))
+        if cache:
+            indexes_to_run = emit_cached_results(cache, metadata_list,
+                                                 args.compress_artifacts,
+                                                 args.artifacts, args.log,
+                                                 on_result)
+            on_result = make_caching_callback(cache, metadata_list, on_result)
+        num_workers = 1 if args.sequential else max(
+            1, min(len(indexes_to_run), NUM_WORKERS_MAX))
+        pinning_info = ""
+        if args.slot_cpus:
+            num_workers = min(num_workers, len(args.slot_cpus))
+            pinning_info = ", pinned to CPU %s" % ",".join(
+                map(str, args.slot_cpus[:num_workers]))
+        sys.stderr.write(
+            info_s("task count: %d (unique: %d, cached: %d), "
+                   "worker count: %d (%s%s)" %
+                   (num_tasks, unique_count, num_tasks - len(indexes_to_run),
+                    num_workers, args.engine, pinning_info)))
+        dispatch_order = indexes_to_run
+        expected_times_ms = None
+        if history:
+            expected_times_ms = get_expected_times_ms(metadata_list, history)
+            dispatch_order = get_longest_first_order(expected_times_ms,
+                                                     indexes_to_run)
+            predicted_makespan_sec = predict_makespan_ms(
+                (expected_times_ms[i] for i in dispatch_order),
+                num_workers) / 1000.0
+        expected_rss_kb = None
+        if args.mem_budget_kb:
+            expected_rss_kb = get_expected_rss_kb(metadata_list, history)
+            expected = simulate_concurrency(
+                # Without history, assume the tasks take the same time.
+                [expected_times_ms[i] if expected_times_ms else 1.0
+                 for i in dispatch_order],
+                [expected_rss_kb[i] for i in dispatch_order],
+                num_workers,
+                args.mem_budget_kb)
+            sys.stderr.write(
+                info_s("memory budget: %d MiB, expected concurrency: %.2f on "
+                       "average, %d at peak" %
+                       (args.mem_budget_kb >> 10, expected.average,
+                        expected.peak)))
+        if not dispatch_order:
+            return 0  # All cached: the workers and servers are not needed.
+        return run_tasks(args, num_workers, metadata_list, dispatch_order,
+                         expected_rss_kb, on_result)
+
     create_dir_if_needed(args.log)
     create_dir_if_needed(str(Path(args.log, "tmp")))  # Tests may write stuff.
     master_log_filepath = Path(args.log, LOG_FILE_BASE)
-    with open(master_log_filepath, 'w') as f:
-        json.dump(result_list, f, indent=2, separators=(",", ": "))  # Sorted.
-    error_count, _ = print_summary_report(args, num_tasks, result_list,
-                                          master_log_filepath,
-                                          time.time() - run_tests_start_time)
+    if shard_manifest != None:
+        with open(Path(args.log, SHARD_MANIFEST_FILE_BASE), 'w') as f:
+            json.dump(shard_manifest, f, indent=2, separators=(",", ": "))
+    run_tests_start_time = time.time()
+    # The pack files are closed however run() returns, also if all tasks are
+    # cached, and only emit_cached_results() appended to them.
+    if args.stream_log:
+        stream_log_filepath = Path(args.log, STREAM_LOG_FILE_BASE)
+        with StreamLogWriter(stream_log_filepath) as stream_log_writer, \
+             contextlib.closing(PACK_WRITER):
+            skipped_count = run(stream_log_writer.append)
+        run_tests_time = time.time() - run_tests_start_time
+        write_master_log_from_stream(stream_log_filepath, master_log_filepath)
+        get_result_list: Callable[[], Iterable[TaskResult]] = \
+            lambda: iter_sorted_entries(stream_log_filepath)
+    else:
+        # Filled in as tasks finish; sorted in the order the tasks are given.
+        # Kept compact, and expanded one at a time when iterated.
+        results: Dict[int, CompactResult] = {}
+        with contextlib.closing(PACK_WRITER):
+            skipped_count = run(lambda i, result: results.__setitem__(
+                i, CompactResult(result)))
+        run_tests_time = time.time() - run_tests_start_time
+        result_order = sorted(results)
+        get_result_list = lambda: (results[i].expand() for i in result_order)
+        write_master_log(get_result_list(), master_log_filepath)  # Sorted.
+    if feed != None:
+        unique_count = len(metadata_list) // args.repeat
+    if update_history:
+        update_history_file(Path(args.history), history, get_result_list())
+    if golden_manifest and args.write_golden:
+        set_golden_digests(golden_manifest, metadata_list)  # Changed ones.
+        golden_manifest.save()
+    if args.mem_budget_kb:
+        observed = get_observed_concurrency(get_result_list())
+        sys.stderr.write(
+            info_s("observed concurrency: %.2f on average, %d at peak; peak "
+                   "RSS sum: %d MiB" % (observed.average, observed.peak,
+                                        int(observed.peak_rss_kb) >> 10)))
+    error_count, _ = print_summary_report(args, result_count, unique_count,
+                                          get_result_list(),
+                                          master_log_filepath, run_tests_time,
+                                          predicted_makespan_sec,
+                                          skipped_count)
     return 0 if error_count == 0 else 1
 
 
-def find_repeated_test_id(test_ids: Iterator[str]) -> List[str]:
-    ids_seen, ids_repeated = set(), []
-    for test_id in test_ids:
-        if test_id in ids_seen:
-            ids_repeated.append(test_id)
-        ids_seen.add(test_id)
-    return ids_repeated
+# Sets "golden_sha256" in the metadata of tests whose golden files exist, for
+# the tasks to compare their stdout's digest with.
+def set_golden_digests(golden_manifest: GoldenManifest,
+                       metadata_list: List[TaskSpec]) -> None:
+    digests = golden_manifest.get_digests(
+        e["golden"] for e in metadata_list if e["golden"] != None)
+    for task in metadata_list:
+        if task["golden"] in digests:
+            task.metadata["golden_sha256"] = digests[task["golden"]]
 
 
-def make_metadata_list(args: Args) -> List[TaskMetadata]:
-    metadata_list = None
+# Calls on_result() with the cached results, and returns the indexes of the
+# tasks that are not cached, i.e. need to be run.
+def emit_cached_results(cache: ResultCache, metadata_list: List[TaskSpec],
+                        compression: Optional[str], artifacts_mode: str,
+                        log_dirname: str,
+                        on_result: ResultCallback) -> List[int]:
+    indexes_to_run = []
+    for i, metadata in enumerate(metadata_list):
+        # Of the test, as the key doesn't cover the repeat.
+        metadata.metadata["cache_key"] = cache.compute_key(metadata)
+        stdout_filename = get_compressed_filename(
+            os.path.abspath(
+                get_logfile_path_stem(metadata["hashed_id"],
+                                      metadata["repeat"]["count"],
+                                      log_dirname) + ".stdout"), compression)
+        cached_result = cache.lookup(metadata["cache_key"], metadata,
+                                     stdout_filename)
+        if cached_result != None:
+            store_task_artifacts(artifacts_mode, log_dirname, cached_result)
+            on_result(i, cached_result)
+        else:
+            indexes_to_run.append(i)
+    cache.save_digests()
+    return indexes_to_run
+
+
+def make_caching_callback(cache: ResultCache,
+                          metadata_list: List[TaskMetadata],
+                          on_result: ResultCallback) -> ResultCallback:
+    def on_result_and_store(i: int, result: TaskResult) -> None:
+        if result["ok"] and len(result["exceptions"]) == 0:
+            cache.store(metadata_list[i]["cache_key"], result)
+        on_result(i, result)
+
+    return on_result_and_store
+
+
+# dispatch_order: indexes into metadata_list, in the order the tasks are to be
+# dispatched; on_result() is still called with indexes into metadata_list.
+# expected_rss_kb: of each task in metadata_list, given if '--mem-budget' is.
+# feed: if given, tasks read from it are appended to metadata_list and
+# dispatched, while they are being read (see run_all()).
+# Returns the number of tasks skipped because of '--max-failures'.
+def run_tasks(args: Args,
+              num_workers: int,
+              metadata_list: List[TaskMetadata],
+              dispatch_order: List[int],
+              expected_rss_kb: Optional[List[float]],
+              on_result: ResultCallback,
+              feed: Optional[Iterator[TaskMetadata]] = None) -> int:
+    make_worker_input: Callable[[TaskMetadata], TaskWorkerArgs] = \
+        lambda metadata: (args.timer, args.timer_stats, args.stderr_mode,
+                          args.max_output_bytes, args.compress_artifacts,
+                          args.diff_context, args.artifacts, args.log,
+                          args.write_golden, metadata)
+    worker_inputs: List[TaskWorkerArgs] = [
+        make_worker_input(metadata_list[i]) for i in dispatch_order
+    ]
+    emit_result: ResultCallback = \
+        lambda i, result: on_result(dispatch_order[i], result)
+    adaptive_repeat = None
+    if args.adaptive_repeat and args.repeat > args.adaptive_repeat:
+        adaptive_repeat = AdaptiveRepeat([e[-1] for e in worker_inputs],
+                                         args.adaptive_repeat, emit_result)
+    failure_count = 0
+
+    def on_task_result(i: int, result: TaskResult) -> None:
+        nonlocal failure_count
+        if adaptive_repeat == None:
+            emit_result(i, result)
+        else:
+            decision = adaptive_repeat.add_result(i, result)
+            if decision != None:
+                retired, later_indexes = decision
+                if retired:
+                    dispatcher.drop(later_indexes)
+                else:
+                    dispatcher.release(later_indexes)
+        if result["ok"] == False and result["error_is_flaky"] == False:
+            failure_count += 1
+            if args.max_failures and failure_count == args.max_failures:
+                dispatcher.stop()
+                RUNNING_TIMERS.kill_all()
+
+    dispatcher = Dispatcher(
+        len(worker_inputs),
+        on_task_result,
+        held_indexes=adaptive_repeat.get_held_indexes()
+        if adaptive_repeat else (),
+        costs=[expected_rss_kb[i] for i in dispatch_order]
+        if expected_rss_kb else None,
+        budget=args.mem_budget_kb,
+        open_ended=feed != None)
+    feed_thread = None
+    if feed != None:
+        feed_thread = threading.Thread(target=feed_tasks,
+                                       args=(feed, dispatcher, metadata_list,
+                                             dispatch_order, worker_inputs,
+                                             make_worker_input),
+                                       daemon=True)
+        feed_thread.start()
+    run_start_time = time.time()
+    with rotating_logger.logging_server(), \
+         POSTPROCESS_POOL.started(args.postprocess_workers), \
+         maybe_serve_remote_workers(args, dispatcher, worker_inputs):
+        if args.engine == "async":
+            async_map(num_workers, run_one_task_async, worker_inputs,
+                      dispatcher, args.slot_cpus)
+        else:
+            pool_map(num_workers, run_one_task, worker_inputs, dispatcher,
+                     args.slot_cpus)
+        # This should be called after worker threads are joined to avoid
+        # race condition. We don't send a clear command via socket, because
+        # that may arrive at the socket after the logging server is closed.
+        rotating_logger.clear_all_transient_logs()
+    if feed_thread:
+        # Returns at once if all tasks are run; if the run is stopped or
+        # aborted, the feed may be blocked on reading, e.g. '--paths-from -',
+        # so the (daemon) thread is not waited for long.
+        feed_thread.join(FEED_JOIN_TIMEOUT_SEC)
+    if args.postprocess_workers:
+        print_postprocess_stats(time.time() - run_start_time)
+    if adaptive_repeat:
+        adaptive_repeat.flush()
+        sys.stderr.write(
+            info_s("adaptive repeat: %d tests retired after %d repeats" %
+                   (adaptive_repeat.get_retired_count(), args.adaptive_repeat)))
+    unfinished_indexes = dispatcher.get_unfinished_indexes()
+    for i in unfinished_indexes:
+        emit_result(
+            i,
+            generate_skipped_result_dict(worker_inputs[i][-1],
+                                         args.write_golden))
+    return len(unfinished_indexes)
+
+
+FEED_BATCH_SIZE_MAX = 1024
+FEED_JOIN_TIMEOUT_SEC = 1.0
+
+
+# Appends the tasks read from the feed to the lists and then to the dispatcher,
+# in batches of doubling sizes, so the first task is dispatched at once and
+# later ones without waking up the workers for each of them. The lists only
+# have the tasks given to the dispatcher, even if the run is stopped while a
+# batch is being read.
+def feed_tasks(feed: Iterator[TaskMetadata], dispatcher: Dispatcher,
+               metadata_list: List[TaskMetadata], dispatch_order: List[int],
+               worker_inputs: List[TaskWorkerArgs],
+               make_worker_input: Callable[[TaskMetadata],
+                                           TaskWorkerArgs]) -> None:
+
+    def add_batch(batch: List[TaskMetadata]) -> bool:
+        start = len(metadata_list)
+        dispatch_order.extend(range(start, start + len(batch)))
+        metadata_list.extend(batch)
+        worker_inputs.extend(make_worker_input(e) for e in batch)
+        if dispatcher.add_tasks(len(batch)):
+            return True
+        for e in (dispatch_order, metadata_list, worker_inputs):
+            del e[start:]
+        return False  # The run is stopped.
+
+    batch_size, batch = 1, []
+    try:
+        for metadata in feed:
+            batch.append(metadata)
+            if len(batch) == batch_size:
+                if not add_batch(batch):
+                    return
+                batch_size, batch = min(2 * batch_size,
+                                        FEED_BATCH_SIZE_MAX), []
+        if add_batch(batch):
+            dispatcher.end_tasks()
+    except BaseException as e:  # Not to leave the run waiting for tasks.
+        dispatcher.fail(e)  # Re-raised in the main thread.
+
+
+def print_postprocess_stats(run_time_sec: float) -> None:
+    stats = POSTPROCESS_POOL.get_stats()
+    sys.stderr.write(
+        info_s("postprocess workers: %d, diffs: %d, all workers busy for "
+               "%.3f sec (%.1f%% of the run)" %
+               (stats.num_workers, stats.job_count, stats.saturated_sec,
+                100.0 * stats.saturated_sec / max(run_time_sec, 1e-6))))
+
+
+def maybe_serve_remote_workers(args: Args, dispatcher: Dispatcher,
+                               worker_inputs: List[TaskWorkerArgs]):
+    if not args.coordinator:
+        return contextlib.nullcontext()
+
+    def on_remote_result(i: int, result: TaskResult) -> None:
+        print_one_task_realtime_log(worker_inputs[i][-1], result)
+        dispatcher.finish(i, result)
+
+    def get_metadata(i: int) -> TaskMetadata:
+        return dict(worker_inputs[i][-1])  # A TaskSpec, to be serialized.
+
+    token = get_coordinator_token()
+    token_filename = os.path.join(args.log, COORDINATOR_TOKEN_FILE_BASE)
+    save_coordinator_token(token_filename, token)
+    sys.stderr.write(
+        info_s("serving tasks to workers at %s, with the token in %s" %
+               (args.coordinator, token_filename)))
+    return coordinator_server(args.coordinator,
+                              token,
+                              dispatcher,
+                              config={
+                                  "cwd": os.getcwd(),
+                                  "timer": get_abs_timer_path(args.timer),
+                                  "timer_stats": args.timer_stats,
+                                  "stderr_mode": args.stderr_mode,
+                                  "max_output_bytes": args.max_output_bytes,
+                                  "compression": args.compress_artifacts,
+                                  "diff_context": args.diff_context,
+                                  "artifacts": args.artifacts,
+                                  "log": os.path.abspath(args.log),
+                                  "write_golden": args.write_golden,
+                              },
+                              get_metadata=get_metadata,
+                              on_remote_result=on_remote_result)
+
+
+def get_abs_timer_path(timer: str) -> str:
+    return timer if timer == BUILTIN_TIMER else os.path.abspath(timer)
+
+
+# Used by main() for '--worker'.
+def run_as_remote_worker(args: Args) -> int:
+    token = os.environ.get(COORDINATOR_TOKEN_ENV)
+    if not token:
+        err_exit(
+            error_s("'--worker' needs the coordinator's token in $%s, found "
+                    "in %s in the coordinator's log directory" %
+                    (COORDINATOR_TOKEN_ENV, COORDINATOR_TOKEN_FILE_BASE)))
+    try:
+        config = fetch_remote_config(args.worker, token)
+    except OSError as e:
+        err_exit(error_s("cannot connect to coordinator at %s: %s" %
+                         (args.worker, e)))
+    except RemoteProtocolError as e:
+        err_exit(error_s("protocol error with coordinator at %s: %s" %
+                         (args.worker, e)))
+    if config == None:
+        sys.stderr.write(info_s("coordinator is closing"))
+        return 0
+    # Paths in metadata are relative to the coordinator's working directory.
+    timer = get_abs_timer_path(args.timer) if args.timer else config["timer"]
+    os.chdir(config["cwd"])
+    task_counts: List[int] = []
+
+    def run_task(metadata: TaskMetadata) -> TaskResult:
+        return run_one_task(
+            (timer, config["timer_stats"], config["stderr_mode"],
+             config["max_output_bytes"], config["compression"],
+             config["diff_context"], config["artifacts"], config["log"],
+             config["write_golden"], metadata))
+
+    def worker_slot_loop(slot: int) -> None:
+        if args.slot_cpus:  # Each thread has its own context.
+            PINNED_CPU.set(args.slot_cpus[slot])
+        try:
+            task_counts.append(run_worker_slot(args.worker, token, run_task))
+        except OSError:
+            pass  # The coordinator is gone, e.g. all tasks are finished.
+        except RemoteProtocolError as e:
+            sys.stderr.write(
+                error_s("protocol error with coordinator at %s: %s" %
+                        (args.worker, e)))
+
+    num_slots = 1 if args.sequential else NUM_WORKERS_MAX
+    if args.slot_cpus:
+        num_slots = min(num_slots, len(args.slot_cpus))
+    with rotating_logger.logging_server(), \
+         POSTPROCESS_POOL.started(args.postprocess_workers), \
+         contextlib.closing(PACK_WRITER):
+        threads = [
+            threading.Thread(target=worker_slot_loop,
+                             args=(slot,),
+                             daemon=True) for slot in range(num_slots)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rotating_logger.clear_all_transient_logs()
+    sys.stderr.write(info_s("ran %d tasks for coordinator at %s" %
+                            (sum(task_counts), args.worker)))
+    return 0
+
+
+# Returns the metadata records, with "hashed_id", read as they are iterated,
+# which raises MetadataError if a record is bad.
+def open_metadata_source(args: Args) -> Iterator[TaskMetadata]:
     if len(args.paths) > 0:
         missing_executables = [e for e in args.paths if not os.path.isfile(e)]
         if len(missing_executables) > 0:
             err_exit(
                 error_s("the following executable(s) "
                         "are not found: %s" % str(missing_executables)))
-        metadata_list = [
-            get_metadata_from_path(str(i + 1), path)
-            for i, path in enumerate(args.paths)
-        ]
+        records = (get_metadata_from_path(str(i + 1), path)
+                   for i, path in enumerate(args.paths))
+    elif args.paths_from != None:
+        if args.paths_from != "-" and not os.path.isfile(args.paths_from):
+            err_exit(
+                error_s("'--paths-from' file not found: %s" % args.paths_from))
+        records = iter_paths_file(args.paths_from)
     elif args.meta != None:
         if not os.path.isfile(args.meta):
             err_exit(error_s("'--meta' file not found: %s" % args.meta))
-        with open(args.meta, 'r') as f:
-            try:
-                metadata_list = json.load(f)
-            except ValueError:
-                err_exit(error_s("not a valid JSON file: %s" % args.meta))
-        error_str = validate_metadata_schema_noexcept(metadata_list)
-        if error_str:
-            err_exit(
-                error_s("metadata format is bad; check out '--docs'\n\t%s" %
-                        error_str))
-        repeated_ids = find_repeated_test_id(e["id"] for e in metadata_list)
-        if len(repeated_ids) > 0:
-            err_exit(error_s("test ID repeated: %s" % ", ".join(repeated_ids)))
+        records = iter_checked_metadata(iter_meta_file(args.meta))
+        if args.meta_cache:
+            snapshot = MetadataSnapshot(Path(args.meta_cache), args.meta)
+            snapshot_records = snapshot.load()
+            if snapshot_records != None:
+                return snapshot_records  # Already checked and hashed.
+            return snapshot.save_as_read(iter_hashed_metadata(records))
     else:
         raise RuntimeError("Should not reach here")
-    return metadata_list
+    return iter_hashed_metadata(records)
+
+
+def iter_hashed_metadata(
+        records: Iterator[TaskMetadata]) -> Iterator[TaskMetadata]:
+    for metadata in records:
+        metadata["hashed_id"] = compute_hashed_id(prog=Path(metadata["path"]),
+                                                  id_name=metadata["id"])  # str
+        yield metadata
+
+
+def make_metadata_list(args: Args) -> List[TaskMetadata]:
+    try:
+        return list(open_metadata_source(args))
+    except MetadataError as e:
+        err_exit(error_s(str(e)))
+
+
+# Whether the tasks can be dispatched while the metadata is read, i.e. no
+# option needs all the tasks beforehand.
+def can_stream_tasks(args: Args) -> bool:
+    return not (args.write_golden or args.history or args.shard or args.cache
+                or args.golden_manifest or args.adaptive_repeat
+                or args.mem_budget_kb)
+
+
+def select_shard(
+    metadata_list: List[TaskMetadata],
+    shard_spec: str,
+    history: History,
+) -> Tuple[List[TaskMetadata], Dict[str, Any]]:
+    try:
+        shard_index, shard_count = parse_shard_spec(shard_spec)
+    except ValueError as e:
+        err_exit(error_s(str(e)))
+    plan = plan_shard([m["hashed_id"] for m in metadata_list], shard_index,
+                      shard_count, history)
+    selected = [metadata_list[i] for i in plan.indexes]
+    return selected, make_shard_manifest(shard_index, shard_count, plan,
+                                         [m["id"] for m in selected])
 
 
 def process_metadata_list(
@@ -386,7 +1410,6 @@ def process_metadata_list(
 ) -> Tuple[List[TaskMetadata], int]:
     # If args.write_golden == True, ignore tests that do not have a golden file
     # path, because there is no need to run these tests.
-    ignore_metadata_indexes = []
     if args.write_golden:
         prompt = (
             "About to overwrite golden files of tests with their stdout.\n"
@@ -394,67 +1417,50 @@ def process_metadata_list(
         consent = input(prompt)
         if consent.lower() != "y":
             err_exit("Aborted.")
-        ignore_metadata_indexes = [
-            i for (i, m) in enumerate(metadata_list) if m["golden"] == None
-        ]
-        if len(ignore_metadata_indexes) > 0:
+        ignored_count = len(metadata_list)
+        metadata_list = [m for m in metadata_list if m["golden"] != None]
+        ignored_count -= len(metadata_list)
+        if ignored_count > 0:
             print(
                 info_s("%d tests are ignored because they specified "
-                       "no golden file to write" %
-                       len(ignore_metadata_indexes)))
-    # Process the raw metadata list:
-    # 1. take care of args.repeat; 2. take care of args.read_flakes
-    metadata_list_processed = []
-    flaky_tests_decl: Dict[
-        str, List[str]] = maybe_parse_flakiness_decls_from_dir(
-            Path(args.read_flakes) if args.read_flakes else None)
+                       "no golden file to write" % ignored_count))
+    metadata_list_processed = list(
+        iter_processed_metadata(iter(metadata_list), args,
+                                read_flakiness_decls(args)))
     unique_count = len(metadata_list)
-    for i, metadata in enumerate(metadata_list):
-        if i in ignore_metadata_indexes:
-            continue
-        metadata["hashed_id"] = compute_hashed_id(prog=Path(metadata["path"]),
-                                                  id_name=metadata["id"])  # str
-        metadata["flaky_errors"] = flaky_tests_decl.get(metadata["id"], [])
-        for repeat_cnt in range(args.repeat):
-            metadata_copy = copy.deepcopy(metadata)
-            metadata_copy["repeat"] = {
-                "count": repeat_cnt + 1,
-                "all": args.repeat,
-            }
-            metadata_list_processed.append(metadata_copy)
     return metadata_list_processed, unique_count
 
 
-def validate_metadata_schema_noexcept(
-    metadata_list: List[TaskMetadata]
-) -> Optional[str]:  # Error explanation, None if OK.
-    try:
-        schema.Schema([{  # sync with EXPLANATION_STRING's spec
-            "id": str,
-            "path": str,
-            "args": [str],
-            "prefix": [str],
-            "golden": schema.Or(str, None),
-            "timeout_ms": schema.And(int, lambda v: v > 0),
-            "envs": schema.Or({schema.Optional(str): str}, None),
-            "exit": {
-                "type": schema.Or("return", "timeout", "signal", "quit",
-                                  "unknown"),
-                "repr": int,
-                schema.Optional(str): object,  # Allow more fields, if any.
-            },
-            schema.Optional(str): object,  # Allow more fields, if any.
-        }]).validate(metadata_list)
-        return None
-    except schema.SchemaError as e:  # Carries explanations.
-        return str(e)
+# Exits on errors, so it's called in the main thread, before the tasks are run.
+def read_flakiness_decls(args: Args) -> Dict[str, List[str]]:
+    return maybe_parse_flakiness_decls_from_dir(
+        Path(args.read_flakes) if args.read_flakes else None)
+
+
+# Processes the metadata records into tasks: 1. take care of args.repeat;
+# 2. take care of flaky_tests_decl, from args.read_flakes. The record is not
+# modified (see MetadataSnapshot.save_as_read()), and the repeats share a copy
+# of it.
+def iter_processed_metadata(
+        metadata_iter: Iterator[TaskMetadata], args: Args,
+        flaky_tests_decl: Dict[str, List[str]]) -> Iterator[TaskSpec]:
+    repeats = [{
+        "count": repeat_cnt + 1,
+        "all": args.repeat,
+    } for repeat_cnt in range(args.repeat)]
+    for metadata in metadata_iter:
+        test_metadata = dict(metadata,
+                             flaky_errors=flaky_tests_decl.get(
+                                 metadata["id"], []))
+        for repeat in repeats:
+            yield TaskSpec(test_metadata, repeat)
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Test runner: with timer, logging, diff in HTML",
-        epilog="Unless '--docs' is given, exactly one of '--paths' "
-        "and '--meta' is needed.\n"
+        epilog="Unless '--docs' is given, exactly one of '--paths', "
+        "'--paths-from' and '--meta' is needed.\n"
         "Program exits with 0 on success, 1 on test errors, "
         "2 on internal errors.",
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -462,16 +1468,29 @@ def main():
                         metavar="TIMER",
                         type=str,
                         default=None,
-                        help="path to the timer program")
+                        help="path to the timer program, or '%s' to run "
+                        "tests without one" % BUILTIN_TIMER)
+    parser.add_argument("--timer-stats",
+                        choices=["file", "delimiter"],
+                        default="file",
+                        help="how the timer reports the stats: to a file "
+                        "given by CTIMER_STATS, falling back to delimiter if "
+                        "not written, or in stdout between delimiters, "
+                        "default: file")
     parser.add_argument("--meta",
                         metavar="PATH",
                         default=None,
-                        help="JSON file of tests' metadata")
+                        help="JSON or JSON lines file of tests' metadata")
     parser.add_argument("--paths",
                         metavar="T",
                         nargs='+',
                         default=[],
                         help="paths to test executables")
+    parser.add_argument("--paths-from",
+                        metavar="FILE",
+                        default=None,
+                        help="file of paths to test executables, one per "
+                        "line, or '-' for stdin")
     parser.add_argument("-g",
                         "--log",
                         metavar="DIR",
@@ -484,13 +1503,125 @@ def main():
                         type=int,
                         default=1,
                         help="run each test N times, default: 1")
+    parser.add_argument("--adaptive-repeat",
+                        metavar="K",
+                        type=int,
+                        default=None,
+                        help="with '--repeat N', retire a test after K "
+                        "repeats if they pass with the same exit and stdout")
     parser.add_argument("-1",
                         "--sequential",
                         action="store_true",
                         help="run sequentially instead concurrently")
+    parser.add_argument("--engine",
+                        choices=["thread", "async"],
+                        default="thread",
+                        help="how tasks are run concurrently, default: thread")
+    parser.add_argument("--stream-log",
+                        action="store_true",
+                        help="append each result to %s as soon as the task "
+                        "finishes, and build %s from it" %
+                        (STREAM_LOG_FILE_BASE, LOG_FILE_BASE))
+    parser.add_argument("--history",
+                        metavar="FILE",
+                        type=str,
+                        default=None,
+                        help="dispatch tests expected to take the longest "
+                        "first, per the run times in FILE (a history file, "
+                        "updated after the run, or a previous %s)" %
+                        LOG_FILE_BASE)
+    parser.add_argument("--cache",
+                        metavar="DIR",
+                        type=str,
+                        default=None,
+                        help="reuse passing results from the cache in DIR for "
+                        "tests whose inputs are unchanged")
+    parser.add_argument("--meta-cache",
+                        metavar="DIR",
+                        type=str,
+                        default=None,
+                        help="keep snapshots of parsed '--meta' files in DIR, "
+                        "used while a file is unchanged")
+    parser.add_argument("--golden-manifest",
+                        metavar="FILE",
+                        type=str,
+                        default=None,
+                        help="keep golden files' digests in FILE, so a test "
+                        "passes without its golden file read if the digests "
+                        "match")
+    parser.add_argument("--shard",
+                        metavar="I/N",
+                        type=str,
+                        default=None,
+                        help="run only the I-th of N shards of the tests, "
+                        "balanced by run times in '--history' if given")
+    parser.add_argument("--mem-budget",
+                        metavar="SIZE",
+                        type=str,
+                        default=None,
+                        help="start a task only if the expected peak RSS of "
+                        "the running tasks fits in SIZE, e.g. 48G")
+    parser.add_argument("--pin-cpus",
+                        metavar="LIST",
+                        nargs="?",
+                        const="",
+                        default=None,
+                        help="pin each worker to a dedicated CPU, from LIST "
+                        "(e.g. 0-3,8) if given, or one per physical core")
+    parser.add_argument("--coordinator",
+                        metavar="ADDR",
+                        type=str,
+                        default=None,
+                        help="also serve tasks to '--worker' processes at "
+                        "ADDR (Unix socket path, or HOST:PORT)")
+    parser.add_argument("--worker",
+                        metavar="ADDR",
+                        type=str,
+                        default=None,
+                        help="run tasks for the coordinator at ADDR, instead "
+                        "of tests given by '--paths', '--paths-from' or "
+                        "'--meta'")
+    parser.add_argument("--max-failures",
+                        metavar="N",
+                        type=int,
+                        default=None,
+                        help="stop the run after N unexpected errors, killing "
+                        "the running tests and skipping the rest")
+    parser.add_argument("--artifacts",
+                        choices=ARTIFACTS_MODES,
+                        default=ARTIFACTS_MODES[0],
+                        help="how the tests' stdout files are stored, "
+                        "default: %s" % ARTIFACTS_MODES[0])
+    parser.add_argument("--compress-artifacts",
+                        choices=list(COMPRESSION_SUFFIXES),
+                        default=None,
+                        help="write the tests' stdout and diff files "
+                        "compressed in the format")
+    parser.add_argument("--postprocess-workers",
+                        metavar="N",
+                        type=int,
+                        default=0,
+                        help="compute diffs with the golden files in N "
+                        "processes, instead of in the workers, default: 0")
     parser.add_argument("--also-stderr",
                         action="store_true",
                         help="redirect stderr to stdout")
+    parser.add_argument("--separate-stderr",
+                        action="store_true",
+                        help="write stderr to a .stderr file in the log "
+                        "directory")
+    parser.add_argument("--max-output-bytes",
+                        metavar="N",
+                        type=int,
+                        default=None,
+                        help="truncate each test's stdout file at N bytes")
+    parser.add_argument("--diff-context",
+                        metavar="N",
+                        type=str,
+                        default="full",
+                        help="show N unchanged lines around the changes in "
+                        "diff files, or the whole files if 'full', default: "
+                        "full")
     parser.add_argument(
         "--read-flakes",
         metavar="DIR",
@@ -510,30 +1641,127 @@ def main():
         print(EXPLANATION_STRING)
         return 0
 
+    args.slot_cpus = None
+    if args.pin_cpus != None:
+        if not is_cpu_pinning_supported():
+            err_exit(error_s("'--pin-cpus' is not supported on %s" % SYS_NAME))
+        try:
+            args.slot_cpus = select_cpus(args.pin_cpus or None)
+        except ValueError as e:
+            err_exit(error_s(str(e)))
+
+    if args.timer == BUILTIN_TIMER and not is_builtin_timer_supported():
+        err_exit(
+            error_s("'--timer %s' is not supported on %s, or by Python %d.%d" %
+                    (BUILTIN_TIMER, SYS_NAME, sys.version_info.major,
+                     sys.version_info.minor)))
+
+    if args.postprocess_workers < 0:
+        err_exit(error_s("'--postprocess-workers' should not be negative."))
+
+    if args.worker:
+        if (args.timer and args.timer != BUILTIN_TIMER
+                and not os.path.isfile(args.timer)):
+            err_exit(error_s("timer program not found: %s" % args.timer))
+        return run_as_remote_worker(args)
+
     if args.timer == None:
         err_exit(error_s("'--timer' is not given; use '-h' for help"))
-    elif not os.path.isfile(args.timer):
-        err_exit(error_s("timer program not found: %s" % args.timer))
-    args.timer = os.path.relpath(args.timer)
+    elif args.timer != BUILTIN_TIMER:
+        if not os.path.isfile(args.timer):
+            err_exit(error_s("timer program not found: %s" % args.timer))
+        args.timer = os.path.relpath(args.timer)
 
-    if ((len(args.paths) == 0 and args.meta == None)
-            or (len(args.paths) > 0 and args.meta != None)):
+    if [len(args.paths) > 0, args.paths_from != None,
+            args.meta != None].count(True) != 1:
+        err_exit(
+            error_s("exactly one of '--paths', '--paths-from' and '--meta' "
+                    "should be given."))
+    if args.paths_from == "-" and args.write_golden:
         err_exit(
-            error_s("exactly one of '--paths' and '--meta' should be given."))
+            error_s("'--paths-from -' and '--write-golden' cannot be used "
+                    "together."))
     if args.repeat != 1 and args.write_golden:
         err_exit(
             error_s("'--repeat' and '--write-golden' cannot be used together."))
+    if args.cache and (args.repeat != 1 or args.write_golden):
+        err_exit(
+            error_s("'--cache' cannot be used with '--repeat' or "
+                    "'--write-golden'."))
+    if args.adaptive_repeat != None and args.adaptive_repeat < 1:
+        err_exit(error_s("'--adaptive-repeat' should be at least 1."))
+    if args.max_failures != None and args.max_failures < 1:
+        err_exit(error_s("'--max-failures' should be at least 1."))
+    if args.max_output_bytes != None and args.max_output_bytes < 1:
+        err_exit(error_s("'--max-output-bytes' should be at least 1."))
+    if args.diff_context == "full":
+        args.diff_context = None
+    elif args.diff_context.isdigit():
+        args.diff_context = int(args.diff_context)
+    else:
+        err_exit(
+            error_s("'--diff-context' should be 'full' or a number, but "
+                    "found '%s'." % args.diff_context))
+    if args.also_stderr and args.separate_stderr:
+        err_exit(
+            error_s("'--also-stderr' and '--separate-stderr' cannot be used "
+                    "together."))
+    args.stderr_mode = STDERR_TO_NULL
+    if args.also_stderr:
+        args.stderr_mode = STDERR_TO_STDOUT
+    elif args.separate_stderr:
+        args.stderr_mode = STDERR_TO_FILE
+    args.mem_budget_kb = None
+    if args.mem_budget:
+        try:
+            args.mem_budget_kb = parse_mem_size_kb(args.mem_budget)
+        except ValueError as e:
+            err_exit(error_s(str(e)))
     if args.read_flakes and not os.path.isdir(args.read_flakes):
         err_exit(error_s("directory not found: %s" % args.read_flakes))
 
+    if can_stream_tasks(args):
+        metadata_iter = open_metadata_source(args)
+        try:
+            first_metadata = next(metadata_iter, None)
+        except MetadataError as e:
+            err_exit(error_s(str(e)))
+        if first_metadata == None:
+            err_exit(error_s("no test found."))
+        feed = iter_processed_metadata(
+            itertools.chain([first_metadata], metadata_iter), args,
+            read_flakiness_decls(args))
+        try:
+            return run_all(args, [], 0, {}, False, None, feed)
+        except MetadataError as e:  # Found after some tasks have run.
+            RUNNING_TIMERS.kill_all()
+            err_exit(error_s(str(e)))
+
     metadata_list = make_metadata_list(args)
-    if metadata_list == None or len(metadata_list) == 0:
+    if len(metadata_list) == 0:
         err_exit(error_s("no test found."))
 
+    history: History = {}
+    history_from_master_log = False
+    if args.history:
+        try:
+            history, history_from_master_log = load_history(Path(args.history))
+        except ValueError as e:
+            err_exit(error_s(str(e)))
+
+    shard_manifest = None
+    if args.shard:
+        metadata_list, shard_manifest = select_shard(metadata_list, args.shard,
+                                                     history)
+        if len(metadata_list) == 0:
+            sys.stderr.write(info_s("no test in shard %s" % args.shard))
+
     metadata_list_processed, unique_test_count = process_metadata_list(
         metadata_list, args)
 
-    return run_all(args, metadata_list_processed, unique_test_count)
+    return run_all(args, metadata_list_processed, unique_test_count, history,
+                   bool(args.history) and not history_from_master_log,
+                   shard_manifest)
 
 
 if __name__ == "__main__":
@@ -10,16 +10,23 @@ import argparse
 import datetime
 import itertools
 import json
+import lzma
 import os
 import shutil
 import statistics
 import sys
+import zlib
 from pathlib import Path
 from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from pylibs import score_utils
+from pylibs.runner_artifacts import PACKS_DIR_BASE, extract_artifact
+from pylibs.runner_compress import get_uncompressed_filename
 
 UI_ASSETS_DIR: Path = Path(__file__).parent.joinpath("ui")
+# Where the artifacts packed or compressed by score_run.py are extracted to,
+# under the generated directory.
+EXTRACTED_ARTIFACTS_DIR_BASE = "artifacts"
 
 # Store data in native JS data structures. Alternatives and reasons of not
 # using:
@@ -119,6 +126,8 @@ class TaskResGetter:
         lambda e: (e["stdout"]["ok"], e["stdout"]["actual_file"], e["stdout"]["diff_file"])
     golden_file: Callable[[dict], Optional[str]] = \
         lambda e: e["stdout"]["golden_file"]
+    packed: Callable[[dict], dict] = \
+        lambda e: e.get("packed") or {}
 
 
 class TestAggregateInfo:  # pylint: disable=too-many-instance-attributes
@@ -252,6 +261,46 @@ def _use_relpaths_in_stdout_tuple(stdout_tuple: tuple,
     return tuple(res)
 
 
+def _extract_artifacts(sorted_task_results: List[dict], master_log: Path,
+                       generate_to_dir: Path, extract_all: bool) -> None:
+    """
+    Extracts the stdout and diff files that browsers can't open as they are,
+    i.e. packed by '--artifacts pack' or compressed by '--compress-artifacts',
+    into the generated directory, decompressed, and points the task results to
+    them. Only those of tasks with errors are extracted, unless extract_all is
+    True; the others' paths are set to None if packed, so the page has no
+    broken links, or kept if compressed, so the files can be downloaded.
+    """
+    for e in sorted_task_results:
+        packed = TaskResGetter.packed(e)
+        for key, field in (("stdout", "actual_file"), ("diff", "diff_file")):
+            filename, ref = e["stdout"][field], packed.get(key)
+            if filename == None:
+                continue
+            uncompressed_filename = get_uncompressed_filename(filename)
+            if ref == None and uncompressed_filename == filename:
+                continue  # Neither packed nor compressed.
+            if not (extract_all or TaskResGetter.ok(e) == False):
+                if ref != None:
+                    e["stdout"][field] = None
+                continue
+            if ref != None and not os.path.isfile(ref["pack"]):
+                # The log directory is moved.
+                ref = dict(ref,
+                           pack=str(master_log.parent.joinpath(
+                               PACKS_DIR_BASE, os.path.basename(ref["pack"]))))
+            dest = generate_to_dir.joinpath(
+                EXTRACTED_ARTIFACTS_DIR_BASE,
+                os.path.basename(uncompressed_filename)).absolute()
+            try:
+                extract_artifact(filename, ref, str(dest))
+            except (OSError, EOFError, zlib.error, lzma.LZMAError) as err:
+                sys.exit(
+                    score_utils.error_s("cannot extract %s: %s" %
+                                        (filename, err)))
+            e["stdout"][field] = str(dest)
+
+
 def _generate_web_view_impl(
     *,
     sorted_task_results: List[dict],
@@ -354,6 +403,7 @@ def generate_web_view(
     timer_path: Optional[Path],
     additional_info: Optional[List[str]],
     generate_to_dir: Path,
+    extract_all_artifacts: bool = False,
 ) -> Path:
     """
     Params:
@@ -367,6 +417,9 @@ def generate_web_view(
     * additional_info: Information you want to display additionally (list of
       lines). If None, the info area isn't shown (different from an empty list).
     * generate_to_dir: Where to write the files produced by this generator.
+    * extract_all_artifacts: If the log is written with '--artifacts pack'
+      or '--compress-artifacts', whether to extract the stdout files of all
+      tasks, not just those with errors.
 
     Returns:
 
@@ -396,6 +449,8 @@ def generate_web_view(
             sys.exit(
                 score_utils.error_s("currupted log file %s: %s" %
                                     (master_log, e)))
+    _extract_artifacts(sorted_task_results, master_log, generate_to_dir,
+                       extract_all_artifacts)
     return _generate_web_view_impl(
         sorted_task_results=sorted_task_results,
         test_title=test_title,
@@ -437,6 +492,11 @@ def main():
                         default="html",
                         help="directory to write results (if the directory "
                         "already exits, it will be replaced), default: ./html")
+    parser.add_argument("--extract-all",
+                        action="store_true",
+                        help="if the log is written with '--artifacts pack' or "
+                        "'--compress-artifacts', extract all tasks' stdout, "
+                        "not just those with errors")
     args = parser.parse_args()
     if not Path(args.log).is_file():
         sys.exit(score_utils.error_s("file not found: %s" % args.log))
@@ -449,6 +509,7 @@ def main():
         timer_path=Path(args.timer) if args.timer else None,
         additional_info=None,
         generate_to_dir=Path(args.to_dir),
+        extract_all_artifacts=args.extract_all,
     )
     return 0
 